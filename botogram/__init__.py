@@ -29,9 +29,11 @@ del configure_logger
 from .api import APIError, ChatUnavailableError
 from .bot import Bot, create, channel
 from .frozenbot import FrozenBotError
+from .shared import TransactionConflictError
 from .components import Component
-from .decorators import pass_bot, pass_shared, help_message_for
-from .runner import run
+from .decorators import pass_bot, pass_shared, help_message_for, priority, \
+    timeout
+from .runner import run, run_workers
 from .objects import *
 from .utils import usernames_in
 from .callbacks import Buttons, ButtonsRow
@@ -19,6 +19,7 @@
 #   DEALINGS IN THE SOFTWARE.
 
 import os
+import threading
 
 import requests
 
@@ -91,18 +92,23 @@ class TelegramAPI:
         self._api_key = api_key
         self._endpoint = endpoint
 
-        self._session_cache = None
+        self._sessions = {}
         self._session_pid = -1
 
     def _session(self):
         """Get the current requests session"""
-        # Ensure a new session is created if the PID changes. This is because
+        # Ensure new sessions are created if the PID changes. This is because
         # sessions behaves badly if you use them after fork()
-        if self._session_pid != os.getpid() or self._session_cache is None:
-            self._session_cache = requests.Session()
+        if self._session_pid != os.getpid():
+            self._sessions = {}
             self._session_pid = os.getpid()
 
-        return self._session_cache
+        # Sessions aren't thread-safe, so each thread gets its own one
+        thread = threading.get_ident()
+        if thread not in self._sessions:
+            self._sessions[thread] = requests.Session()
+
+        return self._sessions[thread]
 
     def call(self, method, params=None, files=None, expect=None):
         """Call a method of the API"""
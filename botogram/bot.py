@@ -96,6 +96,11 @@ class Bot(frozenbot.FrozenBot):
 
         self._bot_id = str(uuid.uuid4())
 
+        # The shared memory of the bot is named after its ID, which is the
+        # first part of the token
+        self._shared_memory.register_name(self._bot_id,
+                                          self.api.token.split(":", 1)[0])
+
         self.use(defaults.DefaultComponent())
         self.use(self._main_component, only_init=True)
 
@@ -203,10 +208,19 @@ class Bot(frozenbot.FrozenBot):
             return func
         return __
 
-    def timer(self, interval):
+    def timer(self, interval, jitter=0, max_instances=1, overlap="skip"):
         """Register a new timer"""
         def __(func):
-            self._main_component.add_timer(interval, func)
+            self._main_component.add_timer(interval, func, jitter,
+                                           max_instances, overlap)
+            return func
+        return __
+
+    def cron(self, expression, jitter=0, max_instances=1, overlap="skip"):
+        """Register a new task executed following a cron expression"""
+        def __(func):
+            self._main_component.add_cron(expression, func, jitter,
+                                          max_instances, overlap)
             return func
         return __
 
@@ -221,6 +235,19 @@ class Bot(frozenbot.FrozenBot):
         """This decorator is deprecated, and it calls @prepare_memory"""
         return self.prepare_memory(func)
 
+    def memory_evicted(self, func):
+        """Add a hook called when a key of the shared memory is evicted"""
+        self._main_component.add_memory_evicted_hook(func)
+        return func
+
+    def set_memory_limits(self, ttl=None, max_keys=None, eviction="lru"):
+        """Set the limits of the shared memory of the bot"""
+        self._main_component.set_memory_limits(ttl, max_keys, eviction)
+        self._shared_memory.register_limits(
+            self._main_component_id,
+            self._main_component._get_memory_limits(),
+        )
+
     def chat_unavailable(self, func):
         """Add a chat unavailable hook"""
         self._main_component.add_chat_unavailable_hook(func)
@@ -237,8 +264,12 @@ class Bot(frozenbot.FrozenBot):
             # Register initializers for the shared memory
             chains = component._get_chains()
             compid = component._component_id
+            self._shared_memory.register_name(compid, component.component_name)
             preparers = chains["memory_preparers"][0]
             self._shared_memory.register_preparers_list(compid, preparers)
+            self._shared_memory.register_limits(
+                compid, component._get_memory_limits(),
+            )
 
             # Register tasks
             self._scheduler.register_tasks_list(chains["tasks"][0])
@@ -251,10 +282,10 @@ class Bot(frozenbot.FrozenBot):
         frozen = self.freeze()
         return frozen.process(update)
 
-    def run(self, workers=2):
+    def run(self, workers=2, **options):
         """Run the bot with the multi-process runner"""
-        inst = runner.BotogramRunner(self, workers=workers)
-        inst.run()
+        inst = runner.BotogramRunner(self, workers=workers, **options)
+        return inst.run()
 
     def register_update_processor(self, kind, processor):
         """Register a new update processor"""
@@ -270,6 +301,7 @@ class Bot(frozenbot.FrozenBot):
         """Return a frozen instance of the bot"""
         chains = components.merge_chains(self._main_component,
                                          *self._components)
+        self._shared_memory.register_evicted_hooks(chains["memory_evicted"])
 
         return frozenbot.FrozenBot(self.api, self.about, self.owner,
                                    self._hide_commands, self.before_help,
@@ -282,6 +314,19 @@ class Bot(frozenbot.FrozenBot):
                                    self._bot_id, self._shared_memory,
                                    self._update_processors, self.override_i18n)
 
+    @property
+    def shared_database(self):
+        """The database storing the shared memory, if any"""
+        return getattr(self._shared_memory.driver, "path", None)
+
+    @shared_database.setter
+    def shared_database(self, path):
+        """Store the shared memory in a database"""
+        if path is None:
+            self._shared_memory.switch_driver(shared.LocalDriver())
+        else:
+            self._shared_memory.switch_driver(shared.PersistentDriver(path))
+
     @property
     def lang(self):
         return self._lang
@@ -179,7 +179,7 @@ def process(bot, chains, update):
         bot.logger.debug("Processing update #%s with the hook %s" %
                          (update.update_id, hook.name))
 
-        result = hook.call(bot, update, name, data)
+        result = yield from hook.steps(bot, update, name, data)
         if result is True:
             bot.logger.debug("Update #%s was just processed by the %s hook" %
                              (update.update_id, hook.name))
@@ -48,6 +48,8 @@ class Component:
         self.__channel_post_hooks = []
         self.__channel_post_edited_hooks = []
         self.__poll_update_hooks = []
+        self.__memory_evicted_hooks = []
+        self.__memory_limits = None
 
         self._component_id = str(uuid.uuid4())
 
@@ -154,13 +156,25 @@ class Component:
         })
         self.__callbacks[name] = hook
 
-    def add_timer(self, interval, func):
+    def add_timer(self, interval, func, jitter=0, max_instances=1,
+                  overlap="skip"):
         """Register a new timer"""
         if not callable(func):
             raise ValueError("A timer must be callable")
 
         hook = hooks.TimerHook(func, self)
-        job = tasks.TimerTask(interval, hook)
+        job = tasks.TimerTask(interval, hook, jitter, max_instances, overlap)
+
+        self.__timers.append(job)
+
+    def add_cron(self, expression, func, jitter=0, max_instances=1,
+                 overlap="skip"):
+        """Register a new task executed following a cron expression"""
+        if not callable(func):
+            raise ValueError("A cron task must be callable")
+
+        hook = hooks.TimerHook(func, self)
+        job = tasks.CronTask(expression, hook, jitter, max_instances, overlap)
 
         self.__timers.append(job)
 
@@ -172,6 +186,29 @@ class Component:
         hook = hooks.MemoryPreparerHook(func, self)
         self.__memory_preparers.append(hook)
 
+    def add_memory_evicted_hook(self, func):
+        """Add a hook called when a key of the shared memory is evicted"""
+        if not callable(func):
+            raise ValueError("A memory evicted hook must be callable")
+
+        hook = hooks.MemoryEvictedHook(func, self)
+        self.__memory_evicted_hooks.append(hook)
+
+    def set_memory_limits(self, ttl=None, max_keys=None, eviction="lru"):
+        """Set the limits of the shared memory of this component"""
+        if ttl is not None and ttl <= 0:
+            raise ValueError("The TTL of the keys must be positive")
+        if max_keys is not None and max_keys < 1:
+            raise ValueError("The shared memory must allow at least one key")
+        if eviction not in ("lru", "lfu"):
+            raise ValueError("The eviction policy must be lru or lfu")
+
+        if ttl is None and max_keys is None:
+            self.__memory_limits = None
+        else:
+            self.__memory_limits = {"ttl": ttl, "max_keys": max_keys,
+                                    "eviction": eviction}
+
     @utils.deprecated("Component.add_shared_memory_initializer", "1.0",
                       "Rename the method to Component.add_memory_preparer")
     def add_shared_memory_initializer(self, func):
@@ -231,6 +268,7 @@ class Component:
             "messages": messages,
             "poll_updates": [self.__poll_update_hooks],
             "memory_preparers": [self.__memory_preparers],
+            "memory_evicted": [self.__memory_evicted_hooks],
             "tasks": [self.__timers],
             "chat_unavalable_hooks": [self.__chat_unavailable_hooks],
             "messages_edited": [self.__messages_edited_hooks],
@@ -242,6 +280,10 @@ class Component:
             ]],
         }
 
+    def _get_memory_limits(self):
+        """Get the limits of the shared memory of this component"""
+        return self.__memory_limits
+
     def _get_commands(self):
         """Get all the commands this component implements"""
         return self.__commands
@@ -18,11 +18,12 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
-import threading
+import contextvars
 
 
-_local = threading.local()
-_local._botogram_context = []
+# Context variables are local both to threads and asyncio tasks, so each of
+# them sees its own stack of contexts
+_botogram_context = contextvars.ContextVar("botogram_context", default=())
 
 
 class Context:
@@ -33,11 +34,14 @@ class Context:
         self.hook = hook
         self.update = update
 
+        self._tokens = []
+
     def __enter__(self):
-        _local._botogram_context.append(self)
+        stack = _botogram_context.get()
+        self._tokens.append(_botogram_context.set(stack + (self,)))
 
     def __exit__(self, *_):
-        _local._botogram_context.pop()
+        _botogram_context.reset(self._tokens.pop())
 
     def bot_username(self):
         """Get the username of the bot"""
@@ -55,5 +59,6 @@ class Context:
 
 def ctx():
     """Get the current context"""
-    if _local._botogram_context:
-        return _local._botogram_context[-1]
+    stack = _botogram_context.get()
+    if stack:
+        return stack[-1]
@@ -42,3 +42,21 @@ def help_message_for(func):
         func._botogram_help_message = help_func
         return help_func
     return decorator
+
+
+def priority(value):
+    """Set the priority of the updates processed by the decorated hook. Lower
+    values are processed first."""
+    def decorator(func):
+        func._botogram_priority = value
+        return func
+    return decorator
+
+
+def timeout(seconds):
+    """Stop the decorated hook if it's still running after the provided
+    number of seconds, when it's processed by the runner."""
+    def decorator(func):
+        func._botogram_timeout = seconds
+        return func
+    return decorator
@@ -18,11 +18,18 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import datetime
+import inspect
+import multiprocessing
+import time
+
 import logbook
 
 from . import utils
 from . import objects
 from . import api as api_module
+from . import context
+from .runner import jobs
 
 
 class FrozenBotError(Exception):
@@ -135,15 +142,28 @@ class FrozenBot:
         """Register a new callback"""
         raise FrozenBotError("Can't add callbacks to a bot at runtime")
 
-    def timer(self, interval):
+    def timer(self, interval, jitter=0, max_instances=1, overlap="skip"):
         """Register a new timer"""
         raise FrozenBotError("Can't add timers to a bot at runtime")
 
+    def cron(self, expression, jitter=0, max_instances=1, overlap="skip"):
+        """Register a new task executed following a cron expression"""
+        raise FrozenBotError("Can't add cron tasks to a bot at runtime")
+
     def prepare_memory(self, func):
         """Add a shared memory preparer"""
         raise FrozenBotError("Can't register a shared memory preparer to a "
                              "bot at runtime")
 
+    def memory_evicted(self, func):
+        """Add a memory evicted hook"""
+        raise FrozenBotError("Can't add hooks to a bot at runtime")
+
+    def set_memory_limits(self, ttl=None, max_keys=None, eviction="lru"):
+        """Set the limits of the shared memory of the bot"""
+        raise FrozenBotError("Can't change the shared memory of a bot at "
+                             "runtime")
+
     @utils.deprecated("@bot.init_shared_memory", "1.0", "Rename the decorator "
                       "to @bot.prepare_memory")
     def init_shared_memory(self, func):
@@ -200,15 +220,36 @@ class FrozenBot:
         if not isinstance(update, objects.Update):
             raise ValueError("Only Update objects are allowed")
 
+        return utils.drive(self._process_steps(update))
+
+    def _process_steps(self, update):
+        """Process an update object, yielding the coroutines it needs to wait
+        for"""
         update.set_api(self.api)  # Be sure to use the correct API object
 
+        # Keys evicted while processing the update are notified after it, even
+        # if the processing failed
+        try:
+            yield from self._process_update_steps(update)
+        except GeneratorExit:
+            raise
+        except BaseException:
+            yield from self._notify_evicted_steps()
+            raise
+        yield from self._notify_evicted_steps()
+
+    def _process_update_steps(self, update):
+        """Call the processor of the update"""
         try:
             for kind, processor in self._update_processors.items():
                 # Call the processor of the right kind
                 if getattr(update, kind) is None:
                     continue
 
-                processor(self, self._chains, update)
+                # Custom processors are normal functions
+                result = processor(self, self._chains, update)
+                if inspect.isgenerator(result):
+                    yield from result
                 break
         except api_module.ChatUnavailableError as e:
             # Do some sane logging
@@ -221,7 +262,28 @@ class FrozenBot:
             for hook in self._chains["chat_unavalable_hooks"]:
                 self.logger.debug("Executing %s for chat %s..." % (hook.name,
                                   e.chat_id))
-                hook.call(self, e.chat_id, e.reason)
+                yield from hook.steps(self, e.chat_id, e.reason)
+
+    def _notify_evicted_steps(self):
+        """Call the hooks of the keys evicted from the shared memory"""
+        for evicted in self._shared_memory.pop_evicted():
+            yield from self._memory_evicted_steps(*evicted)
+
+    def _memory_evicted(self, component, key, value, reason):
+        """Call the hooks which want to know about an evicted key"""
+        return utils.drive(self._memory_evicted_steps(component, key, value,
+                                                      reason))
+
+    def _memory_evicted_steps(self, component, key, value, reason):
+        """Call the hooks which want to know about an evicted key, yielding
+        the coroutines they need to wait for"""
+        for hook in self._chains["memory_evicted"]:
+            if hook.component_id != component:
+                continue
+
+            self.logger.debug("Executing %s for the %s key %r..." %
+                              (hook.name, reason, key))
+            yield from hook.steps(self, key, value, reason)
 
     def scheduled_tasks(self, current_time=None, wrap=True):
         """Return a list of tasks scheduled for now"""
@@ -237,6 +299,37 @@ class FrozenBot:
             return [wrapper(job) for job in tasks]
         return list(tasks)
 
+    def schedule_in(self, seconds, func, **kwargs):
+        """Process a function after the provided number of seconds"""
+        self.schedule_at(time.time() + seconds, func, **kwargs)
+
+    def schedule_at(self, when, func, **kwargs):
+        """Process a function at the provided time"""
+        if isinstance(when, datetime.datetime):
+            when = when.timestamp()
+
+        # Only the processes of the runner can talk with it
+        ipc = getattr(multiprocessing.current_process(), "ipc", None)
+        if ipc is None:
+            raise RuntimeError("Functions can be scheduled only while the "
+                               "bot is running in the runner")
+
+        # The function gets the shared memory of the component scheduling it
+        current = context.ctx()
+        if current is not None and current.hook is not None:
+            component = current.hook.component_id
+        else:
+            component = self._main_component_id
+
+        job = jobs.Job(self._bot_id, jobs.process_scheduled, {
+            "func": func,
+            "kwargs": kwargs,
+            "component": component,
+        }, getattr(func, "_botogram_priority", None),
+            getattr(func, "__qualname__", None), run_at=when,
+            timeout=getattr(func, "_botogram_timeout", None))
+        ipc.command("jobs.schedule", job)
+
     def register_update_processor(self, kind, processor):
         """Register a new update processor"""
         raise FrozenBotError("Can't register new update processors at runtime")
@@ -267,6 +360,11 @@ class FrozenBot:
 
     def _call(self, func, component=None, **available):
         """Wrapper for calling user-provided functions"""
+        return utils.drive(self._call_steps(func, component, **available))
+
+    def _call_steps(self, func, component=None, **available):
+        """Wrapper for calling user-provided functions, yielding the coroutine
+        it returns (if any) to wait for it"""
         # Set some default available arguments
         available.setdefault("bot", self)
 
@@ -278,7 +376,7 @@ class FrozenBot:
 
             available.setdefault("shared", utils.CallLazyArgument(lazy_shared))
 
-        return utils.call(func, **available)
+        return (yield from utils.call_steps(func, **available))
 
     # This function allows to use the old, deprecated bot.hide_commands
 
@@ -316,6 +414,12 @@ for _proxy in _proxied_sends:
     setattr(FrozenBot, _proxy.__name__, _wrapper)
 
 
+# Coroutine handlers can use these without blocking the event loop
+utils.add_async_variants(FrozenBot, [
+    "chat", "edit_message", "edit_caption", "schedule_in", "schedule_at",
+])
+
+
 def restore(*args):
     """Restore a FrozenBot instance from pickle"""
     return FrozenBot(*args)
@@ -19,6 +19,7 @@
 
 import re
 
+from . import utils
 from .callbacks import hashed_callback_name
 from .context import Context
 
@@ -52,18 +53,22 @@ class Hook:
         """Prepare the object"""
         pass
 
-    def call(self, bot, update):
+    def call(self, *args):
         """Call the hook"""
+        return utils.drive(self.steps(*args))
+
+    def steps(self, bot, update):
+        """Call the hook, yielding the coroutines it needs to wait for"""
         with Context(bot, self, update):
             if self._only_texts and update.message.text is None:
                 return
-            return self._call(bot, update)
+            return (yield from self._call(bot, update))
 
     def _call(self, bot, update):
         """*Actually* call the hook"""
         message = update.message
-        return bot._call(self.func, self.component_id, chat=message.chat,
-                         message=message)
+        return (yield from bot._call_steps(self.func, self.component_id,
+                                           chat=message.chat, message=message))
 
 
 def rebuild(cls, func, component, args):
@@ -85,7 +90,8 @@ class PollUpdateHook(Hook):
     """Underlying hook for @bot.poll_update"""
 
     def _call(self, bot, update):
-        return bot._call(self.func, self.component_id, poll=update.poll)
+        return (yield from bot._call_steps(self.func, self.component_id,
+                                           poll=update.poll))
 
 
 class MemoryPreparerHook(Hook):
@@ -95,6 +101,17 @@ class MemoryPreparerHook(Hook):
         return self.func(memory)
 
 
+class MemoryEvictedHook(Hook):
+    """Underlying hook for @bot.memory_evicted"""
+
+    def steps(self, bot, key, value, reason):
+        with Context(bot, self, None):
+            return (yield from bot._call_steps(
+                self.func, self.component_id, key=key, value=value,
+                reason=reason,
+            ))
+
+
 class NoCommandsHook(Hook):
     """Underlying hook for an internal event"""
     pass
@@ -124,8 +141,8 @@ class MessageEqualsHook(Hook):
 
         if text != self._string:
             return
-        return bot._call(self.func, self.component_id, chat=message.chat,
-                         message=message)
+        return (yield from bot._call_steps(self.func, self.component_id,
+                                           chat=message.chat, message=message))
 
 
 class MessageContainsHook(MessageEqualsHook):
@@ -142,8 +159,10 @@ class MessageContainsHook(MessageEqualsHook):
             if one != self._string:
                 continue
 
-            result = bot._call(self.func, self.component_id, chat=message.chat,
-                               message=message)
+            result = yield from bot._call_steps(
+                self.func, self.component_id, chat=message.chat,
+                message=message,
+            )
             res.append(result)
             if not self._args["multiple"]:
                 break
@@ -167,8 +186,9 @@ class MessageMatchesHook(Hook):
         for result in results:
             found = True
 
-            bot._call(self.func, self.component_id, chat=message.chat,
-                      message=message, matches=result.groups())
+            yield from bot._call_steps(self.func, self.component_id,
+                                       chat=message.chat, message=message,
+                                       matches=result.groups())
             if not self._args["multiple"]:
                 break
 
@@ -212,8 +232,9 @@ class CommandHook(Hook):
             return
 
         args = _command_args_split_re.split(text)[1:]
-        bot._call(self.func, self.component_id, chat=message.chat,
-                  message=message, args=args)
+        yield from bot._call_steps(self.func, self.component_id,
+                                   chat=message.chat, message=message,
+                                   args=args)
         return True
 
 
@@ -225,7 +246,7 @@ class CallbackHook(Hook):
             "%s:%s" % (self.component.component_name, args["name"])
         )
 
-    def call(self, bot, update, name, data):
+    def steps(self, bot, update, name, data):
         with Context(bot, self, update):
             if not update.callback_query:
                 return
@@ -234,7 +255,7 @@ class CallbackHook(Hook):
             if name != self._name:
                 return
 
-            bot._call(
+            yield from bot._call_steps(
                 self.func, self.component_id, query=q, chat=q.message.chat,
                 message=q.message, data=data,
             )
@@ -246,10 +267,10 @@ class CallbackHook(Hook):
 class ChatUnavailableHook(Hook):
     """Underlying hook for @bot.chat_unavailable"""
 
-    def call(self, bot, chat_id, reason):
+    def steps(self, bot, chat_id, reason):
         with Context(bot, self, None):
-            return bot._call(self.func, self.component_id, chat_id=chat_id,
-                             reason=reason)
+            return (yield from bot._call_steps(self.func, self.component_id,
+                                               chat_id=chat_id, reason=reason))
 
 
 class MessageEditedHook(Hook):
@@ -257,8 +278,8 @@ class MessageEditedHook(Hook):
 
     def _call(self, bot, update):
         message = update.edited_message
-        return bot._call(self.func, self.component_id, chat=message.chat,
-                         message=message)
+        return (yield from bot._call_steps(self.func, self.component_id,
+                                           chat=message.chat, message=message))
 
 
 class ChannelPostHook(Hook):
@@ -266,8 +287,8 @@ class ChannelPostHook(Hook):
 
     def _call(self, bot, update):
         message = update.channel_post
-        return bot._call(self.func, self.component_id, chat=message.chat,
-                         message=message)
+        return (yield from bot._call_steps(self.func, self.component_id,
+                                           chat=message.chat, message=message))
 
 
 class EditedChannelPostHook(Hook):
@@ -275,13 +296,13 @@ class EditedChannelPostHook(Hook):
 
     def _call(self, bot, update):
         message = update.edited_channel_post
-        return bot._call(self.func, self.component_id, chat=message.chat,
-                         message=message)
+        return (yield from bot._call_steps(self.func, self.component_id,
+                                           chat=message.chat, message=message))
 
 
 class TimerHook(Hook):
     """Underlying hook for a timer"""
 
-    def call(self, bot):
+    def steps(self, bot):
         with Context(bot, self, None):
-            return bot._call(self.func, self.component_id)
+            return (yield from bot._call_steps(self.func, self.component_id))
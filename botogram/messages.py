@@ -25,7 +25,7 @@ def process_message(bot, chains, update):
         bot.logger.debug("Processing update #%s with the hook %s..." %
                          (update.update_id, hook.name))
 
-        result = hook.call(bot, update)
+        result = yield from hook.steps(bot, update)
         if result is True:
             bot.logger.debug("Update #%s was just processed by the %s hook." %
                              (update.update_id, hook.name))
@@ -41,7 +41,7 @@ def process_edited_message(bot, chains, update):
         bot.logger.debug("Processing edited message in update #%s with the "
                          "hook %s..." % (update.update_id, hook.name))
 
-        result = hook.call(bot, update)
+        result = yield from hook.steps(bot, update)
         if result is True:
             bot.logger.debug("Update %s was just processed by the %s hook." %
                              (update.update_id, hook.name))
@@ -57,7 +57,7 @@ def process_channel_post(bot, chains, update):
         bot.logger.debug("Processing channel post in update #%s with the "
                          "hook %s..." % (update.update_id, hook.name))
 
-        result = hook.call(bot, update)
+        result = yield from hook.steps(bot, update)
         if result is True:
             bot.logger.debug("Update %s was just processed by the %s hook." %
                              (update.update_id, hook.name))
@@ -73,7 +73,7 @@ def process_channel_post_edited(bot, chains, update):
         bot.logger.debug("Processing edited channel post in update #%s with"
                          "the hook %s..." % (update.update_id, hook.name))
 
-        result = hook.call(bot, update)
+        result = yield from hook.steps(bot, update)
         if result is True:
             bot.logger.debug("Update %s was just processed by the %s hook." %
                              (update.update_id, hook.name))
@@ -89,7 +89,7 @@ def process_poll_update(bot, chains, update):
         bot.logger.debug("Processing poll update in update #%s with"
                          "the hook %s..." % (update.update_id, hook.name))
 
-        result = hook.call(bot, update)
+        result = yield from hook.steps(bot, update)
         if result is True:
             bot.logger.debug("Update %s was just processed by the %s hook." %
                              (update.update_id, hook.name))
@@ -19,6 +19,7 @@
 #   DEALINGS IN THE SOFTWARE.
 
 from .base import BaseObject
+from .. import utils
 from ..context import ctx
 from .messages import User, Message
 from .mixins import _require_api
@@ -104,3 +105,6 @@ class CallbackQuery(BaseObject):
             "callback_query_id": self.id,
             "cache_time": 0
         })
+
+
+utils.add_async_variants(CallbackQuery)
@@ -739,3 +739,9 @@ class SendAlbum(Album):
             utils.warn(1, "error_with_album",
                        "you should use `with` to use send_album\
                         -- check the documentation")
+
+
+# Coroutine handlers can use the *_async variants of the methods, which don't
+# block the event loop while waiting for Telegram
+for _mixin in ChatMixin, MessageMixin, FileMixin:
+    utils.add_async_variants(_mixin)
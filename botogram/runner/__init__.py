@@ -18,8 +18,11 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import gc
 import multiprocessing
-import multiprocessing.managers
+import multiprocessing.connection
+import os
+import socket
 import time
 import atexit
 import signal
@@ -29,54 +32,194 @@ from . import processes
 from . import shared
 from . import ipc
 from . import jobs
+from . import stats
+from . import backends
+from .. import shared as shared_module
+
+
+# Seconds between the checks of the jobs queue when autoscaling
+AUTOSCALE_INTERVAL = 1
 
 
 class BotogramRunner:
     """A multi-process, scalable bot runner"""
 
-    def __init__(self, *bots, workers=2):
+    def __init__(self, *bots, workers=2, threads_per_worker=None,
+                 async_workers=False, jobs_per_worker=1000,
+                 max_workers=None, autoscale_queue=10,
+                 autoscale_wait=1, autoscale_cooldown=60, max_job_attempts=3,
+                 worker_max_jobs=None, worker_max_memory=None,
+                 priorities=None, starvation_timeout=10,
+                 max_queued_jobs=1000, stats_address=None, hub_address=None,
+                 hub_auth_key=None, jobs_database=None, shutdown_timeout=None,
+                 handover=False, preload=False, job_timeout=None,
+                 shared_cache=False):
         # Only frozen instances, thanks
         self._bots = {bot._bot_id: bot.freeze() for bot in bots}
 
         self._updater_processes = {}
-        self._worker_processes = []
+        self._worker_processes = {}
+        self._next_worker_id = 0
         self._ipc_process = None
         self.ipc = None
 
         self.running = False
         self._stop = False
         self._started_at = None
-        self._last_scheduled_checks = -1
+
+        # Writing to this socket pair wakes up the main loop
+        self._wakeup_read = None
+        self._wakeup_write = None
 
         # Start the IPC server
-        self._ipc_server = ipc.IPCServer()
-        self.ipc_port = self._ipc_server.port
-        self.ipc_auth_key = self._ipc_server.auth_key
-        self._ipc_stop_key = self._ipc_server.stop_key
+        self._setup_ipc(hub_address, hub_auth_key)
 
-        # Use the MultiprocessingDriver for all the shared memories
+        # Use the MultiprocessingDriver for all the shared memories, which are
+        # stored by the IPC process in the database of the bots (if any)
+        databases = set()
         for bot in self._bots.values():
-            bot._shared_memory.switch_driver(shared.MultiprocessingDriver())
+            driver = bot._shared_memory.driver
+            if isinstance(driver, shared_module.PersistentDriver):
+                databases.add(driver.path)
+
+            bot._shared_memory.switch_driver(
+                shared.MultiprocessingDriver(shared_cache),
+            )
+
+        if len(databases) > 1:
+            raise ValueError("All the bots run together must store the shared "
+                             "memory in the same database")
+        self._shared_store = None
+        if databases:
+            self._shared_store = shared_module.SQLiteStore(databases.pop())
+
+        # Threads of async workers run the normal functions and the calls to
+        # the Telegram API of all the jobs processed at once, so a lot more of
+        # them are needed by default
+        if threads_per_worker is None:
+            threads_per_worker = 64 if async_workers else 1
+        if threads_per_worker < 1:
+            raise ValueError("Each worker needs at least one thread")
+        if jobs_per_worker < 1:
+            raise ValueError("Each worker must process at least one job")
 
         self._workers_count = workers
+        self._threads_per_worker = threads_per_worker
+        self._async_workers = async_workers
+        self._jobs_per_worker = jobs_per_worker
+
+        # Each worker processes a job at once in each of its slots
+        self._slots_per_worker = threads_per_worker
+        if async_workers:
+            self._slots_per_worker = jobs_per_worker
+
+        # Autoscaling is enabled only if more workers than the minimum ones
+        # are allowed to run
+        if max_workers is not None and max_workers < workers:
+            raise ValueError("max_workers can't be lower than workers")
+        self._max_workers = max_workers
+        self._autoscale_queue = autoscale_queue
+        self._autoscale_wait = autoscale_wait
+        self._autoscale_cooldown = autoscale_cooldown
+        self._last_autoscale_check = -1
+        self._idle_since = None
+        self._retiring = set()
+
+        # Options for the supervision of the workers
+        self._max_job_attempts = max_job_attempts
+        self._worker_max_jobs = worker_max_jobs
+        self._worker_max_memory = worker_max_memory
+        self._restarts = []
+
+        # Workers stuck on a job for longer than its timeout are killed when
+        # the IPC process tells the runner to do so
+        self._job_timeout = job_timeout
+        self._to_kill = []
+        self._killed = set()
+
+        # Workers can be forked from the runner after the bots are loaded, so
+        # they share the memory holding them
+        self._fork_context = None
+        if preload:
+            if "fork" not in multiprocessing.get_all_start_methods():
+                raise ValueError("Preloading the bots requires the fork start "
+                                 "method, which isn't available here")
+            self._fork_context = multiprocessing.get_context("fork")
+
+        # Lower priorities are processed first, with the provided ones
+        # replacing the default ones
+        self._priorities = dict(jobs.DEFAULT_PRIORITIES)
+        if priorities is not None:
+            self._priorities.update(priorities)
+        self._starvation_timeout = starvation_timeout
+
+        # The updaters wait before fetching new updates if there are too many
+        # jobs in the queue
+        self._max_queued_jobs = max_queued_jobs
+
+        # Jobs are stored on disk only if a database is provided
+        if jobs_database is not None:
+            self._jobs_backend = backends.SQLiteBackend(jobs_database)
+        else:
+            self._jobs_backend = backends.MemoryBackend()
+
+        # Options for stopping and starting the runner
+        self._shutdown_timeout = shutdown_timeout
+        self._handover = handover
+
+        # The statistics are served over HTTP only if an address is provided
+        if stats_address is not None:
+            stats_address = tuple(stats_address)
+        self._stats_address = stats_address
+        self._stats_server = None
 
         self.logger = logbook.Logger("botogram runner")
 
+    def _setup_ipc(self, address, auth_key):
+        """Setup the IPC server"""
+        # Remote workers can connect to the IPC server only if it listens on
+        # an address they can reach, so it's the hub of the runner
+        if address is not None:
+            address = tuple(address)
+            if auth_key is None:
+                raise ValueError("An authentication key is required for the "
+                                 "remote workers to connect to the hub")
+        self._hub_address = address
+
+        self._ipc_server = ipc.IPCServer(address, auth_key)
+        self.ipc_host = _connectable_host(self._ipc_server.host)
+        self.ipc_port = self._ipc_server.port
+        self.ipc_auth_key = self._ipc_server.auth_key
+        self._ipc_stop_key = self._ipc_server.stop_key
+
+    @property
+    def _ipc_info(self):
+        """Get the information needed to connect to the IPC server"""
+        return self.ipc_port, self.ipc_auth_key, self.ipc_host
+
     def run(self):
         """Run the runner"""
         if self.running:
             raise RuntimeError("Server already running")
 
         self.logger.debug("Booting up the botogram runner...")
-        self.logger.debug("IPC address: 127.0.0.1:%s" % self.ipc_port)
+        self.logger.debug("IPC address: %s:%s" % (self.ipc_host,
+                                                  self.ipc_port))
         self.logger.debug("IPC auth key: %s" % self.ipc_auth_key)
 
         self.running = True
         self._started_at = time.time()
 
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_write.setblocking(False)
+
         self._enable_signals()
         to_updaters = self._boot_processes()
 
+        if self._stats_address is not None:
+            self._stats_server = stats.StatsServer(self, self._stats_address)
+            self._stats_server.start()
+
         self.logger.info("Your bot is now running!")
         self.logger.info("Press Ctrl+C to exit.")
 
@@ -84,95 +227,399 @@ class BotogramRunner:
             # Main server loop
             while not self._stop:
                 self._loop()
-                time.sleep(0.1)
+                self._wait(self._sleep_time())
         except (KeyboardInterrupt, InterruptedError):
             pass
 
-        self._shutdown_processes(to_updaters)
+        report = self._shutdown_processes(to_updaters)
+
+        self._wakeup_read.close()
+        self._wakeup_write.close()
+        self._wakeup_read = self._wakeup_write = None
 
         self.running = False
         self._started_at = None
-        self._last_scheduled_checks = -1
+
+        return report
 
     def _loop(self):
         """The main loop"""
         # Check for scheduled tasks
-        now = int(time.time())
-        if now > self._last_scheduled_checks:
-            self._last_scheduled_checks = now
-
-            jobs_list = []
-            for bot in self._bots.values():
-                for task in bot.scheduled_tasks(current_time=now, wrap=False):
-                    jobs_list.append(jobs.Job(bot._bot_id, jobs.process_task, {
-                        "task": task,
-                    }))
-            # Don't put jobs into the queue if there are no jobs
-            if jobs_list:
-                self.ipc.command("jobs.bulk_put", jobs_list)
+        now = time.time()
+        jobs_list = []
+        for bot in self._bots.values():
+            for task in bot.scheduled_tasks(current_time=now, wrap=False):
+                name, priority, timeout = jobs.describe_task(
+                    task, self._priorities,
+                )
+                jobs_list.append(jobs.Job(
+                    bot._bot_id, jobs.process_task, {"task": task}, priority,
+                    name, instances_key=(
+                        bot._bot_id, bot._scheduler.task_key(task),
+                    ),
+                    max_instances=task.max_instances, overlap=task.overlap,
+                    timeout=timeout,
+                ))
+        # Don't put jobs into the queue if there are no jobs
+        # The runner can't wait for the queue to have space for them
+        if jobs_list:
+            self.ipc.command("jobs.bulk_put_nowait", jobs_list)
+
+        self._supervise()
+
+        if self._max_workers is not None:
+            self._autoscale()
+
+    def _wakeups(self, now):
+        """Return when the main loop needs to run again"""
+        result = list(self._restarts)
+        if self._max_workers is not None:
+            result.append(self._last_autoscale_check + AUTOSCALE_INTERVAL)
+
+        for bot in self._bots.values():
+            next_run = bot._scheduler.next_run(now)
+            if next_run is not None:
+                result.append(next_run)
+        return result
+
+    def _sleep_time(self):
+        """Return how long the main loop can sleep (None for forever)"""
+        now = time.time()
+        wakeups = self._wakeups(now)
+        if not wakeups:
+            return None
+        return max(min(wakeups) - now, 0)
+
+    def _wait(self, timeout, sentinels=None):
+        """Wait until a worker stops, the runner is stopped or the timeout
+        expires"""
+        if sentinels is None:
+            sentinels = [worker.sentinel for worker
+                         in self._worker_processes.values()]
+        ready = multiprocessing.connection.wait(
+            [self._wakeup_read] + sentinels, timeout,
+        )
+
+        if self._wakeup_read in ready:
+            try:
+                self._wakeup_read.recv(4096)
+            except OSError:
+                pass
+
+    def _watch_kills(self, after=0):
+        """Wait for the IPC process to request killing some workers"""
+        try:
+            self.ipc.send("jobs.wait_kills", after).add_done_callback(
+                self._kills_received,
+            )
+        except ipc.IPCServerCrashedError:
+            pass
+
+    def _kills_received(self, future):
+        """Kill the workers whose jobs timed out"""
+        if future.exception() is not None:
+            return
+
+        count, kills = future.result()
+        self._to_kill.extend(kills)
+        self._watch_kills(count)
+
+        # The workers are killed by the main loop
+        try:
+            self._wakeup_write.send(b"\0")
+        except (AttributeError, OSError):
+            pass
+
+    def _kill_timed_out(self):
+        """Kill the workers the IPC process asked to kill"""
+        while self._to_kill:
+            worker_id = self._to_kill.pop()
+            worker = self._worker_processes.get(worker_id)
+            if worker is not None and worker_id not in self._killed:
+                worker.kill()
+                self._killed.add(worker_id)
+
+    def _join_worker(self, worker, deadline=None):
+        """Wait for a worker to stop, killing it if one of its jobs times
+        out"""
+        while worker.is_alive():
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    return
+
+            self._wait(timeout, [worker.sentinel])
+            self._kill_timed_out()
+        worker.join()
+
+    def _supervise(self):
+        """Replace the workers which stopped"""
+        self._kill_timed_out()
+
+        now = time.time()
+        for worker_id, worker in list(self._worker_processes.items()):
+            if worker.is_alive():
+                continue
+
+            worker.join()
+            del self._worker_processes[worker_id]
+
+            retired = worker_id in self._retiring
+            if retired:
+                self._retiring.remove(worker_id)
+                self.logger.debug("Worker #%s retired" % worker_id)
+            elif worker_id in self._killed:
+                self._killed.remove(worker_id)
+                self.logger.warning("Worker #%s was killed, since one of its "
+                                    "jobs timed out" % worker_id)
+            elif worker.exitcode == 0:
+                self.logger.debug("Worker #%s recycled" % worker_id)
+            else:
+                self.logger.error("Worker #%s died unexpectedly (exit code "
+                                  "%s)" % (worker_id, worker.exitcode))
+
+            # Redeliver the jobs the worker was processing when it stopped
+            result = self.ipc.command("jobs.worker_died", worker_id)
+            if result["requeued"]:
+                self.logger.warning("%s jobs processed by worker #%s will be "
+                                    "processed again" % (result["requeued"],
+                                                         worker_id))
+            if result["dropped"]:
+                self.logger.error("%s jobs were dropped, since they crashed "
+                                  "%s workers in a row" % (
+                                      result["dropped"],
+                                      self._max_job_attempts,
+                                  ))
+
+            # Retired workers shouldn't be replaced
+            if retired:
+                continue
+
+            # Workers crashing right after they started are replaced slowly,
+            # to avoid spawning processes in a loop
+            if now - worker.started_at < 1:
+                self._restarts.append(now + 1)
+            else:
+                self._restarts.append(now)
+
+        for restart_at in self._restarts[:]:
+            if restart_at <= now:
+                self._restarts.remove(restart_at)
+                self._start_worker()
+
+    def _autoscale(self):
+        """Start or stop workers based on the status of the jobs queue"""
+        now = time.time()
+        if now - self._last_autoscale_check < AUTOSCALE_INTERVAL:
+            return
+        self._last_autoscale_check = now
+
+        status = self.ipc.command("jobs.status", None)
+        active = [worker_id for worker_id in self._worker_processes
+                  if worker_id not in self._retiring]
+        active_count = len(active) + len(self._restarts)
+
+        # Start a new worker if the jobs are waiting for too long in the queue
+        overloaded = status["queued"] >= self._autoscale_queue or \
+            status["oldest"] >= self._autoscale_wait
+        if overloaded:
+            self._idle_since = None
+            if active_count < self._max_workers:
+                worker_id = self._start_worker()
+                self.logger.debug("Jobs queue overloaded, started worker "
+                                  "#%s" % worker_id)
+            return
+
+        # A worker is idle if all of its slots are waiting for jobs
+        slots = self._slots_per_worker
+        idle = [worker_id for worker_id in active
+                if status["waiting"].get(worker_id, 0) >= slots]
+        if status["queued"] or not idle or \
+           active_count <= self._workers_count:
+            self._idle_since = None
+            return
+
+        # Retire idle workers only after they were idle for a while, to avoid
+        # stopping and starting them continuously
+        if self._idle_since is None:
+            self._idle_since = now
+        elif now - self._idle_since >= self._autoscale_cooldown:
+            self._idle_since = None
+
+            self.ipc.command("jobs.retire", idle[-1])
+            self._retiring.add(idle[-1])
+            self.logger.debug("Retiring idle worker #%s" % idle[-1])
+
+    def stats(self):
+        """Get the statistics of the running runner"""
+        if not self.running:
+            raise RuntimeError("The runner isn't running")
+
+        result = self.ipc.command("stats.get", None)
+
+        # The IPC server doesn't know anything about the processes
+        now = time.time()
+        for worker_id, worker in list(self._worker_processes.items()):
+            info = result["workers"].setdefault(worker_id, {
+                "idle": 0, "busy": [], "retiring": False,
+            })
+            info["pid"] = worker.pid
+            info["uptime"] = now - worker.started_at
+        for bot_id, updater in list(self._updater_processes.items()):
+            result["updates"].setdefault(bot_id, {})["pid"] = updater.pid
+
+        result["uptime"] = now - self._started_at
+        return result
 
     def stop(self, *__):
         """Stop a running runner"""
         self._stop = True
 
+        # This works from signal handlers and other threads too
+        if self._wakeup_write is not None:
+            try:
+                self._wakeup_write.send(b"\0")
+            except OSError:
+                pass
+
     def _boot_processes(self):
         """Start all the used processes"""
-        upd_commands = multiprocessing.Queue()
+        updaters_stop = multiprocessing.Event()
 
         # Boot up the IPC process
-        ipc_process = processes.IPCProcess(None, self._ipc_server)
+        ipc_process = processes.IPCProcess(None, self._ipc_server,
+                                           self._max_job_attempts,
+                                           self._starvation_timeout,
+                                           self._max_queued_jobs,
+                                           self._bots,
+                                           self._jobs_backend,
+                                           self._priorities,
+                                           self._job_timeout,
+                                           self._shared_store)
         ipc_process.start()
         self._ipc_process = ipc_process
 
         # And boot the client
         # This will wait until the IPC server is started
-        ipc_info = (self.ipc_port, self.ipc_auth_key)
+        ipc_info = self._ipc_info
         while True:
             try:
                 self.ipc = ipc.IPCClient(*ipc_info)
                 break
             except ConnectionRefusedError:
                 time.sleep(0.1)
+        self._watch_kills()
 
         # Boot up all the worker processes
         for i in range(self._workers_count):
-            worker = processes.WorkerProcess(ipc_info, self._bots)
-            worker.start()
-
-            self._worker_processes.append(worker)
+            self._start_worker()
 
         # Boot up all the updater processes
         for bot in self._bots.values():
-            updater = processes.UpdaterProcess(ipc_info, bot, upd_commands)
+            updater = processes.UpdaterProcess(ipc_info, bot, updaters_stop,
+                                               self._priorities,
+                                               self._handover)
             updater.start()
 
-            self._updater_processes[id] = updater
-
-        return upd_commands
+            self._updater_processes[bot._bot_id] = updater
+
+        return updaters_stop
+
+    def _start_worker(self):
+        """Start a new worker process"""
+        worker_id = self._new_worker_id()
+        worker = processes.WorkerProcess(
+            self._ipc_info, worker_id, self._bots, self._threads_per_worker,
+            self._async_workers, max_jobs=self._worker_max_jobs,
+            max_memory=self._worker_max_memory,
+            async_jobs=self._jobs_per_worker,
+        )
+        if self._fork_context is not None:
+            # The garbage collector doesn't touch the objects created until
+            # now anymore, so the memory pages holding them stay shared
+            gc.collect()
+            gc.freeze()
+            worker.use_context(self._fork_context)
+        worker.start()
+        worker.started_at = time.time()
+
+        self._worker_processes[worker_id] = worker
+        return worker_id
+
+    def _new_worker_id(self):
+        """Get the ID of a new worker"""
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        return worker_id
 
     def _shutdown_processes(self, to_updaters):
         """Shutdown all the opened processes"""
         self.logger.info("Shutting down the runner...")
 
+        if self._stats_server is not None:
+            self._stats_server.stop()
+            self._stats_server = None
+
         # Shutdown updaters before, and after the workers
         # This way no update will be lost
-        for i in range(len(self._updater_processes)):
-            to_updaters.put("stop")
+        to_updaters.set()
+        # Updaters waiting for space in the queue must be able to stop
+        self.ipc.command("jobs.release", None)
         for process in self._updater_processes.values():
             process.join()
-        self._updaters_processes = {}
+        self._updater_processes = {}
 
         # Here, we tell each worker to shut down, and then we join it
         self.ipc.command("jobs.shutdown", None)
-        for worker in self._worker_processes:
-            worker.join()
-        self._worker_processes = []
+        deadline = None
+        if self._shutdown_timeout is not None:
+            deadline = time.time() + self._shutdown_timeout
+        for worker in self._worker_processes.values():
+            self._join_worker(worker, deadline)
+
+        # Workers still processing jobs after the deadline are killed
+        for worker in self._worker_processes.values():
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+        self._worker_processes = {}
+        self._retiring = set()
+        self._restarts = []
+        self._killed = set()
+
+        report = self._shutdown_report()
 
         # And finally we stop the IPC process
         self.ipc.command("__stop__", self._ipc_stop_key)
         self._ipc_process.join()
+        self.ipc.close()
         self.ipc = None
 
+        return report
+
+    def _shutdown_report(self):
+        """Report which jobs weren't completed before shutting down"""
+        report = self.ipc.command("jobs.abort", None)
+        report["stored"] = self._jobs_backend.durable
+
+        count = len(report["queued"]) + len(report["interrupted"]) + \
+            len(report["delayed"])
+        if not count:
+            self.logger.info("All the jobs were completed")
+        elif report["stored"]:
+            self.logger.warning("%s jobs weren't completed, and they will be "
+                                "processed after a restart" % count)
+        else:
+            self.logger.warning("%s jobs weren't completed (%s interrupted, "
+                                "%s still in the queue and %s scheduled for "
+                                "later)" % (
+                                    count, len(report["interrupted"]),
+                                    len(report["queued"]),
+                                    len(report["delayed"]),
+                                ))
+        return report
+
     def _enable_signals(self):
         """Setup signals handlers"""
         atexit.register(self.stop)
@@ -182,7 +629,134 @@ class BotogramRunner:
             signal.signal(one, self.stop)
 
 
+class WorkersRunner(BotogramRunner):
+    """A runner with only the workers, processing the jobs of a remote hub"""
+
+    def __init__(self, hub_address, auth_key, workers=2,
+                 threads_per_worker=None, async_workers=False,
+                 jobs_per_worker=1000, max_workers=None, autoscale_queue=10,
+                 autoscale_wait=1,
+                 autoscale_cooldown=60, worker_max_jobs=None,
+                 worker_max_memory=None, preload=False):
+        super(WorkersRunner, self).__init__(
+            workers=workers, threads_per_worker=threads_per_worker,
+            async_workers=async_workers, jobs_per_worker=jobs_per_worker,
+            max_workers=max_workers,
+            autoscale_queue=autoscale_queue, autoscale_wait=autoscale_wait,
+            autoscale_cooldown=autoscale_cooldown,
+            worker_max_jobs=worker_max_jobs,
+            worker_max_memory=worker_max_memory,
+            hub_address=hub_address, hub_auth_key=auth_key, preload=preload,
+        )
+
+        # Worker IDs must be unique across all the machines
+        self._workers_prefix = "%s-%s" % (socket.gethostname(), os.getpid())
+
+    def _setup_ipc(self, address, auth_key):
+        # The IPC server is the one of the hub
+        self._hub_address = tuple(address)
+        self._ipc_server = None
+        self.ipc_host, self.ipc_port = self._hub_address
+        self.ipc_auth_key = auth_key
+        self._ipc_stop_key = None
+
+    def _boot_processes(self):
+        self.ipc = ipc.IPCClient(*self._ipc_info)
+
+        # The bots are loaded from the hub, so they're exactly the same
+        self._bots = self.ipc.command("bots.get", None)
+
+        # The hub replies to this when it's shutting down, and the request
+        # fails if the hub crashes
+        self.ipc.send("jobs.wait_shutdown", None).add_done_callback(
+            self._hub_stopped,
+        )
+        self._watch_kills()
+
+        for i in range(self._workers_count):
+            self._start_worker()
+
+    def _start_worker(self):
+        try:
+            return super(WorkersRunner, self)._start_worker()
+        except (OSError, ipc.IPCError):
+            # The hub is gone, and the loop is going to notice that
+            pass
+
+    def _new_worker_id(self):
+        worker_id = super(WorkersRunner, self)._new_worker_id()
+        return "%s-%s" % (self._workers_prefix, worker_id)
+
+    def _loop(self):
+        try:
+            self._supervise()
+            if self._max_workers is not None:
+                self._autoscale()
+        except ipc.IPCServerCrashedError:
+            # The failed request to the hub might have noticed it first
+            if not self._stop:
+                self.logger.info("The hub stopped")
+                self._stop = True
+
+    def _hub_stopped(self, future):
+        """Stop the workers when the hub is stopping"""
+        if self._stop:
+            return
+
+        if future.exception() is None:
+            self.logger.info("The hub is shutting down")
+        else:
+            self.logger.info("The hub stopped")
+        self.stop()
+
+    def _wakeups(self, now):
+        # The tasks of the bots are scheduled by the hub
+        result = list(self._restarts)
+        if self._max_workers is not None:
+            result.append(self._last_autoscale_check + AUTOSCALE_INTERVAL)
+        return result
+
+    def _shutdown_processes(self, _):
+        self.logger.info("Shutting down the workers...")
+
+        # Let the workers finish the jobs they're processing
+        try:
+            for worker_id in self._worker_processes:
+                self.ipc.command("jobs.retire", worker_id)
+        except ipc.IPCServerCrashedError:
+            # The workers are going to stop by themselves
+            pass
+
+        for worker_id, worker in self._worker_processes.items():
+            self._join_worker(worker)
+            try:
+                self.ipc.command("jobs.worker_died", worker_id)
+            except ipc.IPCServerCrashedError:
+                pass
+        self._worker_processes = {}
+        self._retiring = set()
+        self._restarts = []
+        self._killed = set()
+
+        self.ipc.close()
+        self.ipc = None
+
+
+def _connectable_host(host):
+    """Get the host to connect to for a server bound to the provided one"""
+    # Servers listening on all the interfaces are reachable from localhost
+    if host in ("", "0.0.0.0"):
+        return "localhost"
+    return host
+
+
 def run(*bots, **options):
     """Run multiple bots at once"""
     runner = BotogramRunner(*bots, **options)
+    return runner.run()
+
+
+def run_workers(hub_address, auth_key, **options):
+    """Run workers processing the jobs of a runner on another machine"""
+    runner = WorkersRunner(hub_address, auth_key, **options)
     runner.run()
@@ -0,0 +1,139 @@
+# Copyright (c) 2015-2019 The Botogram Authors (see AUTHORS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import itertools
+import pickle
+import sqlite3
+
+import logbook
+
+
+class MemoryBackend:
+    """Keep the jobs only in memory"""
+
+    # Jobs are lost when the runner stops, so the queue must be drained
+    durable = False
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def open(self, bots):
+        """Prepare the backend to be used with the provided bots"""
+        pass
+
+    def add(self, jobs):
+        """Store new jobs, assigning them an ID"""
+        for job in jobs:
+            job.id = next(self._ids)
+
+    def ack(self, job):
+        """Forget about a job which was completed"""
+        pass
+
+    def load(self):
+        """Get the jobs which weren't completed when the runner stopped"""
+        return []
+
+    def close(self):
+        """Close the backend"""
+        pass
+
+
+class SQLiteBackend(MemoryBackend):
+    """Store the jobs in a SQLite database until they're completed"""
+
+    durable = True
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = logbook.Logger("botogram runner")
+
+        self._conn = None
+        self._bot_keys = {}
+        self._bot_ids = {}
+
+    def open(self, bots):
+        # Bot IDs change every time the bots are loaded, so jobs are stored
+        # with a key which is the same after a restart
+        for bot_id, bot in bots.items():
+            key = _bot_key(bot)
+            self._bot_keys[bot_id] = key
+            self._bot_ids[key] = bot_id
+
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                           "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "bot TEXT NOT NULL, "
+                           "data BLOB NOT NULL)")
+        self._conn.commit()
+
+    def add(self, jobs):
+        with self._conn:
+            for job in jobs:
+                cursor = self._conn.execute(
+                    "INSERT INTO jobs (bot, data) VALUES (?, ?)",
+                    (self._bot_keys[job.bot_id], pickle.dumps(job)),
+                )
+                job.id = cursor.lastrowid
+
+    def ack(self, job):
+        with self._conn:
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+
+    def load(self):
+        result = []
+        skipped = 0
+        for job_id, key, data in self._conn.execute(
+            "SELECT id, bot, data FROM jobs ORDER BY id"
+        ):
+            # Jobs of bots not running anymore are kept for later
+            if key not in self._bot_ids:
+                skipped += 1
+                continue
+
+            job = pickle.loads(data)
+            job.id = job_id
+
+            # The instances of timers are limited by a key including the bot
+            # ID, so that's updated too
+            bot_id = self._bot_ids[key]
+            if job.instances_key is not None and \
+               job.instances_key[0] == job.bot_id:
+                job.instances_key = (bot_id,) + tuple(job.instances_key[1:])
+            job.bot_id = bot_id
+            result.append(job)
+
+        if skipped:
+            self.logger.warning("%s stored jobs belong to bots which aren't "
+                                "running, so they were ignored" % skipped)
+        return result
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def _bot_key(bot):
+    """Get a key identifying a bot, which doesn't change after restarts"""
+    return hashlib.sha256(bot.api.token.encode("utf-8")).hexdigest()
@@ -18,19 +18,26 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import asyncio
+import hmac
+import itertools
 import os
-import select
+import selectors
 import socket
 import random
 import struct
 import pickle
 import hashlib
+import threading
 
 import logbook
 
 
 PACKET_LENGTH_SECTION_SIZE = 4
-READ_MAX_CHUNK = 4096
+PACKET_LENGTH_FORMAT = "!I"
+AUTH_KEY_MAX_SIZE = 1024
+READ_CHUNK_SIZE = 65536
+SHUTDOWN_SEND_TIMEOUT = 1
 PORTS_RANGE = 49152, 65535
 MAX_CONNECT_TRIES = 20
 
@@ -46,16 +53,35 @@ class IPCServerCrashedError(IPCError):
 class IPCServer:
     """Main server for the IPC"""
 
-    def __init__(self):
+    def __init__(self, address=None, auth_key=None):
         self.logger = logbook.Logger("botogram IPC server")
 
         self.commands = {}
+        self.timers = []
 
-        self.auth_key = hashlib.sha1(os.urandom(64)).hexdigest()
+        if auth_key is None:
+            auth_key = hashlib.sha1(os.urandom(64)).hexdigest()
+        self.auth_key = auth_key
         self.stop_key = hashlib.sha1(os.urandom(64)).hexdigest()
 
         self.stop = False
-        self.port, self.conn = self._get_connection()
+        self._selector = None
+        if address is None:
+            self.host = "localhost"
+            self.port, self.conn = self._get_connection()
+        else:
+            self.host, self.port, self.conn = self._bind(address)
+
+    def _bind(self, address):
+        """Create a new server connection bound to a specific address"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(5)
+
+        # The port might be chosen by the OS
+        host, port = sock.getsockname()[:2]
+        return host, port, sock
 
     def _get_connection(self):
         """Create a new server connection"""
@@ -81,6 +107,7 @@ class IPCServer:
                 count += 1
                 continue
 
+            sock.listen(5)
             return port, sock
 
         # If the code reaches this state, no free port was found
@@ -93,107 +120,134 @@ class IPCServer:
 
         self.commands[name] = func
 
+    def register_timer(self, func):
+        """Register a function called after each request, which returns in
+        how many seconds it should be called again (or None)"""
+        self.timers.append(func)
+
+    def _run_timers(self):
+        """Run all the timers, returning when they should run again"""
+        timeout = None
+        for func in self.timers:
+            result = func()
+            if result is not None and (timeout is None or result < timeout):
+                timeout = result
+        return timeout
+
     def run(self):
         """Run the IPC server"""
-        read_from = [self.conn]
-        needs_authentication = []
+        # The connections are kept if a command crashes and this is called
+        # again by the IPC process
+        if self._selector is None:
+            self._selector = selectors.DefaultSelector()
+            self.conn.setblocking(False)
+            self._selector.register(self.conn, selectors.EVENT_READ)
 
-        self.conn.listen(5)
         while not self.stop:
+            timeout = self._run_timers()
+
+            for key, events in self._selector.select(timeout):
+                # The server socket is registered without a connection
+                if key.data is None:
+                    self._accept()
+                    continue
+
+                connection = key.data
+                if events & selectors.EVENT_WRITE:
+                    connection.flush()
+                if events & selectors.EVENT_READ:
+                    for packet in connection.read():
+                        if connection.closed:
+                            break
+                        self._process_packet(connection, packet)
+                        if self.stop:
+                            break
+
+                if self.stop:
+                    break
+
+        # Gracefully close all the connections, sending the last responses
+        for key in list(self._selector.get_map().values()):
+            if key.data is not None:
+                key.data.drain(SHUTDOWN_SEND_TIMEOUT)
+                key.data.close()
+        self._selector.close()
+        self._selector = None
+        self.conn.close()
 
-            # This is needed because sometimes the system call stops when
-            # sending to the process the interruption signal
-            # In this case, we'll just call the system call again
+    def _accept(self):
+        """Accept all the new connections"""
+        while True:
             try:
-                readable, *_ = select.select(read_from, [], [])
-            except InterruptedError:
-                continue
+                sock, addr = self.conn.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+
+            _setup_socket(sock)
+            sock.setblocking(False)
+            connection = IPCConnection(sock, self._selector)
+            self._selector.register(sock, selectors.EVENT_READ, connection)
+
+            self.logger.debug("New IPC connection from %s:%s" % addr[:2])
+
+    def _process_packet(self, connection, packet):
+        """Process a packet received from a connection"""
+        # If the connection isn't authenticated, check auth code
+        # This is done before unpickling anything, since unpickling data from
+        # untrusted clients isn't safe
+        if not connection.authenticated:
+            if not hmac.compare_digest(
+                bytes(packet), self.auth_key.encode("utf-8"),
+            ):
+                _write_response(connection, {
+                    "ok": False,
+                    "data": "Authentication failed",
+                })
+                connection.close(flush=True)
+                return
+
+            connection.authenticated = True
+            _write_response(connection, {"ok": True, "data": "Welcome!"})
+            return
 
-            for conn in readable:
-                # If the connection we can read is the server one, accept the
-                # new connection and add it to the read_from list
-                if conn is self.conn:
-                    new_conn, addr = conn.accept()
-                    needs_authentication.append(new_conn)
-                    read_from.append(new_conn)
+        request = pickle.loads(packet)
+
+        # __stop__ will stop the IPC server
+        if request["command"] == "__stop__":
+            # Allow only matching stop keys
+            if request["data"] != self.stop_key:
+                _write_response(connection, {
+                    "id": request["id"],
+                    "ok": False,
+                    "data": "Wrong stop key",
+                })
+                return
+
+            self.stop = True
+            _write_response(connection, {
+                "id": request["id"],
+                "ok": True,
+                "data": "Bye!",
+            })
+            return
 
-                    self.logger.debug("New IPC connection from %s:%s" % addr)
-                else:
-                    try:
-                        request = read_packet(conn)
-                    # If the socket is broken, remove the connection
-                    except EOFError:
-                        read_from.remove(conn)
-                        try:
-                            conn.shutdown(socket.SHUT_RDWR)
-                        except OSError:
-                            pass
-                        conn.close()
-                        continue
-
-                    # If the connection isn't authenticated, check auth code
-                    if conn in needs_authentication:
-                        # Allow only the __authenticate__ command
-                        if request["command"] != "__authenticate__":
-                            write_packet(conn, {
-                                "ok": False,
-                                "data": "Please authenticate",
-                            })
-                            continue
-
-                        # Match the authentication key
-                        if request["data"] != self.auth_key:
-                            write_packet(conn, {
-                                "ok": False,
-                                "data": "Authentication failed",
-                            })
-                            continue
-
-                        write_packet(conn, {
-                            "ok": True,
-                            "data": "Welcome!"
-                        })
-
-                        needs_authentication.remove(conn)
-                        continue
-
-                    # __stop__ will stop the IPC server
-                    if request["command"] == "__stop__":
-                        # Allow only matching stop keys
-                        if request["data"] != self.stop_key:
-                            write_packet(conn, {
-                                "ok": False,
-                                "data": "Wrong stop key",
-                            })
-                            continue
-
-                        self.stop = True
-                        write_packet(conn, {
-                            "ok": True,
-                            "data": "Bye!",
-                        })
-                        break
-
-                    self.process(conn, request)
-
-        # Gracefully close all the connections
-        for conn in read_from:
-            try:
-                conn.shutdown(socket.SHUT_RDWR)
-            except OSError:
-                pass
-            conn.close()
+        self.process(connection, request)
 
     def process(self, conn, request):
         """Process a single request"""
         command = request["command"]
         request_data = request["data"]
+        request_id = request["id"]
 
         self.logger.debug("Received IPC command %s" % command)
 
+        # Commands can reply later, even after other requests from the same
+        # connection were processed, so each response carries its request ID
+        # Replies to clients which disconnected in the meantime are dropped,
+        # and they return False so commands can pick someone else
         def reply(data, ok=True):
-            response = {"ok": ok, "data": data}
-            write_packet(conn, response)
+            response = {"id": request_id, "ok": ok, "data": data}
+            return _write_response(conn, response)
 
         if command not in self.commands:
             reply("Command not supported!", False)
@@ -206,28 +260,270 @@ class IPCServer:
         self.stop = True
 
 
+class IPCConnection:
+    """A connection accepted by the IPC server
+
+    The socket is non-blocking, and the data is buffered until a whole packet
+    is received or until the other side is ready to receive it, so a slow
+    client doesn't block the server.
+    """
+
+    def __init__(self, sock, selector):
+        self.sock = sock
+        self.selector = selector
+        self.authenticated = False
+
+        # Closed connections might still need to send their last packets
+        self.closed = False
+        self._detached = False
+
+        self._received = bytearray()
+        self._to_send = bytearray()
+        self._writing = False
+
+    def read(self):
+        """Read the available data, returning the packets completed"""
+        if self.closed:
+            return []
+
+        try:
+            data = self.sock.recv(READ_CHUNK_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            data = b""
+
+        if not data:
+            self.close()
+            return []
+        self._received += data
+
+        packets = []
+        start = 0
+        while len(self._received) - start >= PACKET_LENGTH_SECTION_SIZE:
+            size = struct.unpack_from(PACKET_LENGTH_FORMAT, self._received,
+                                      start)[0]
+
+            # Unauthenticated clients can't make the server buffer a lot of
+            # data before checking their key
+            if not self.authenticated and size > AUTH_KEY_MAX_SIZE:
+                self.close()
+                return []
+
+            end = start + PACKET_LENGTH_SECTION_SIZE + size
+            if len(self._received) < end:
+                break
+
+            packets.append(self._received[end - size:end])
+            start = end
+
+        del self._received[:start]
+        return packets
+
+    def write(self, data):
+        """Write a packet, sending it as soon as possible"""
+        if self.closed:
+            raise EOFError("The connection is closed")
+
+        self._to_send += struct.pack(PACKET_LENGTH_FORMAT, len(data))
+        self._to_send += data
+
+        # If the data can't be sent right now, it's sent as soon as the
+        # socket is writable
+        if not self._writing:
+            self.flush()
+            if self._detached:
+                raise EOFError("The connection is closed")
+
+    def flush(self):
+        """Send as much buffered data as possible"""
+        if self._detached:
+            return
+
+        try:
+            sent = self.sock.send(self._to_send)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._detach()
+            return
+        del self._to_send[:sent]
+
+        if self.closed and not self._to_send:
+            self._detach()
+            return
+
+        writing = bool(self._to_send)
+        if writing != self._writing:
+            self._writing = writing
+            self._update_events()
+
+    def drain(self, timeout):
+        """Send all the buffered data, waiting if the socket isn't ready"""
+        self.sock.settimeout(timeout)
+        while self._to_send and not self._detached:
+            self.flush()
+
+    def close(self, flush=False):
+        """Close the connection, optionally after the buffered data is
+        sent"""
+        if self.closed:
+            return
+        self.closed = True
+        self._received = bytearray()
+
+        if flush and self._to_send:
+            self._update_events()
+        else:
+            self._detach()
+
+    def _update_events(self):
+        """Update the events the selector waits for"""
+        events = selectors.EVENT_WRITE if self._writing else 0
+        if not self.closed:
+            events |= selectors.EVENT_READ
+        self.selector.modify(self.sock, events, self)
+
+    def _detach(self):
+        """Close the socket and stop tracking it"""
+        if self._detached:
+            return
+        self.closed = True
+        self._detached = True
+        self._to_send = bytearray()
+
+        self.selector.unregister(self.sock)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
 class IPCClient:
-    """Client for the Inter-Process Communication"""
+    """Client for the Inter-Process Communication
 
-    def __init__(self, port, auth_key):
-        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.conn.connect(("localhost", port))
+    The client can be shared by multiple threads, and each one of them can
+    have multiple commands waiting for a response at the same time.
+    """
 
-        self.command("__authenticate__", auth_key)
+    def __init__(self, port, auth_key, host="localhost"):
+        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.conn.connect((host, port))
+        _setup_socket(self.conn)
+
+        # The authentication key isn't pickled, see IPCServer.run
+        write_raw_packet(self.conn, auth_key.encode("utf-8"))
+        response = self._read_response()
+        if not response["ok"]:
+            raise IPCError(response["data"])
+
+        self._ids = itertools.count()
+        self._pending = {}
+        self._write_lock = threading.Lock()
+        self._crashed = False
+
+        # Only one of the waiting threads at a time reads from the connection,
+        # delivering the responses to the other ones
+        self._condition = threading.Condition(threading.Lock())
+        self._reading = False
+        self._reader = None
 
     def command(self, command, data):
-        """Send a command to the IPC server"""
-        packet = {"command": command, "data": data}
+        """Send a command to the IPC server, and wait for its response"""
+        return self._send(command, data).result()
+
+    def send(self, command, data):
+        """Send a command to the IPC server without waiting for its
+        response, returning a PendingResponse"""
+        # Nobody might wait for the response, so a background thread reads
+        # it when no other thread is reading
+        with self._condition:
+            if self._reader is None:
+                self._reader = threading.Thread(
+                    target=self._read_until, args=(lambda: self._crashed,),
+                    name="botogram IPC reader", daemon=True,
+                )
+                self._reader.start()
+
+        return self._send(command, data)
+
+    def _send(self, command, data):
+        """Send a command, returning its pending response"""
+        future = PendingResponse(self)
+        with self._condition:
+            if self._crashed:
+                raise IPCServerCrashedError("The IPC server just crashed")
+
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+
+        packet = {"id": request_id, "command": command, "data": data}
         try:
-            write_packet(self.conn, packet)
-        except BrokenPipeError:
+            with self._write_lock:
+                write_packet(self.conn, packet)
+        except (BrokenPipeError, ConnectionResetError):
+            with self._condition:
+                self._pending.pop(request_id, None)
             raise IPCServerCrashedError("The IPC server just crashed")
 
-        response = read_packet(self.conn)
-        if response["ok"]:
-            return response["data"]
+        return future
+
+    def _read_until(self, done):
+        """Read the responses from the connection until done() is true"""
+        with self._condition:
+            while not done():
+                if self._reading:
+                    self._condition.wait()
+                    continue
+
+                self._reading = True
+                self._condition.release()
+                try:
+                    try:
+                        response = self._read_response()
+                    except (IPCServerCrashedError, OSError):
+                        response = None
+                    self._deliver(response)
+                finally:
+                    self._condition.acquire()
+                    self._reading = False
+                    self._condition.notify_all()
+
+    def _read_response(self):
+        """Read the next response from the server"""
+        try:
+            return read_packet(self.conn)
+        except (EOFError, ConnectionResetError):
+            raise IPCServerCrashedError("The IPC server just crashed")
 
-        raise IPCError(response["data"])
+    def _deliver(self, response):
+        """Deliver a response (or None if the connection broke)"""
+        if response is None:
+            error = IPCServerCrashedError("The IPC server just crashed")
+            with self._condition:
+                self._crashed = True
+                completed = list(self._pending.values())
+                self._pending = {}
+                for future in completed:
+                    future._complete(None, error)
+        else:
+            if response["ok"]:
+                result, error = response["data"], None
+            else:
+                result, error = None, IPCError(response["data"])
+
+            with self._condition:
+                future = self._pending.pop(response["id"], None)
+                if future is None:
+                    return
+                future._complete(result, error)
+            completed = [future]
+
+        # The callbacks are called by the thread reading the response
+        for future in completed:
+            for func in future._callbacks:
+                func(future)
 
     def close(self):
         """Close the connection to the IPC server"""
@@ -237,65 +533,173 @@ class IPCClient:
             pass
         self.conn.close()
 
+        if self._reader is not None:
+            self._reader.join()
+        self._deliver(None)
+
+
+class PendingResponse:
+    """The response to a command sent to the IPC server"""
+
+    def __init__(self, client):
+        self._client = client
+        self._done = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        """Check if the response was received"""
+        return self._done
+
+    def result(self):
+        """Wait for the response, returning it (or raising its error)"""
+        self._client._read_until(self.done)
+
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self):
+        """Wait for the response, returning its error (if any)"""
+        self._client._read_until(self.done)
+        return self._error
+
+    def add_done_callback(self, func):
+        """Call a function with this object when the response is received
+
+        The function is called by the thread reading the response, so it
+        must not wait for other responses.
+        """
+        with self._client._condition:
+            if not self._done:
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _complete(self, result, error):
+        """Store the response (called with the lock of the client held)"""
+        self._result = result
+        self._error = error
+        self._done = True
+
+
+def wait_async(response):
+    """Get an asyncio future completed with a pending response, so it can be
+    awaited without blocking the running event loop"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def received(response):
+        # The loop might be closed if the process is stopping
+        try:
+            loop.call_soon_threadsafe(_complete_future, future, response)
+        except RuntimeError:
+            pass
+
+    response.add_done_callback(received)
+    return future
+
+
+def _complete_future(future, response):
+    """Complete an asyncio future with a pending response"""
+    if future.cancelled():
+        return
+
+    error = response.exception()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(response.result())
+
+
+def _write_response(conn, response):
+    """Send a response, returning False if the client disconnected"""
+    if conn.closed:
+        return False
+
+    try:
+        conn.write(pickle.dumps(response))
+    except EOFError:
+        return False
+    return True
+
 
 def _read_from_socket(conn, length):
     """Read a chunk of data from a connection"""
-    chunks = []
-    remaining = length
-    while remaining > 0:
-        # Read a maximum of READ_MAX_CHUNK each iteration
-        chunk = remaining
-        if chunk > READ_MAX_CHUNK:
-            chunk = READ_MAX_CHUNK
-
+    # The data is received directly in its final buffer, without joining
+    # the chunks received from the socket
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    while received < length:
         # In Python 3.4, when the process received a signal every system call
         # is interrupted, so it's better to retry sending the data instead of
         # crashing when someone signals the process
         try:
-            resp = conn.recv(chunk)
+            count = conn.recv_into(view[received:])
         except InterruptedError:
             continue
 
-        if len(resp) == 0:
+        if count == 0:
             raise EOFError("Broken socket!")
 
-        chunks.append(resp)
-        remaining -= len(resp)
+        received += count
 
-    return b''.join(chunks)
+    return data
 
 
 def _write_on_socket(conn, data):
     """Write a chunk of data on a connection"""
-    remaining = len(data)
-    while remaining > 0:
+    view = memoryview(data)
+    sent = 0
+    while sent < len(data):
         # In Python 3.4, when the process received a signal every system call
         # is interrupted, so it's better to retry sending the data instead of
         # crashing when someone signals the process
         try:
-            sent = conn.send(data[len(data) - remaining:])
+            count = conn.send(view[sent:])
         except InterruptedError:
             continue
 
-        if sent == 0:
+        if count == 0:
             raise EOFError("Broken socket!")
 
-        remaining -= sent
+        sent += count
 
 
-def read_packet(conn):
-    """Read a packet from a connection"""
+def _setup_socket(conn):
+    """Prepare a socket connected to the other side of the IPC"""
+    # Each packet is sent with a single call, so there is no point in
+    # delaying them to merge them with the next ones
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def read_raw_packet(conn, max_size=None):
+    """Read a packet from a connection, without unpickling it"""
     size_raw = _read_from_socket(conn, PACKET_LENGTH_SECTION_SIZE)
-    size = struct.unpack("I", size_raw)[0]
+    size = struct.unpack(PACKET_LENGTH_FORMAT, size_raw)[0]
+
+    if max_size is not None and size > max_size:
+        raise EOFError("Packet too big!")
+
+    return _read_from_socket(conn, size)
 
-    result_raw = _read_from_socket(conn, size)
-    return pickle.loads(result_raw)
+
+def write_raw_packet(conn, data):
+    """Write a packet to a connection, without pickling it"""
+    size = struct.pack(PACKET_LENGTH_FORMAT, len(data))
+
+    # Sending the length and the data separately would delay the data until
+    # the other side acknowledges the length
+    _write_on_socket(conn, size + data)
+
+
+def read_packet(conn):
+    """Read a packet from a connection"""
+    return pickle.loads(read_raw_packet(conn))
 
 
 def write_packet(conn, data):
     """Write a packet to a connection"""
-    pickled = pickle.dumps(data)
-    size = struct.pack("I", len(pickled))
-
-    _write_on_socket(conn, size)
-    _write_on_socket(conn, pickled)
+    write_raw_packet(conn, pickle.dumps(data))
@@ -18,76 +18,636 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import base64
+import binascii
+import bisect
 import collections
+import heapq
+import inspect
+import pickle
+import time
+
+import logbook
+
+from . import backends
+from . import stats
+from .. import utils
+
+
+# Lower numbers are processed first
+DEFAULT_PRIORITIES = {
+    "callback_query": 0,
+    "message": 10,
+    "edited_message": 20,
+    "channel_post": 20,
+    "edited_channel_post": 20,
+    "poll": 20,
+    "timer": 30,
+}
+DEFAULT_PRIORITY = DEFAULT_PRIORITIES["message"]
+
+# Seconds the workers have to cancel a job after its timeout, before they're
+# killed
+TIMEOUT_GRACE = 1
+
+
+class PriorityQueue:
+    """A queue of jobs with a lane for each priority"""
+
+    def __init__(self, starvation_timeout=None):
+        self.lanes = {}
+        self.priorities = []
+        self.starvation_timeout = starvation_timeout
+
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def _lane(self, priority):
+        """Get the lane of a priority"""
+        if priority not in self.lanes:
+            self.lanes[priority] = collections.deque()
+            bisect.insort(self.priorities, priority)
+        return self.lanes[priority]
+
+    def appendleft(self, job):
+        """Put a job at the end of its lane"""
+        self._lane(job.priority).appendleft(job)
+        self._length += 1
+
+    def append(self, job):
+        """Put a job at the front of its lane"""
+        self._lane(job.priority).append(job)
+        self._length += 1
+
+    def pop(self):
+        """Get the next job which should be processed"""
+        if not self._length:
+            raise IndexError("pop from an empty queue")
+
+        lanes = [self.lanes[priority] for priority in self.priorities
+                 if self.lanes[priority]]
+        chosen = lanes[0]
+
+        # Jobs waiting for too long are processed first regardless of their
+        # priority, starting from the oldest one
+        if self.starvation_timeout is not None and len(lanes) > 1:
+            deadline = time.time() - self.starvation_timeout
+            overdue = [lane for lane in lanes
+                       if lane[-1].queued_at <= deadline]
+            if overdue:
+                chosen = min(overdue, key=lambda lane: lane[-1].queued_at)
+
+        self._length -= 1
+        return chosen.pop()
+
+    def oldest(self):
+        """Get the time the oldest job in the queue was queued at"""
+        fronts = [lane[-1].queued_at for lane in self.lanes.values() if lane]
+        if fronts:
+            return min(fronts)
+
+    def sizes(self):
+        """Get the number of jobs in each lane"""
+        return {priority: len(lane) for priority, lane in self.lanes.items()}
 
 
 class JobsCommands:
     """This object will manage the IPC jobs.* commands"""
 
-    def __init__(self):
-        self.queue = collections.deque()
+    def __init__(self, max_attempts=None, starvation_timeout=None,
+                 max_queued=None, backend=None, priorities=None,
+                 timeout=None):
+        self.queue = PriorityQueue(starvation_timeout)
         self.waiting = collections.deque()
+        self.retired = set()
+
+        # Replies to the bulk_put requests are delayed while too many jobs are
+        # queued, so the updaters stop fetching new updates
+        self.max_queued = max_queued
+        self.blocked = collections.deque()
+        self.released = False
+
+        # Jobs sent to a worker thread (identified by a (worker, thread) slot)
+        # which didn't request a new job yet
+        self.in_flight = {}
+        self.max_attempts = max_attempts
+
+        # The backend stores the jobs until they're completed
+        if backend is None:
+            backend = backends.MemoryBackend()
+        self.backend = backend
+
+        # Number of jobs queued or running for each limited job key, and the
+        # jobs to put in the queue as soon as one of them is completed
+        self.instances = collections.Counter()
+        self.coalesced = {}
 
+        # Jobs scheduled for later are kept in a heap ordered by time
+        self.delayed = []
+        self.delayed_count = 0
+        if priorities is None:
+            priorities = DEFAULT_PRIORITIES
+        self.priorities = priorities
+
+        # Jobs still running after their timeout are stopped by killing their
+        # worker, which is done by the runner which started it
+        self.timeout = timeout
+        self.deadlines = []
+        self.deadlines_count = 0
+        self.killed = {}
+        self.kills_count = 0
+        self.kills_waiting = []
+
+        self.stats = stats.JobsStats()
         self.stop = False
+        self.shutdown_waiting = []
+        self.logger = logbook.Logger("botogram runner")
+
+    def resume(self):
+        """Put back in the queue the jobs stored by the backend"""
+        now = time.time()
+        jobs = self.backend.load()
+        for job in jobs:
+            if job.run_at is not None and job.run_at > now:
+                self._delay(job)
+                continue
+
+            if job.instances_key is not None:
+                self.instances[job.instances_key] += 1
+            self.stats.job_put(job)
+            self._put(job)
+        return len(jobs)
+
+    def _delay(self, job):
+        """Keep a job until the time it's scheduled at"""
+        heapq.heappush(self.delayed, (job.run_at, self.delayed_count, job))
+        self.delayed_count += 1
+
+    def dispatch_delayed(self, now=None):
+        """Put in the queue the delayed jobs which are due, returning in how
+        many seconds the next one is"""
+        if now is None:
+            now = time.time()
+
+        # Delayed jobs not due yet aren't processed while shutting down
+        while self.delayed and self.delayed[0][0] <= now and not self.stop:
+            job = heapq.heappop(self.delayed)[2]
+            self.stats.job_put(job)
+            self._put(job)
+
+        if self.delayed:
+            return max(self.delayed[0][0] - now, 0)
+
+    def _admit(self, job):
+        """Check if a job can be put in the queue, given its instances limit"""
+        key = job.instances_key
+        if key is None:
+            return True
+
+        if job.max_instances is None or \
+           self.instances[key] < job.max_instances:
+            self.instances[key] += 1
+            return True
+
+        # Only the latest job is kept when coalescing
+        if job.overlap == "coalesce":
+            self.coalesced[key] = job
+        self.stats.job_skipped(job)
+        return False
+
+    def _put_many(self, jobs):
+        """Put multiple jobs in the queue, if their limits allow it"""
+        jobs = [job for job in jobs if self._admit(job)]
+
+        self.backend.add(jobs)
+        for job in jobs:
+            self.stats.job_put(job)
+            self._put(job)
+
+    def _done(self, job, failed=False):
+        """Forget about a job which won't be processed anymore"""
+        self.backend.ack(job)
+        self.stats.job_done(job, failed)
+
+        key = job.instances_key
+        if key is None:
+            return
+
+        self.instances[key] -= 1
+        if self.instances[key] <= 0:
+            del self.instances[key]
+
+        # Run once the jobs coalesced while this one was running
+        if key in self.coalesced:
+            coalesced = self.coalesced.pop(key)
+            if not self.stop:
+                self._put_many([coalesced])
 
     def _put(self, job):
         """Internal implementation of putting a job into the queue"""
+        job.queued_at = time.time()
+        if job.timeout is None:
+            job.timeout = self.timeout
+
         # Directly send the job to the processes wanting it
-        if len(self.waiting) > 0:
-            try:
-                self.waiting.pop()(job)
-            except EOFError:
-                pass
-            else:
-                return
+        while len(self.waiting) > 0:
+            slot, reply = self.waiting.pop()
+            if not reply(job):
+                # The worker is dead, so try with the next one
+                continue
+
+            self._started(slot, job)
+            return
 
         self.queue.appendleft(job)
 
+    def _started(self, slot, job):
+        """Keep track of a job sent to a worker"""
+        self.in_flight[slot] = job
+        self.stats.job_started(job)
+
+        if job.timeout is not None:
+            deadline = job.started_at + job.timeout + TIMEOUT_GRACE
+            heapq.heappush(self.deadlines, (deadline, self.deadlines_count,
+                                            slot, job))
+            self.deadlines_count += 1
+
+    def check_timeouts(self, now=None):
+        """Stop the jobs running for longer than their timeout, returning in
+        how many seconds the next one expires"""
+        if now is None:
+            now = time.time()
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            __, __, slot, job = heapq.heappop(self.deadlines)
+
+            # Completed jobs are removed from the heap only here
+            if self.in_flight.get(slot) is not job:
+                continue
+            del self.in_flight[slot]
+
+            self.logger.error("Job %s timed out after %s seconds, killing "
+                              "worker #%s" % (job.name, job.timeout, slot[0]))
+            self.stats.job_timed_out(job, now)
+            self._done(job, failed=True)
+
+            # The worker isn't going to process other jobs
+            self._retire(slot[0])
+            if slot[0] not in self.killed:
+                self.kills_count += 1
+                self.killed[slot[0]] = self.kills_count
+                self._notify_kills()
+
+        if self.deadlines:
+            return max(self.deadlines[0][0] - now, 0)
+
+    def _notify_kills(self):
+        """Tell the runners which workers they should kill"""
+        # The count is sent too, since the workers which died in the
+        # meantime aren't in the list anymore
+        for after, reply in self.kills_waiting:
+            reply((self.kills_count, [
+                worker_id for worker_id, count in self.killed.items()
+                if count > after
+            ]))
+        self.kills_waiting = []
+
+    def wait_kills(self, after, reply):
+        """Reply with the kills count and the workers to kill, after the
+        provided count"""
+        self.kills_waiting.append((after, reply))
+        if self.kills_count > after:
+            self._notify_kills()
+
+    def _is_full(self):
+        """Check if the queue is over its limit"""
+        if self.max_queued is None or self.released:
+            return False
+        return len(self.queue) >= self.max_queued
+
+    def _unblock(self):
+        """Reply to the blocked requests if there is space in the queue"""
+        while len(self.blocked) > 0 and not self._is_full():
+            self.blocked.pop()(None)
+
     def bulk_put(self, jobs, reply):
-        """Put multiple jobs in the queue"""
+        """Put multiple jobs in the queue, waiting if it's full"""
         if self.stop:
-            reply("No more jobs accepted", ok=False)
+            return reply("No more jobs accepted", ok=False)
 
         # Add each provided job
-        for job in jobs:
-            self._put(job)
+        self._put_many(jobs)
+
+        # The jobs are accepted anyway, but the reply is sent only when the
+        # queue has enough space for more jobs
+        if self._is_full():
+            self.blocked.appendleft(reply)
+        else:
+            reply(None)
+
+    def bulk_put_nowait(self, jobs, reply):
+        """Put multiple jobs in the queue, without waiting if it's full"""
+        if self.stop:
+            return reply("No more jobs accepted", ok=False)
+
+        self._put_many(jobs)
+        reply(None)
+
+    def schedule(self, job, reply):
+        """Put a job in the queue at the time it's scheduled at"""
+        if self.stop:
+            return reply("No more jobs accepted", ok=False)
+
+        if job.priority is None:
+            job.priority = self.priorities.get("timer", DEFAULT_PRIORITY)
+
+        self.backend.add([job])
+        self._delay(job)
         reply(None)
 
-    def get(self, _, reply):
+    def get(self, slot, reply):
         """Get a job from the queue"""
+        # Requesting a new job means the previous one was completed
+        previous = self.in_flight.pop(slot, None)
+        if previous is not None:
+            # Workers cancel the jobs running for longer than their timeout
+            if previous.failed and previous.timeout is not None and \
+               time.time() - previous.started_at >= previous.timeout:
+                self.logger.warning("Job %s was cancelled after %s seconds" %
+                                    (previous.name, previous.timeout))
+                self.stats.job_timed_out(previous)
+            self._done(previous, previous.failed)
+
+        # Retired workers must stop as soon as they finish their jobs
+        if slot[0] in self.retired:
+            return reply("__stop__")
+
+        # The queue doesn't need to be drained when shutting down if the jobs
+        # in it are going to be processed after a restart
+        if self.stop and self.backend.durable:
+            return reply("__stop__")
+
         # If there is something in the queue return it, else append the request
         # to the new jobs' waiting deque
         if len(self.queue) > 0:
-            reply(self.queue.pop())
+            job = self.queue.pop()
+            self._started(slot, job)
+            reply(job)
+
+            self._unblock()
         else:
             if self.stop:
-                reply("__stop__")
+                return reply("__stop__")
+
+            self.waiting.appendleft((slot, reply))
+
+    def failed(self, slot, reply):
+        """Mark the job a worker is processing as failed"""
+        if slot in self.in_flight:
+            self.in_flight[slot].failed = True
+        reply(None)
+
+    def status(self, _, reply):
+        """Get the status of the queue"""
+        oldest = 0
+        if len(self.queue) > 0:
+            oldest = time.time() - self.queue.oldest()
+
+        waiting = collections.Counter(slot[0] for slot, _ in self.waiting)
+        reply({
+            "queued": len(self.queue),
+            "lanes": self.queue.sizes(),
+            "oldest": oldest,
+            "waiting": dict(waiting),
+            "blocked": len(self.blocked),
+            "delayed": len(self.delayed),
+            "stopping": self.stop,
+        })
+
+    def get_stats(self, _, reply):
+        """Get the detailed statistics of the jobs"""
+        now = time.time()
+
+        oldest = 0
+        if len(self.queue) > 0:
+            oldest = now - self.queue.oldest()
+
+        workers = {}
+        for slot, _ in self.waiting:
+            workers.setdefault(slot[0], _worker_stats())["idle"] += 1
+        for slot, job in self.in_flight.items():
+            workers.setdefault(slot[0], _worker_stats())["busy"].append({
+                "thread": slot[1],
+                "job": job.name,
+                "running": now - job.started_at,
+            })
+        for worker_id, worker in workers.items():
+            worker["retiring"] = worker_id in self.retired
+
+        result = self.stats.export(now)
+        result["queue"] = {
+            "queued": len(self.queue),
+            "lanes": self.queue.sizes(),
+            "oldest": oldest,
+            "blocked": len(self.blocked),
+            "delayed": len(self.delayed),
+        }
+        result["workers"] = workers
+        reply(result)
+
+    def _retire(self, worker_id):
+        """Don't send new jobs to a worker"""
+        self.retired.add(worker_id)
+
+        # Stop the threads of the worker currently waiting for a job
+        for waiting in list(self.waiting):
+            if waiting[0][0] == worker_id:
+                self.waiting.remove(waiting)
+                waiting[1]("__stop__")
 
-            self.waiting.appendleft(reply)
+    def retire(self, worker_id, reply):
+        """Tell a worker to stop after the jobs it's processing"""
+        self._retire(worker_id)
+        reply(None)
+
+    def worker_died(self, worker_id, reply):
+        """Redeliver the jobs a dead worker was processing"""
+        # Forget about the requests the worker was waiting for
+        for waiting in list(self.waiting):
+            if waiting[0][0] == worker_id:
+                self.waiting.remove(waiting)
+        self.retired.discard(worker_id)
+
+        # Workers killed because of a timeout didn't crash because of the other
+        # jobs they were processing
+        killed = self.killed.pop(worker_id, None) is not None
+
+        requeued = 0
+        dropped = 0
+        for slot in [slot for slot in self.in_flight if slot[0] == worker_id]:
+            job = self.in_flight.pop(slot)
+
+            # Jobs which crashed too many workers are probably the cause of the
+            # crashes, so they're not processed anymore
+            if not killed:
+                job.attempts += 1
+            if self.max_attempts is not None and \
+               job.attempts >= self.max_attempts:
+                self._done(job, failed=True)
+                dropped += 1
+                continue
+
+            # Redelivered jobs are put at the front of the queue
+            requeued += 1
+            if len(self.waiting) > 0:
+                self._put(job)
+            else:
+                self.queue.append(job)
+
+        reply({"requeued": requeued, "dropped": dropped})
+
+    def release(self, _, reply):
+        """Stop blocking the requests when the queue is full"""
+        self.released = True
+        self._unblock()
+
+        reply(None)
+
+    def abort(self, _, reply):
+        """Stop processing the jobs, returning the ones not completed yet"""
+        queued = []
+        while len(self.queue) > 0:
+            queued.append(self.queue.pop())
+
+        # The jobs aren't acknowledged, so durable backends still have them
+        interrupted = list(self.in_flight.values())
+        self.in_flight = {}
+
+        delayed = [job for __, __, job in sorted(self.delayed)]
+        self.delayed = []
+
+        reply({
+            "queued": queued,
+            "interrupted": interrupted,
+            "delayed": delayed,
+        })
+
+    def wait_shutdown(self, _, reply):
+        """Reply only when the queue is shutting down"""
+        if self.stop:
+            return reply(None)
+        self.shutdown_waiting.append(reply)
 
     def shutdown(self, _, reply):
         """Shutdown the queue"""
         self.stop = True
 
+        # The remote runners must know the hub is stopping before their
+        # workers are stopped, otherwise they would replace them
+        for waiting_reply in self.shutdown_waiting:
+            waiting_reply(None)
+        self.shutdown_waiting = []
+
+        # Nothing is going to put new jobs anymore
+        self.released = True
+        self._unblock()
+
         # Stop all the waiting workers
         if len(self.waiting) > 0:
-            for worker in self.waiting:
-                worker("__stop__")
+            for slot, worker_reply in self.waiting:
+                worker_reply("__stop__")
+            self.waiting.clear()
 
         reply(None)
 
 
+def _worker_stats():
+    """Get the empty statistics of a worker"""
+    return {"idle": 0, "busy": []}
+
+
 class Job:
     """A job processed by workers"""
 
-    def __init__(self, bot_id, func, metadata):
+    def __init__(self, bot_id, func, metadata, priority=DEFAULT_PRIORITY,
+                 name=None, instances_key=None, max_instances=None,
+                 overlap="skip", run_at=None, timeout=None):
         self.bot_id = bot_id
-        self.func = func
-        self.metadata = metadata
+        self.priority = priority
+
+        # Without a timeout, the default one of the runner is used
+        self.timeout = timeout
+
+        # The function and the metadata are pickled only once, when the job
+        # is sent for the first time: the IPC process and the backends then
+        # forward the pickled payload without looking inside it
+        self._func = func
+        self._metadata = metadata
+        self._payload = None
+
+        # The ID of the update is copied out of the payload for the statistics
+        update = metadata.get("update")
+        self.update_id = update.update_id if update is not None else None
+
+        # Jobs with a run_at timestamp are put in the queue only at that time
+        self.run_at = run_at
+
+        # Jobs with the same instances key are limited to max_instances at
+        # the same time: the extra ones are skipped or coalesced
+        self.instances_key = instances_key
+        self.max_instances = max_instances
+        self.overlap = overlap
+
+        # The name is used only in the statistics
+        if name is None:
+            name = getattr(func, "__name__", "unknown")
+        self.name = name
+
+        # The ID is assigned by the jobs backend
+        self.id = None
+
+        # How many times the job was sent to a worker which then crashed
+        self.attempts = 0
+        self.failed = False
+
+    def __getstate__(self):
+        if self._payload is None:
+            self._payload = pickle.dumps((self._func, self._metadata),
+                                         pickle.HIGHEST_PROTOCOL)
+
+        state = self.__dict__.copy()
+        state.pop("_func", None)
+        state.pop("_metadata", None)
+        return state
+
+    def _load_payload(self):
+        """Unpickle the function and the metadata of a received job"""
+        self._func, self._metadata = pickle.loads(self._payload)
+
+    @property
+    def func(self):
+        if "_func" not in self.__dict__:
+            self._load_payload()
+        return self._func
+
+    @property
+    def metadata(self):
+        if "_metadata" not in self.__dict__:
+            self._load_payload()
+        return self._metadata
 
     def process(self, bots):
+        return utils.drive(self.steps(bots))
+
+    def steps(self, bots):
+        """Process the job, yielding the coroutines it needs to wait for"""
         bot = bots[self.bot_id]
-        return self.func(bot, self.metadata)
+        result = self.func(bot, self.metadata)
+        if inspect.isgenerator(result):
+            result = yield from result
+        return result
 
 
 def process_update(bot, metadata):
@@ -96,7 +656,7 @@ def process_update(bot, metadata):
 
     # Restore the removed API object
     update.set_api(bot.api)
-    bot.process(update)
+    yield from bot._process_steps(update)
 
 
 def process_task(bot, metadata):
@@ -104,4 +664,82 @@ def process_task(bot, metadata):
     task = metadata["task"]
     bot.logger.debug("Processing task %s..." % task.hook.name)
 
-    task.process(bot)
+    yield from task.steps(bot)
+
+
+def process_scheduled(bot, metadata):
+    """Process a function scheduled by the bot"""
+    func = metadata["func"]
+    bot.logger.debug("Processing scheduled function %s..." %
+                     getattr(func, "__qualname__", func))
+
+    yield from bot._call_steps(func, metadata["component"],
+                               **metadata["kwargs"])
+
+
+def process_evicted(bot, metadata):
+    """Tell the bot a key of the shared memory was evicted"""
+    value = pickle.loads(metadata["value"])
+    yield from bot._memory_evicted_steps(metadata["component"],
+                                         metadata["key"], value,
+                                         metadata["reason"])
+
+
+def describe_update(bot, update, priorities):
+    """Get the name, the priority and the timeout of the job processing an
+    update"""
+    hook = _update_target(bot, update)
+
+    kind = None
+    for one in bot._update_processors:
+        if getattr(update, one) is not None:
+            kind = one
+            break
+
+    name = hook.name if hook is not None else kind
+    priority = priorities.get(kind, DEFAULT_PRIORITY)
+
+    # Hooks can override the priority of the kind of update
+    timeout = None
+    if hook is not None:
+        priority = getattr(hook.func, "_botogram_priority", priority)
+        timeout = getattr(hook.func, "_botogram_timeout", None)
+
+    return name, priority, timeout
+
+
+def describe_task(task, priorities):
+    """Get the name, the priority and the timeout of the job processing a
+    task"""
+    name = getattr(task.hook, "name", None)
+    priority = priorities.get("timer", DEFAULT_PRIORITY)
+
+    func = getattr(task.hook, "func", None)
+    priority = getattr(func, "_botogram_priority", priority)
+    timeout = getattr(func, "_botogram_timeout", None)
+
+    return name, priority, timeout
+
+
+def _update_target(bot, update):
+    """Find out which hook will process the update, if that's cheap"""
+    # Commands can be found by their name
+    if update.message is not None and update.message.text is not None:
+        match = bot._commands_re.match(update.message.text)
+        if match and match.group(1) in bot._commands:
+            return bot._commands[match.group(1)]._hook
+
+    # Callbacks can be found from the hashed name in the callback data, without
+    # checking its signature: that's done while processing the update
+    if update.callback_query is not None:
+        raw = update.callback_query._data
+        if raw is None or len(raw) < 32:
+            return
+        try:
+            name = base64.b64decode(raw[:32].encode("utf-8"))[16:]
+        except binascii.Error:
+            return
+
+        for hook in bot._chains["callbacks"]:
+            if hook._name == name:
+                return hook
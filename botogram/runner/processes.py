@@ -18,10 +18,13 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import asyncio
+import concurrent.futures
 import multiprocessing
 import os
+import sys
 import traceback
-import queue
+import threading
 import signal
 
 import logbook
@@ -30,32 +33,58 @@ from . import jobs
 from . import shared
 from . import ipc
 from .. import api
+from .. import utils
 from .. import updates as updates_module
 
 
+# Seconds the previous instance of the bot has to confirm its last updates
+HANDOVER_GRACE = 0.5
+
+try:
+    import resource
+except ImportError:
+    # The resource module isn't available on Windows
+    resource = None
+
+
 class BaseProcess(multiprocessing.Process):
     """Base class for all of the processes"""
 
-    def __init__(self, ipc_info, *args):
+    def __init__(self, ipc_info, *args, **kwargs):
         self.stop = False
         self.logger = logbook.Logger("botogram subprocess")
 
+        # The IPC client is shared by all the threads of the process, and
+        # it's created in the child process since it can't be pickled
+        self._ipc_info = ipc_info
         self.ipc = None
-        if ipc_info is not None:
-            self.ipc = ipc.IPCClient(*ipc_info)
+        self._local = None
 
         super(BaseProcess, self).__init__()
-        self.setup(*args)
+        self.setup(*args, **kwargs)
 
     def setup(self, *args):
         """Setup the class"""
         pass
 
+    def use_context(self, context):
+        """Start the process with a specific multiprocessing context"""
+        # multiprocessing.Process always uses the default start method, so
+        # the one of the context replaces it
+        # This relies on private attributes of CPython's multiprocessing
+        # (checked by tests/test_runner_processes.py), since the processes
+        # can't inherit from a specific context's Process class
+        self._start_method = context.get_start_method()
+        self._Popen = context.Process._Popen
+
     def run(self):
         """Run the process"""
         for one in signal.SIGINT, signal.SIGTERM:
             signal.signal(one, _ignore_signal)
 
+        if self._ipc_info is not None:
+            self.ipc = ipc.IPCClient(*self._ipc_info)
+        self._local = threading.local()
         self.before_start()
 
         self.logger.debug("%s process is ready! (pid: %s)" % (self.name,
@@ -103,33 +132,104 @@ class IPCProcess(BaseProcess):
 
     name = "IPC"
 
-    def setup(self, ipc):
+    def setup(self, ipc, max_attempts=None, starvation_timeout=None,
+              max_queued=None, bots=None, jobs_backend=None, priorities=None,
+              job_timeout=None, shared_store=None):
         self.ipc_server = ipc
+        self.bots = bots
 
         # Setup the jobs commands
-        self.jobs_commands = jobs.JobsCommands()
-        ipc.register_command("jobs.bulk_put", self.jobs_commands.bulk_put)
-        ipc.register_command("jobs.get", self.jobs_commands.get)
-        ipc.register_command("jobs.shutdown", self.jobs_commands.shutdown)
+        self.jobs_commands = jobs.JobsCommands(max_attempts,
+                                               starvation_timeout, max_queued,
+                                               jobs_backend, priorities,
+                                               job_timeout)
+        self.register("jobs.bulk_put", self.jobs_commands.bulk_put)
+        self.register("jobs.bulk_put_nowait",
+                      self.jobs_commands.bulk_put_nowait)
+        self.register("jobs.get", self.jobs_commands.get)
+        self.register("jobs.failed", self.jobs_commands.failed)
+        self.register("jobs.status", self.jobs_commands.status)
+        self.register("jobs.retire", self.jobs_commands.retire)
+        self.register("jobs.worker_died", self.jobs_commands.worker_died)
+        self.register("jobs.release", self.jobs_commands.release)
+        self.register("jobs.abort", self.jobs_commands.abort)
+        self.register("jobs.shutdown", self.jobs_commands.shutdown)
+        self.register("jobs.wait_shutdown", self.jobs_commands.wait_shutdown)
+        self.register("jobs.schedule", self.jobs_commands.schedule)
+        self.register("jobs.wait_kills", self.jobs_commands.wait_kills)
+        self.ipc_server.register_timer(self.jobs_commands.dispatch_delayed)
+        self.ipc_server.register_timer(self.jobs_commands.check_timeouts)
+        self.register("stats.get", self.jobs_commands.get_stats)
+
+        # Remote workers need the bots to process the jobs
+        self.register("bots.get", self.get_bots)
 
         # Setup the shared commands
-        self.shared_commands = shared.SharedMemoryCommands()
-        ipc.register_command("shared.get", self.shared_commands.get)
-        ipc.register_command("shared.list", self.shared_commands.list)
-        ipc.register_command("shared.lock_acquire",
-                             self.shared_commands.lock_acquire)
-        ipc.register_command("shared.lock_release",
-                             self.shared_commands.lock_release)
-        ipc.register_command("shared.lock_status",
-                             self.shared_commands.lock_status)
-        ipc.register_command("shared.lock_import",
-                             self.shared_commands.lock_import)
-        ipc.register_command("shared.lock_export",
-                             self.shared_commands.lock_export)
+        self.shared_commands = shared.SharedMemoryCommands(shared_store,
+                                                           self.memory_evicted)
+        self.ipc_server.register_timer(self.shared_commands.flush)
+        self.ipc_server.register_timer(self.shared_commands.expire)
+        self.register("shared.get", self.shared_commands.get)
+        self.register("shared.list", self.shared_commands.list)
+        self.register("shared.get_many", self.shared_commands.get_many)
+        self.register("shared.set_many", self.shared_commands.set_many)
+        self.register("shared.delete_many", self.shared_commands.delete_many)
+        self.register("shared.incr", self.shared_commands.incr)
+        self.register("shared.cas", self.shared_commands.cas)
+        self.register("shared.append", self.shared_commands.append)
+        self.register("shared.setdefault", self.shared_commands.setdefault)
+        self.register("shared.pop", self.shared_commands.pop)
+        self.register("shared.commit", self.shared_commands.commit)
+        self.register("shared.contains", self.shared_commands.contains)
+        self.register("shared.size", self.shared_commands.size)
+        self.register("shared.keys", self.shared_commands.keys)
+        self.register("shared.items", self.shared_commands.items)
+        self.register("shared.clear", self.shared_commands.clear)
+        self.register("shared.watch", self.shared_commands.watch)
+        self.register("shared.wait_changes",
+                      self.shared_commands.wait_changes)
+        self.register("shared.lock_acquire",
+                      self.shared_commands.lock_acquire)
+        self.register("shared.lock_release",
+                      self.shared_commands.lock_release)
+        self.register("shared.lock_status", self.shared_commands.lock_status)
+        self.register("shared.lock_import", self.shared_commands.lock_import)
+        self.register("shared.lock_export", self.shared_commands.lock_export)
+
+    def register(self, name, func):
+        """Register an IPC command, counting how many times it's called"""
+        self.ipc_server.register_command(
+            name, self.jobs_commands.stats.counted(name, func),
+        )
+
+    def get_bots(self, _, reply):
+        """Get the bots processed by the runner"""
+        reply(self.bots)
+
+    def memory_evicted(self, limits, key, value, reason):
+        """Tell the bot a key of the shared memory was evicted"""
+        job = jobs.Job(limits["bot"], jobs.process_evicted, {
+            "component": limits["component"],
+            "key": key,
+            "value": value,
+            "reason": reason,
+        }, self.jobs_commands.priorities.get("timer", jobs.DEFAULT_PRIORITY),
+            "memory_evicted")
+        self.jobs_commands.bulk_put_nowait([job], lambda data, ok=True: None)
 
     def before_start(self):
-        # Start the shared memory manager
-        self.shared_commands.start()
+        # Process again the jobs which weren't completed before the last stop
+        self.jobs_commands.backend.open(self.bots)
+        resumed = self.jobs_commands.resume()
+        if resumed:
+            self.logger.info("Resumed %s jobs stored before the last stop" %
+                             resumed)
+
+        self.shared_commands.open()
+
+    def after_stop(self):
+        self.jobs_commands.backend.close()
+        self.shared_commands.close()
 
     def loop(self):
         self.ipc_server.run()
@@ -148,24 +248,195 @@ class WorkerProcess(BaseProcess):
 
     name = "Worker"
 
-    def setup(self, bots):
+    def setup(self, worker_id, bots, threads=1, async_loop=False,
+              max_jobs=None, max_memory=None, async_jobs=1):
+        self.worker_id = worker_id
         self.bots = bots
+        self.threads_count = threads
+        self.threads = []
+
+        # The worker stops itself after these limits are reached, so it can be
+        # replaced by a fresh one
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.processed_jobs = 0
+        self.recycling = False
+        # Locks can't be pickled, so this is created in the child process
+        self.counter_lock = None
+
+        # Async workers process each job in a task of their event loop, so
+        # the number of jobs processed at once doesn't depend on the threads
+        self.async_loop = async_loop
+        self.async_jobs = async_jobs
+        self.event_loop = None
+        self.executor = None
+        self.api_executor = None
 
-    def loop(self):
+    def before_start(self):
+        self.counter_lock = threading.Lock()
+
+        # Each thread requests jobs with its own slot
+        self._local.slot = (self.worker_id, 0)
+
+        # The normal functions and the Telegram API calls of async workers run
+        # in their own executors, so they don't block the event loop
+        if self.async_loop:
+            self.event_loop = asyncio.new_event_loop()
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.threads_count, "botogram worker",
+            )
+            self.api_executor = concurrent.futures.ThreadPoolExecutor(
+                self.threads_count, "botogram API",
+            )
+            utils.set_coroutines_loop(self.event_loop)
+            utils.set_coroutines_executor(self.api_executor)
+            return
+
+        # The main thread processes jobs too, so only the additional ones are
+        # started here
+        for i in range(1, self.threads_count):
+            thread = threading.Thread(target=self.thread_run, args=(i,),
+                                      daemon=True)
+            thread.start()
+
+            self.threads.append(thread)
+
+    def thread_run(self, index):
+        """Run an additional jobs thread"""
+        self._local.slot = (self.worker_id, index)
+
+        stop = False
+        while not stop:
+            try:
+                stop = self.process_job()
+            except ipc.IPCServerCrashedError:
+                self.logger.error("The IPC server just crashed. Please kill "
+                                  "the runner.")
+                stop = True
+            except Exception:
+                traceback.print_exc()
+
+    def process_job(self):
+        """Fetch and process a single job, returning True when stopping"""
         # Request a new job
+        # This also tells the IPC server the previous job was completed
         try:
-            job = self.ipc.command("jobs.get", None)
+            job = self.ipc.command("jobs.get", self._local.slot)
         except InterruptedError:
-            # This return acts as a continue
-            return
+            return False
 
         # If the job is None, stop the worker
         if job == "__stop__":
-            self.stop = True
-            return
+            return True
 
         # Run the wanted job
-        job.process(self.bots)
+        # Coroutines are cancelled when the job times out, while the normal
+        # functions can only be stopped by killing the whole worker
+        utils.set_coroutines_timeout(job.timeout)
+        try:
+            job.process(self.bots)
+        except Exception:
+            # The error is then printed by the caller
+            self.ipc.command("jobs.failed", self._local.slot)
+            raise
+        finally:
+            self.check_recycle()
+        return False
+
+    def check_recycle(self):
+        """Retire the worker if it reached its limits"""
+        with self.counter_lock:
+            self.processed_jobs += 1
+            if self.recycling:
+                return
+
+            if self.max_jobs is not None and \
+               self.processed_jobs >= self.max_jobs:
+                reason = "it processed %s jobs" % self.processed_jobs
+            elif self.max_memory is not None and \
+                    _memory_usage() >= self.max_memory:
+                reason = "it's using more than %s MB of memory" % \
+                    self.max_memory
+            else:
+                return
+
+            self.recycling = True
+
+        # Every thread of the worker will be stopped by the IPC server as soon
+        # as it finishes its job
+        self.logger.debug("Recycling worker #%s, since %s" % (self.worker_id,
+                          reason))
+        self.ipc.command("jobs.retire", self.worker_id)
+
+    def command_async(self, command, data):
+        """Send a command to the IPC server, returning an asyncio future
+        completed with its response"""
+        return ipc.wait_async(self.ipc.send(command, data))
+
+    async def run_async(self):
+        """Process the jobs of all the slots in the event loop"""
+        tasks = [self.event_loop.create_task(self.slot_run_async(i))
+                 for i in range(self.async_jobs)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def slot_run_async(self, index):
+        """Fetch and process the jobs of a slot, until the worker stops"""
+        slot = (self.worker_id, index)
+        while True:
+            try:
+                job = await self.command_async("jobs.get", slot)
+            except InterruptedError:
+                continue
+            except ipc.IPCServerCrashedError:
+                self.logger.error("The IPC server just crashed. Please kill "
+                                  "the runner.")
+                return
+
+            if job == "__stop__":
+                return
+
+            try:
+                await self.process_job_async(slot, job)
+            except Exception:
+                traceback.print_exc()
+
+    async def process_job_async(self, slot, job):
+        """Process a single job in the event loop"""
+        # The timeout is local to the task processing this job
+        utils.set_coroutines_timeout(job.timeout)
+        try:
+            await utils.drive_async(job.steps(self.bots), self.executor)
+        except Exception:
+            await self.command_async("jobs.failed", slot)
+            raise
+        finally:
+            await self.event_loop.run_in_executor(self.executor,
+                                                  self.check_recycle)
+
+    def loop(self):
+        if self.async_loop:
+            self.event_loop.run_until_complete(self.run_async())
+            self.stop = True
+        elif self.process_job():
+            self.stop = True
+
+    def after_stop(self):
+        # Every thread receives its own stop command from the IPC server
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        # No coroutine is running anymore, since all the slots stopped
+        if self.event_loop is not None:
+            utils.set_coroutines_loop(None)
+            utils.set_coroutines_executor(None)
+            self.executor.shutdown()
+            self.api_executor.shutdown()
+            self.event_loop.close()
 
 
 class UpdaterProcess(BaseProcess):
@@ -173,24 +444,25 @@ class UpdaterProcess(BaseProcess):
 
     name = "Updater"
 
-    def setup(self, bot, commands):
+    def setup(self, bot, stop_event, priorities=None, handover=False):
         self.bot = bot
         self.bot_id = bot._bot_id
-        self.commands = commands
+        self.stop_event = stop_event
+
+        if priorities is None:
+            priorities = jobs.DEFAULT_PRIORITIES
+        self.priorities = priorities
 
-        self.fetcher = updates_module.UpdatesFetcher(bot)
+        # When taking over from a previous instance of the bot, the updates it
+        # didn't fetch aren't an old backlog
+        self.handover = handover
+        self.handover_waiting = False
+        self.fetcher = updates_module.UpdatesFetcher(bot, handover)
 
     def should_stop(self):
         """Check if the process should stop"""
-        try:
-            command = self.commands.get(False)
-        except queue.Empty:
-            val = False
-        else:
-            val = command == "stop"
-
-        self.stop = val
-        return val
+        self.stop = self.stop_event.is_set()
+        return self.stop
 
     def loop(self):
         # This allows to control the process
@@ -200,7 +472,10 @@ class UpdaterProcess(BaseProcess):
         try:
             updates = self.fetcher.fetch()
         except updates_module.AnotherInstanceRunningError:
-            self.handle_another_instance()
+            if self.handover:
+                self.wait_handover()
+            else:
+                self.handle_another_instance()
             return
         except api.APIError as e:
             self.logger.error("An error occured while fetching updates!")
@@ -208,18 +483,46 @@ class UpdaterProcess(BaseProcess):
             self.logger.debug("Exception content: %s" % str(e))
             return
 
+        if self.handover:
+            self.handover = False
+            if self.handover_waiting:
+                self.logger.info("The previous instance of the bot stopped, "
+                                 "this one is now fetching the updates")
+
+                # The previous instance might still be processing (and
+                # confirming) the last updates it fetched
+                if updates:
+                    self.fetcher.rewind()
+                    self.stop_event.wait(HANDOVER_GRACE)
+                    return
+
         if not updates:
             return
 
         result = []
         for update in updates:
             update.set_api(None)
+            name, priority, timeout = jobs.describe_update(self.bot, update,
+                                                           self.priorities)
             result.append(jobs.Job(self.bot_id, jobs.process_update, {
                 "update": update,
-            }))
+            }, priority, name, timeout=timeout))
 
         self.ipc.command("jobs.bulk_put", result)
 
+    def after_stop(self):
+        # The updates fetched until now are processed by this instance, so
+        # they shouldn't be sent again to the next one
+        self.fetcher.confirm()
+
+    def wait_handover(self):
+        """Wait for the previous instance of the bot to stop"""
+        if not self.handover_waiting:
+            self.logger.info("Waiting for the previous instance of the bot "
+                             "to stop...")
+            self.handover_waiting = True
+        self.stop_event.wait(0.1)
+
     def handle_another_instance(self):
         """Code run when another instance of the bot is running"""
         # Tell the user what's happening
@@ -239,3 +542,15 @@ class UpdaterProcess(BaseProcess):
 
 def _ignore_signal(*__):
     pass
+
+
+def _memory_usage():
+    """Get the peak memory usage of the current process, in megabytes"""
+    if resource is None:
+        return 0
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return usage / 1024 / 1024
+    return usage / 1024
@@ -18,43 +18,331 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import asyncio
 import collections
+import collections.abc
+import functools
 import multiprocessing
-import multiprocessing.managers
+import os
+import pickle
+import threading
+import time
 
+from . import ipc
+from .. import shared as shared_module
+from .. import utils
 
-class OverrideableDict(dict):
-    pass
+# How many changes are remembered for the processes caching the shared memory,
+# which need to invalidate their cache
+CHANGES_LOG_SIZE = 10000
+
+# Marker of the keys missing from a cached memory
+_MISSING = object()
 
 
 class SharedMemoryCommands:
     """Definition of IPC commands for the shared memory"""
 
-    def __init__(self):
+    # The values are stored pickled, so the IPC process doesn't need to
+    # unpickle (and import) the objects stored by the bots
+
+    def __init__(self, store=None, on_evict=None):
         self._memories = {}
-        self._manager = multiprocessing.managers.SyncManager()
+
+        # Limited memories have a limiter and the limits they were created
+        # with, and the evicted keys are sent to on_evict if needed
+        self._limiters = {}
+        self.on_evict = on_evict
+
+        # The memories are written to the store (if any) in batches, while
+        # they're always read from RAM
+        self.store = store
+
+        # Each change has a sequence number, sent with the values read so the
+        # processes caching them know how fresh they are
+        self._changes_count = 0
+        self._changes = None
+        self._changes_waiting = []
 
         self._locks = set()
         self._locks_queues = {}
 
-    def start(self):
-        """Start the shared memory manager"""
-        self._manager.start()
+    def open(self):
+        """Load the memories saved in the store"""
+        if self.store is not None:
+            self._memories = self.store.open()
 
-    def get(self, memory_id, reply):
-        """Get the shared memory which has the provided ID"""
-        new = False
-        if memory_id not in self._memories:
-            self._memories[memory_id] = self._manager.dict()
-            new = True
+    def flush(self):
+        """Write the changes to the store if it's time to do so, returning
+        when this should be called again"""
+        if self.store is not None:
+            return self.store.tick(self._memories)
 
-        # Send the shared memory to the process which requested it
-        reply((self._memories[memory_id], new))
+    def close(self):
+        """Write the last changes to the store"""
+        if self.store is not None:
+            self.store.close(self._memories)
+
+    def _memory(self, memory_id):
+        """Get a memory, creating it if it doesn't exist"""
+        if memory_id not in self._memories:
+            self._memories[memory_id] = {}
+
+        # Expired keys are removed before the memory is used
+        if memory_id in self._limiters:
+            self._expire(memory_id)
+        return self._memories[memory_id]
+
+    def get(self, request, reply):
+        """Create the shared memory which has the provided ID, returning if
+        it's new"""
+        memory_id, limits = request
+        new = memory_id not in self._memories
+        memory = self._memory(memory_id)
+
+        # The limits are enforced from the first time they're provided
+        if limits is not None and memory_id not in self._limiters:
+            limiter = shared_module.Limiter(limits["ttl"], limits["max_keys"],
+                                            limits["eviction"])
+            self._limiters[memory_id] = limiter, limits
+            self._written(memory_id, list(memory.keys()))
+
+        reply(new)
+
+    def _expire(self, memory_id, now=None):
+        """Remove the expired keys of a memory"""
+        limiter = self._limiters[memory_id][0]
+        if limiter.ttl is not None:
+            self._evict(memory_id, limiter.expired(now), "expired")
+
+    def _written(self, memory_id, keys):
+        """Record some keys were written, evicting the extra ones"""
+        if memory_id not in self._limiters:
+            return
+
+        limiter = self._limiters[memory_id][0]
+        for key in keys:
+            limiter.written(key)
+        self._evict(memory_id,
+                    limiter.overflowing(len(self._memories[memory_id])),
+                    "evicted")
+
+    def _evict(self, memory_id, keys, reason):
+        """Remove some keys, telling the bot about it if it wants to know"""
+        if not keys:
+            return
+
+        limits = self._limiters[memory_id][1]
+        memory = self._memories[memory_id]
+        for key in keys:
+            value = memory.pop(key, None)
+            if value is not None and limits["notify"] and \
+               self.on_evict is not None:
+                self.on_evict(limits, key, value, reason)
+        self._changed(memory_id, keys)
+
+    def expire(self):
+        """Remove the expired keys of all the memories, returning when this
+        should be called again"""
+        now = time.monotonic()
+        timeout = None
+        for memory_id, (limiter, __) in self._limiters.items():
+            if limiter.ttl is None:
+                continue
+
+            self._expire(memory_id, now)
+            expires = limiter.next_expiry()
+            if expires is None:
+                continue
+
+            remaining = max(expires - now, 0)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
 
     def list(self, memory_id, reply):
         """Get all the shared memories available"""
         reply(list(self._memories.keys()))
 
+    def _changed(self, memory_id, keys):
+        """Record a change to some keys (or to the whole memory if None),
+        returning its sequence number"""
+        self._changes_count += 1
+
+        if self.store is not None:
+            self.store.changed(memory_id, keys)
+
+        # Changes are logged only if some process is caching the memory
+        if self._changes is not None:
+            self._changes.append((self._changes_count, memory_id, keys))
+            self._notify_changes()
+
+        return self._changes_count
+
+    def _notify_changes(self):
+        """Send the new changes to the processes waiting for them"""
+        waiting, self._changes_waiting = self._changes_waiting, []
+        for after, reply in waiting:
+            # Processes which missed too many changes must drop their cache
+            if not self._changes or self._changes[0][0] > after + 1:
+                changes = None
+            else:
+                changes = []
+                for count, memory_id, keys in reversed(self._changes):
+                    if count <= after:
+                        break
+                    changes.append((memory_id, keys))
+                changes.reverse()
+
+            reply((self._changes_count, changes))
+
+    def watch(self, __, reply):
+        """Start logging the changes, returning the current sequence
+        number"""
+        if self._changes is None:
+            self._changes = collections.deque(maxlen=CHANGES_LOG_SIZE)
+        reply(self._changes_count)
+
+    def wait_changes(self, after, reply):
+        """Reply with the changes made after the provided sequence number"""
+        self._changes_waiting.append((after, reply))
+        if self._changes_count > after:
+            self._notify_changes()
+
+    def get_many(self, request, reply):
+        """Get the values of some keys, skipping the missing ones"""
+        memory_id, keys = request
+        memory = self._memory(memory_id)
+        values = {key: memory[key] for key in keys if key in memory}
+
+        if memory_id in self._limiters:
+            limiter = self._limiters[memory_id][0]
+            for key in values:
+                limiter.read(key)
+
+        reply((self._changes_count, values))
+
+    def set_many(self, request, reply):
+        """Set the values of some keys"""
+        memory_id, items = request
+        self._memory(memory_id).update(items)
+        self._written(memory_id, list(items.keys()))
+        reply(self._changed(memory_id, list(items.keys())))
+
+    def delete_many(self, request, reply):
+        """Delete some keys, returning how many of them existed"""
+        memory_id, keys = request
+        memory = self._memory(memory_id)
+
+        deleted = 0
+        for key in keys:
+            if key in memory:
+                del memory[key]
+                deleted += 1
+                self._removed(memory_id, key)
+        reply((self._changed(memory_id, keys), deleted))
+
+    def _removed(self, memory_id, key):
+        """Record a key was removed"""
+        if memory_id in self._limiters:
+            self._limiters[memory_id][0].removed(key)
+
+    def _atomic(self, memory_id, key, reply, func, *args):
+        """Change a key with the provided function, replying with the
+        result"""
+        memory = self._memory(memory_id)
+
+        # Errors are sent to the process which sent the command, since the
+        # IPC process must keep running: this includes the errors raised by
+        # unpickling the values and by their methods
+        try:
+            changed, result = func(memory, key, *args)
+        except Exception as e:
+            return reply((None, None, _portable_error(e)))
+
+        if key not in memory:
+            self._removed(memory_id, key)
+        elif changed:
+            self._written(memory_id, [key])
+        elif memory_id in self._limiters:
+            self._limiters[memory_id][0].read(key)
+
+        count = None
+        if changed:
+            count = self._changed(memory_id, [key])
+        reply((count, result, None))
+
+    def incr(self, request, reply):
+        """Add a number to the value of a key"""
+        memory_id, key, amount, default = request
+        self._atomic(memory_id, key, reply, _incr, amount, default)
+
+    def cas(self, request, reply):
+        """Change the value of a key only if it's the expected one"""
+        memory_id, key, expected, value = request
+        self._atomic(memory_id, key, reply, _cas, expected, value)
+
+    def append(self, request, reply):
+        """Append a value to the list stored in a key"""
+        memory_id, key, value = request
+        self._atomic(memory_id, key, reply, _append, value)
+
+    def setdefault(self, request, reply):
+        """Get the value of a key, setting it if it's missing"""
+        memory_id, key, default = request
+        self._atomic(memory_id, key, reply, _setdefault, default)
+
+    def pop(self, request, reply):
+        """Remove a key, returning its value"""
+        memory_id, key, has_default, default = request
+        self._atomic(memory_id, key, reply, _pop, has_default, default)
+
+    def commit(self, request, reply):
+        """Apply the changes of a transaction, only if the keys it read
+        didn't change in the meantime"""
+        memory_id, versions, items, deleted = request
+        memory = self._memory(memory_id)
+
+        # Versions are the pickled values read, or None if the keys were
+        # missing
+        for key, version in versions.items():
+            if memory.get(key) != version:
+                return reply((None, False))
+
+        memory.update(items)
+        self._written(memory_id, list(items.keys()))
+        for key in deleted:
+            if key in memory:
+                del memory[key]
+                self._removed(memory_id, key)
+
+        keys = list(items.keys()) + list(deleted)
+        reply((self._changed(memory_id, keys), True))
+
+    def contains(self, request, reply):
+        """Check if a key is in a memory"""
+        memory_id, key = request
+        reply(key in self._memory(memory_id))
+
+    def size(self, memory_id, reply):
+        """Get the number of keys in a memory"""
+        reply(len(self._memory(memory_id)))
+
+    def keys(self, memory_id, reply):
+        """Get all the keys of a memory"""
+        reply(list(self._memory(memory_id).keys()))
+
+    def items(self, memory_id, reply):
+        """Get the whole content of a memory"""
+        reply(dict(self._memory(memory_id)))
+
+    def clear(self, memory_id, reply):
+        """Remove all the keys of a memory"""
+        self._memory(memory_id).clear()
+        if memory_id in self._limiters:
+            self._limiters[memory_id][0].cleared()
+        reply(self._changed(memory_id, None))
+
     def lock_acquire(self, lock_id, reply):
         """Acquire a lock"""
         # If the lock isn't acquired acquire it
@@ -73,14 +361,19 @@ class SharedMemoryCommands:
         if lock_id not in self._locks:
             return reply(None)
 
-        self._locks.remove(lock_id)
+        # If there are processes waiting for this lock, hand it over to one
+        # of them, so no one else can acquire it in the meantime
+        # Processes which disconnected can't receive the lock anymore
+        queue = self._locks_queues.get(lock_id)
+        handed_over = False
+        while queue and not handed_over:
+            handed_over = queue.pop()(None)
 
-        # If there are processes waiting for this lock, wake up one of them
-        if lock_id in self._locks_queues:
-            self._locks_queues[lock_id].pop()(None)
-            # And clear up the queue if it's empty
-            if not len(self._locks_queues[lock_id]):
-                del self._locks_queues[lock_id]
+        # And clear up the queue if it's empty
+        if lock_id in self._locks_queues and not queue:
+            del self._locks_queues[lock_id]
+        if not handed_over:
+            self._locks.remove(lock_id)
 
         reply(None)
 
@@ -99,57 +392,436 @@ class SharedMemoryCommands:
         reply(self._locks)
 
 
+class ReadCache:
+    """Cache of the shared memory values read by a process"""
+
+    # Values are cached pickled, so hooks changing the objects they got don't
+    # change the cache too
+
+    def __init__(self):
+        self._memories = {}
+        self._lock = threading.Lock()
+
+        # Values read before the last change received from the IPC process
+        # might be stale, so they aren't cached
+        self._seen = _command("shared.watch", None)
+        self._watch(self._seen)
+
+    def _watch(self, after):
+        """Wait for the changes made after the provided sequence number"""
+        client = multiprocessing.current_process().ipc
+        try:
+            client.send("shared.wait_changes", after).add_done_callback(
+                self._changes_received,
+            )
+        except ipc.IPCServerCrashedError:
+            # The runner is stopping
+            pass
+
+    def _changes_received(self, future):
+        """Remove the changed keys from the cache"""
+        if future.exception() is not None:
+            return
+
+        count, changes = future.result()
+        with self._lock:
+            if changes is None:
+                self._memories = {}
+            else:
+                for memory_id, keys in changes:
+                    self._forget(memory_id, keys)
+            self._seen = max(self._seen, count)
+
+        self._watch(count)
+
+    def _forget(self, memory_id, keys):
+        """Remove some keys (or all of them if None) from the cache"""
+        if keys is None:
+            self._memories.pop(memory_id, None)
+        elif memory_id in self._memories:
+            memory = self._memories[memory_id]
+            for key in keys:
+                memory.pop(key, None)
+
+    def get(self, memory_id, keys):
+        """Get the cached values, and the keys which aren't cached"""
+        values = {}
+        missing = []
+        with self._lock:
+            memory = self._memories.get(memory_id, {})
+            for key in keys:
+                value = memory.get(key)
+                if value is None:
+                    missing.append(key)
+                elif value is not _MISSING:
+                    values[key] = value
+        return values, missing
+
+    def store(self, count, memory_id, keys, values):
+        """Cache the values read with the provided sequence number"""
+        with self._lock:
+            if count < self._seen:
+                return
+
+            memory = self._memories.setdefault(memory_id, {})
+            for key in keys:
+                memory[key] = values.get(key, _MISSING)
+
+    def changed(self, count, memory_id, keys):
+        """Remove the keys changed by this process from the cache"""
+        with self._lock:
+            self._forget(memory_id, keys)
+            self._seen = max(self._seen, count)
+
+
+class SharedDict(collections.abc.MutableMapping):
+    """A dict-like shared memory, stored by the IPC process"""
+
+    def __init__(self, memory_id, driver=None):
+        self.memory_id = memory_id
+        self._driver = driver
+
+    def _cache(self):
+        """Get the read cache of this process, if it's enabled"""
+        if self._driver is None:
+            return None
+        return self._driver.read_cache()
+
+    def _get_pickled(self, keys):
+        """Get the pickled values of some keys"""
+        cache = self._cache()
+        if cache is None:
+            __, values = _command("shared.get_many", (self.memory_id, keys))
+            return values
+
+        values, missing = cache.get(self.memory_id, keys)
+        if missing:
+            count, fetched = _command("shared.get_many",
+                                      (self.memory_id, missing))
+            cache.store(count, self.memory_id, missing, fetched)
+            values.update(fetched)
+        return values
+
+    def _changed(self, count, keys):
+        """Keep the cache of this process up to date after a change"""
+        cache = self._cache()
+        if cache is not None:
+            cache.changed(count, self.memory_id, keys)
+
+    def get_many(self, keys):
+        """Get the values of multiple keys at once, skipping the missing
+        ones"""
+        values = self._get_pickled(list(keys))
+        return {key: _loads(value) for key, value in values.items()}
+
+    def set_many(self, items):
+        """Set the values of multiple keys at once"""
+        items = {key: _dumps(value) for key, value in dict(items).items()}
+        if items:
+            count = _command("shared.set_many", (self.memory_id, items))
+            self._changed(count, list(items.keys()))
+
+    def delete_many(self, keys):
+        """Delete multiple keys at once, returning how many existed"""
+        keys = list(keys)
+        count, deleted = _command("shared.delete_many",
+                                  (self.memory_id, keys))
+        self._changed(count, keys)
+        return deleted
+
+    def _atomic(self, command, key, *args):
+        """Execute an atomic operation on a key in the IPC process"""
+        count, result, error = _command("shared." + command,
+                                        (self.memory_id, key) + args)
+        if error is not None:
+            raise error
+
+        if count is not None:
+            self._changed(count, [key])
+        return result
+
+    def incr(self, key, amount=1, default=0):
+        """Add a number to the value of a key, returning the new value"""
+        return self._atomic("incr", key, amount, default)
+
+    def decr(self, key, amount=1, default=0):
+        """Subtract a number from the value of a key, returning the new
+        value"""
+        return self._atomic("incr", key, -amount, default)
+
+    def cas(self, key, expected, value):
+        """Change the value of a key only if it's the expected one,
+        returning if it was changed"""
+        return self._atomic("cas", key, _dumps(expected), _dumps(value))
+
+    def append(self, key, value):
+        """Append a value to the list stored in a key, returning its new
+        length"""
+        return self._atomic("append", key, _dumps(value))
+
+    def setdefault(self, key, default=None):
+        return _loads(self._atomic("setdefault", key, _dumps(default)))
+
+    def pop(self, key, *default):
+        if len(default) > 1:
+            raise TypeError("pop expected at most 2 arguments")
+        has_default = bool(default)
+        default = _dumps(default[0]) if has_default else None
+        return _loads(self._atomic("pop", key, has_default, default))
+
+    def transaction(self, func=None,
+                    attempts=shared_module.TRANSACTION_ATTEMPTS):
+        """Change multiple keys at once, only if the keys read didn't change
+        in the meantime"""
+        return shared_module.transaction(self, func, attempts)
+
+    def _transaction_read(self, keys):
+        """Get the values of some keys, and the versions to check them
+        against when committing"""
+        # The cache is skipped, since it can return values already changed
+        __, values = _command("shared.get_many", (self.memory_id, keys))
+        return {key: (value, _loads(value)) for key, value in values.items()}
+
+    def _transaction_commit(self, versions, items, deleted):
+        """Apply the changes of a transaction, returning if it succeeded"""
+        versions = {key: None if version is shared_module._MISSING
+                    else version for key, version in versions.items()}
+        items = {key: _dumps(value) for key, value in items.items()}
+
+        count, ok = _command("shared.commit",
+                             (self.memory_id, versions, items, deleted))
+        if ok:
+            self._changed(count, list(items.keys()) + list(deleted))
+        return ok
+
+    def __getitem__(self, key):
+        result = self.get_many([key])
+        if key not in result:
+            raise KeyError(key)
+        return result[key]
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def __setitem__(self, key, value):
+        self.set_many({key: value})
+
+    def __delitem__(self, key):
+        if not self.delete_many([key]):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if self._cache() is not None:
+            return key in self._get_pickled([key])
+        return _command("shared.contains", (self.memory_id, key))
+
+    def __len__(self):
+        return _command("shared.size", self.memory_id)
+
+    def __iter__(self):
+        return iter(_command("shared.keys", self.memory_id))
+
+    def update(self, *args, **kwargs):
+        # All the keys are sent at once
+        self.set_many(dict(*args, **kwargs))
+
+    def clear(self):
+        count = _command("shared.clear", self.memory_id)
+        self._changed(count, None)
+
+    def copy(self):
+        """Get a copy of the whole memory as a dict"""
+        result = _command("shared.items", self.memory_id)
+        return {key: _loads(value) for key, value in result.items()}
+
+    # Views over the memory would need a request for each value
+
+    def keys(self):
+        return self.copy().keys()
+
+    def values(self):
+        return self.copy().values()
+
+    def items(self):
+        return self.copy().items()
+
+    def __repr__(self):
+        return "<SharedDict %s>" % self.memory_id
+
+
 class MultiprocessingDriver:
     """This is a multiprocessing-ready driver for the shared memory"""
 
-    def __init__(self):
+    def __init__(self, cache=False):
         self._memories = {}
 
+        # The cache is created in each process reading the memory
+        self.cache = cache
+        self._read_cache = None
+        self._read_cache_pid = None
+        self._read_cache_lock = threading.Lock()
+
     def __reduce__(self):
-        return rebuild_driver, tuple()
+        return rebuild_driver, (self.cache,)
+
+    def read_cache(self):
+        """Get the read cache of the current process, if it's enabled"""
+        if not self.cache:
+            return None
 
-    def _command(self, command, arg):
-        """Send a command"""
-        ipc = multiprocessing.current_process().ipc
-        return ipc.command(command, arg)
+        # Forked processes can't reuse the cache of their parent
+        with self._read_cache_lock:
+            if self._read_cache_pid != os.getpid():
+                self._read_cache = ReadCache()
+                self._read_cache_pid = os.getpid()
+        return self._read_cache
 
-    def get(self, memory_id):
+    def get(self, memory_id, limits=None):
         # Create the shared memory if it doens't exist
         is_new = False
         if memory_id not in self._memories:
-            memory, is_new = self._command("shared.get", memory_id)
-            self._memories[memory_id] = memory
+            is_new = _command("shared.get", (memory_id, limits))
+            self._memories[memory_id] = SharedDict(memory_id, self)
 
         return self._memories[memory_id], is_new
 
     def lock_acquire(self, lock_id):
         # This automagically blocks if the lock is already acquired
-        self._command("shared.lock_acquire", lock_id)
+        _command("shared.lock_acquire", lock_id)
+
+    async def lock_acquire_async(self, lock_id):
+        # The event loop keeps running while the lock is acquired by others
+        client = multiprocessing.current_process().ipc
+        response = client.send("shared.lock_acquire", lock_id)
+        try:
+            await ipc.wait_async(response)
+        except asyncio.CancelledError:
+            # The runner will give the lock to this process anyway, so it's
+            # released as soon as that happens
+            response.add_done_callback(
+                functools.partial(_release_cancelled, client, lock_id),
+            )
+            raise
 
     def lock_release(self, lock_id):
-        self._command("shared.lock_release", lock_id)
+        _command("shared.lock_release", lock_id)
+
+    async def lock_release_async(self, lock_id):
+        client = multiprocessing.current_process().ipc
+        await ipc.wait_async(client.send("shared.lock_release", lock_id))
 
     def lock_status(self, lock_id):
-        return self._command("shared.lock_status", lock_id)
+        return _command("shared.lock_status", lock_id)
 
     def import_data(self, data):
         # This will merge the provided component with the shared memory
-        for memory_id, memory in data["storage"].items():
-            memory = self.get(memory_id)
-            memory.update(data)
+        for memory_id, content in data["storage"].items():
+            memory, __ = self.get(memory_id)
+            memory.set_many(content)
 
         if len(data["locks"]):
-            self._command("shared.lock_import", data["locks"])
+            _command("shared.lock_import", data["locks"])
 
     def export_data(self):
         result = {"storage": {}}
-        for memory_id, data in self._memories.items():
-            result["storage"][memory_id] = dict(data)
+        for memory_id, memory in self._memories.items():
+            result["storage"][memory_id] = memory.copy()
 
-        result["locks"] = self._command("shared.lock_export", None)
+        result["locks"] = _command("shared.lock_export", None)
 
         return result
 
 
-def rebuild_driver():
-    return MultiprocessingDriver()
+utils.add_async_variants(SharedDict, shared_module.ASYNC_METHODS)
+
+
+def _release_cancelled(client, lock_id, response):
+    """Release a lock acquired after its coroutine was cancelled"""
+    if response.exception() is not None:
+        return
+
+    try:
+        client.send("shared.lock_release", lock_id)
+    except ipc.IPCServerCrashedError:
+        # The runner is stopping
+        pass
+
+
+def _incr(memory, key, amount, default):
+    value = _loads(memory[key]) if key in memory else default
+    value += amount
+    memory[key] = _dumps(value)
+    return True, value
+
+
+def _cas(memory, key, expected, value):
+    if key not in memory:
+        return False, False
+
+    # Equal values are usually pickled the same way
+    current = memory[key]
+    if current != expected and _loads(current) != _loads(expected):
+        return False, False
+
+    memory[key] = value
+    return True, True
+
+
+def _append(memory, key, value):
+    items = _loads(memory[key]) if key in memory else []
+    items.append(_loads(value))
+    memory[key] = _dumps(items)
+    return True, len(items)
+
+
+def _setdefault(memory, key, default):
+    if key in memory:
+        return False, memory[key]
+
+    memory[key] = default
+    return True, default
+
+
+def _pop(memory, key, has_default, default):
+    if key in memory:
+        return True, memory.pop(key)
+    if has_default:
+        return False, default
+    raise KeyError(key)
+
+
+def _portable_error(error):
+    """Get an error which can be sent to another process"""
+    try:
+        pickle.loads(pickle.dumps(error, pickle.HIGHEST_PROTOCOL))
+        return error
+    except Exception:
+        pass
+
+    # The error can't be rebuilt in the other process, so just describe it
+    try:
+        message = "%s: %s" % (type(error).__name__, error)
+    except Exception:
+        message = type(error).__name__
+    return RuntimeError("The shared memory operation failed with %s" %
+                        message)
+
+
+def _command(command, arg):
+    """Send a command to the IPC process"""
+    ipc = multiprocessing.current_process().ipc
+    return ipc.command(command, arg)
+
+
+def _dumps(value):
+    """Pickle a value stored in the shared memory"""
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(value):
+    """Unpickle a value stored in the shared memory"""
+    return pickle.loads(value)
+
+
+def rebuild_driver(cache=False):
+    return MultiprocessingDriver(cache)
@@ -0,0 +1,270 @@
+# Copyright (c) 2015-2019 The Botogram Authors (see AUTHORS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+
+import collections
+import http.server
+import json
+import math
+import threading
+import time
+
+import logbook
+
+
+# Rates are calculated on the events of the last RATE_WINDOW seconds, and
+# percentiles on the last SAMPLES_SIZE samples
+RATE_WINDOW = 60
+SAMPLES_SIZE = 1000
+PERCENTILES = (50, 90, 99)
+
+
+class Rate:
+    """Count how many times something happens each second"""
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.total = 0
+
+        self._buckets = collections.deque()
+
+    def _prune(self, second):
+        """Forget the events which are too old"""
+        while self._buckets and self._buckets[0][0] <= second - self.window:
+            self._buckets.popleft()
+
+    def add(self, count=1, now=None):
+        """Record some events"""
+        second = int(now if now is not None else time.time())
+        if self._buckets and self._buckets[-1][0] == second:
+            self._buckets[-1][1] += count
+        else:
+            self._buckets.append([second, count])
+
+        self.total += count
+        self._prune(second)
+
+    def per_second(self, now=None):
+        """Get the average number of events per second"""
+        self._prune(int(now if now is not None else time.time()))
+        return sum(count for _, count in self._buckets) / self.window
+
+    def export(self, now=None):
+        """Export the rate as a dict"""
+        return {"total": self.total, "per_second": self.per_second(now)}
+
+
+class Samples:
+    """Keep the last samples of a measure"""
+
+    def __init__(self, size=SAMPLES_SIZE):
+        self._samples = collections.deque(maxlen=size)
+
+    def add(self, value):
+        """Record a new sample"""
+        self._samples.append(value)
+
+    def export(self):
+        """Export the percentiles of the samples as a dict"""
+        values = sorted(self._samples)
+
+        result = {"samples": len(values)}
+        for percentile in PERCENTILES:
+            result["p%s" % percentile] = _percentile(values, percentile)
+        return result
+
+
+def _percentile(values, percentile):
+    """Get a percentile of a sorted list, with the nearest rank method"""
+    if not values:
+        return None
+
+    rank = math.ceil(len(values) * percentile / 100)
+    return values[max(rank - 1, 0)]
+
+
+class JobsStats:
+    """Statistics about the jobs processed by the runner"""
+
+    def __init__(self):
+        self.processed = Rate()
+        self.failed = Rate()
+        self.timeouts = Rate()
+        self.hooks = {}
+        self.updates = {}
+        self.commands = {}
+
+    def _hook(self, name):
+        """Get the statistics of a single hook"""
+        if name not in self.hooks:
+            self.hooks[name] = {
+                "processed": Rate(),
+                "failed": Rate(),
+                "skipped": Rate(),
+                "timeouts": Rate(),
+                "wait": Samples(),
+                "run": Samples(),
+            }
+        return self.hooks[name]
+
+    def _updates(self, bot_id):
+        """Get the statistics of the updates of a single bot"""
+        if bot_id not in self.updates:
+            self.updates[bot_id] = {
+                "last_fetched": None,
+                "last_processed": None,
+                "pending": 0,
+            }
+        return self.updates[bot_id]
+
+    def counted(self, command, func):
+        """Wrap an IPC command to count how many times it's called"""
+        self.commands[command] = Rate()
+        return CountedCommand(self.commands[command], func)
+
+    def job_put(self, job):
+        """Record a new job being put in the queue"""
+        if job.update_id is None:
+            return
+
+        updates = self._updates(job.bot_id)
+        updates["pending"] += 1
+        if updates["last_fetched"] is None or \
+           job.update_id > updates["last_fetched"]:
+            updates["last_fetched"] = job.update_id
+
+    def job_skipped(self, job, now=None):
+        """Record a job not put in the queue, since too many are running"""
+        self._hook(job.name)["skipped"].add(now=now)
+
+    def job_started(self, job, now=None):
+        """Record a job being sent to a worker"""
+        job.started_at = now if now is not None else time.time()
+        self._hook(job.name)["wait"].add(job.started_at - job.queued_at)
+
+    def job_timed_out(self, job, now=None):
+        """Record a job stopped because it ran for too long"""
+        self._hook(job.name)["timeouts"].add(now=now)
+        self.timeouts.add(now=now)
+
+    def job_done(self, job, failed=False, now=None):
+        """Record a job being completed by a worker"""
+        now = now if now is not None else time.time()
+
+        hook = self._hook(job.name)
+        hook["run"].add(now - job.started_at)
+        hook["processed"].add(now=now)
+        self.processed.add(now=now)
+        if failed:
+            hook["failed"].add(now=now)
+            self.failed.add(now=now)
+
+        if job.update_id is not None:
+            updates = self._updates(job.bot_id)
+            updates["pending"] -= 1
+            if updates["last_processed"] is None or \
+               job.update_id > updates["last_processed"]:
+                updates["last_processed"] = job.update_id
+
+    def export(self, now=None):
+        """Export all the statistics as a dict"""
+        return {
+            "processed": self.processed.export(now),
+            "failed": self.failed.export(now),
+            "timeouts": self.timeouts.export(now),
+            "hooks": {
+                name: {key: value.export() if key in ("wait", "run")
+                       else value.export(now)
+                       for key, value in hook.items()}
+                for name, hook in self.hooks.items()
+            },
+            "updates": {
+                bot_id: dict(updates)
+                for bot_id, updates in self.updates.items()
+            },
+            "ipc_commands": {
+                command: rate.export(now)
+                for command, rate in self.commands.items() if rate.total
+            },
+        }
+
+
+class CountedCommand:
+    """An IPC command which counts how many times it's called"""
+
+    # This is a class instead of a closure because it needs to be pickled
+    # when the IPC process is spawned
+
+    def __init__(self, rate, func):
+        self.rate = rate
+        self.func = func
+
+    def __call__(self, data, reply):
+        self.rate.add()
+        return self.func(data, reply)
+
+
+class StatsServer(http.server.HTTPServer):
+    """HTTP server exposing the statistics of the runner"""
+
+    def __init__(self, runner, address):
+        self.runner = runner
+        self.logger = logbook.Logger("botogram runner")
+
+        super(StatsServer, self).__init__(address, StatsRequestHandler)
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        """Serve the requests in the thread"""
+        self.serve_forever()
+
+    def start(self):
+        """Start serving the requests in a background thread"""
+        self.thread.start()
+        self.logger.debug("Statistics available at http://%s:%s/" %
+                          self.server_address[:2])
+
+    def stop(self):
+        """Stop serving the requests"""
+        self.shutdown()
+        self.thread.join()
+        self.server_close()
+
+
+class StatsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handle the requests to the statistics server"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/stats"):
+            self.send_error(404)
+            return
+
+        stats = self.server.runner.stats()
+        body = json.dumps(stats, indent=4).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't clutter the output of the runner
+        pass
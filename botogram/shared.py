@@ -18,15 +18,377 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import asyncio
+import atexit
+import collections
+import copy
 import threading
 import functools
 import builtins
+import heapq
+import itertools
+import pickle
+import sqlite3
+import time
 
+from . import utils
 
-class dict(builtins.dict):
+
+# Seconds between the writes of the changes to the database
+FLUSH_INTERVAL = 1
+
+# Seconds between the compactions of the database
+COMPACT_INTERVAL = 3600
+
+# How many times a transaction is attempted if it conflicts with other changes
+TRANSACTION_ATTEMPTS = 10
+
+# Seconds between the attempts to acquire a local lock from a coroutine
+LOCK_POLL_INTERVAL = 0.01
+
+# Methods of the memories with an *_async variant, since coroutines must not
+# block the event loop while waiting for the memory
+ASYNC_METHODS = ["get", "get_many", "set_many", "delete_many", "incr", "decr",
+                 "cas", "append", "setdefault", "pop", "transaction"]
+
+# Marker of the keys missing from a memory when it's stored
+_MISSING = object()
+
+
+class TransactionConflictError(Exception):
     pass
 
 
+class dict(builtins.dict):
+
+    # These methods are here so the same code works with the shared memory of
+    # the runner, where they need a single request to the IPC process
+
+    def get_many(self, keys):
+        """Get the values of multiple keys at once, skipping the missing
+        ones"""
+        return {key: self[key] for key in keys if key in self}
+
+    def set_many(self, items):
+        """Set the values of multiple keys at once"""
+        self.update(items)
+
+    def delete_many(self, keys):
+        """Delete multiple keys at once, returning how many existed"""
+        deleted = 0
+        for key in keys:
+            if key in self:
+                del self[key]
+                deleted += 1
+        return deleted
+
+    # Hooks can be called by multiple threads even without the runner, so
+    # these methods are atomic only if they hold this lock
+    _atomic_lock = threading.RLock()
+
+    def incr(self, key, amount=1, default=0):
+        """Add a number to the value of a key, returning the new value"""
+        with self._atomic_lock:
+            value = self.get(key, default) + amount
+            self[key] = value
+            return value
+
+    def decr(self, key, amount=1, default=0):
+        """Subtract a number from the value of a key, returning the new
+        value"""
+        return self.incr(key, -amount, default)
+
+    def cas(self, key, expected, value):
+        """Change the value of a key only if it's the expected one,
+        returning if it was changed"""
+        with self._atomic_lock:
+            if key not in self or self[key] != expected:
+                return False
+            self[key] = value
+            return True
+
+    def append(self, key, value):
+        """Append a value to the list stored in a key, returning its new
+        length"""
+        # The list is replaced instead of changed, so the transactions which
+        # read it notice the change
+        with self._atomic_lock:
+            items = copy.copy(self.get(key, []))
+            items.append(value)
+            self[key] = items
+            return len(items)
+
+    def setdefault(self, key, default=None):
+        with self._atomic_lock:
+            return super(dict, self).setdefault(key, default)
+
+    def pop(self, key, *default):
+        with self._atomic_lock:
+            return super(dict, self).pop(key, *default)
+
+    def transaction(self, func=None, attempts=TRANSACTION_ATTEMPTS):
+        """Change multiple keys at once, only if the keys read didn't change
+        in the meantime"""
+        return transaction(self, func, attempts)
+
+    def _transaction_read(self, keys):
+        """Get the values of some keys, and the versions to check them
+        against when committing"""
+        # Values are replaced when they're changed, so the objects themselves
+        # are the versions, while the transaction gets a copy it can change
+        # without touching the memory before committing
+        values = self.get_many(keys)
+        return {key: (value, copy.deepcopy(value))
+                for key, value in values.items()}
+
+    def _transaction_commit(self, versions, items, deleted):
+        """Apply the changes of a transaction, returning if it succeeded"""
+        with self._atomic_lock:
+            for key, version in versions.items():
+                if self.get(key, _MISSING) is not version:
+                    return False
+
+            self.set_many(items)
+            self.delete_many(deleted)
+            return True
+
+
+class Limiter:
+    """Keep track of the keys of a memory, to expire and evict them"""
+
+    # Expired and evicted keys are found with heaps, where the entries of the
+    # keys changed since they were pushed are just ignored
+
+    def __init__(self, ttl=None, max_keys=None, eviction="lru"):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.eviction = eviction
+
+        self._counter = itertools.count()
+        self._expires = {}
+        self._expires_heap = []
+        self._recent = collections.OrderedDict()
+        self._hits = {}
+        self._hits_heap = []
+
+    def read(self, key):
+        """Record a key was read"""
+        if self.max_keys is None:
+            return
+
+        if self.eviction == "lru":
+            if key in self._recent:
+                self._recent.move_to_end(key)
+        elif key in self._hits:
+            self._hits[key] += 1
+            self._push(self._hits_heap, self._hits[key], key)
+
+    def written(self, key, now=None):
+        """Record a key was written"""
+        if self.ttl is not None:
+            if now is None:
+                now = time.monotonic()
+            self._expires[key] = now + self.ttl
+            self._push(self._expires_heap, self._expires[key], key)
+
+        if self.max_keys is None:
+            return
+
+        if self.eviction == "lru":
+            self._recent[key] = None
+            self._recent.move_to_end(key)
+        else:
+            self._hits[key] = self._hits.get(key, 0) + 1
+            self._push(self._hits_heap, self._hits[key], key)
+
+    def removed(self, key):
+        """Forget about a key which was removed"""
+        self._expires.pop(key, None)
+        self._recent.pop(key, None)
+        self._hits.pop(key, None)
+
+    def cleared(self):
+        """Forget about all the keys"""
+        self._expires = {}
+        self._expires_heap = []
+        self._recent = collections.OrderedDict()
+        self._hits = {}
+        self._hits_heap = []
+
+    def _push(self, heap, priority, key):
+        """Push a key in a heap, rebuilding it if it's full of old entries"""
+        heapq.heappush(heap, (priority, next(self._counter), key))
+
+        if len(heap) > 2 * (len(self._expires) + len(self._hits)) + 64:
+            current = self._expires if heap is self._expires_heap \
+                else self._hits
+            heap[:] = [entry for entry in heap
+                       if current.get(entry[2]) == entry[0]]
+            heapq.heapify(heap)
+
+    def next_expiry(self):
+        """Get when the next key will expire, if any"""
+        while self._expires_heap:
+            expires, __, key = self._expires_heap[0]
+            if self._expires.get(key) == expires:
+                return expires
+            heapq.heappop(self._expires_heap)
+
+    def expired(self, now=None):
+        """Get the keys which expired"""
+        if now is None:
+            now = time.monotonic()
+
+        result = []
+        while True:
+            expires = self.next_expiry()
+            if expires is None or expires > now:
+                return result
+
+            key = heapq.heappop(self._expires_heap)[2]
+            self.removed(key)
+            result.append(key)
+
+    def overflowing(self, size):
+        """Get the keys to evict from a memory with the provided size"""
+        result = []
+        if self.max_keys is None:
+            return result
+
+        while size - len(result) > self.max_keys:
+            if self.eviction == "lru":
+                if not self._recent:
+                    break
+                key = next(iter(self._recent))
+            else:
+                if not self._hits_heap:
+                    break
+                hits, __, key = heapq.heappop(self._hits_heap)
+                if self._hits.get(key) != hits:
+                    continue
+
+            self.removed(key)
+            result.append(key)
+        return result
+
+
+class LimitedDict(dict):
+    """A shared memory with expiring keys and a maximum size"""
+
+    _limiter = None
+    _on_evict = None
+
+    def _limit(self, limiter, on_evict):
+        """Start enforcing the limits of the memory"""
+        self._limiter = limiter
+        self._on_evict = on_evict
+
+        for key in builtins.dict.keys(self):
+            limiter.written(key)
+        self._evict(limiter.overflowing(builtins.dict.__len__(self)),
+                    "evicted")
+
+    def _evict(self, keys, reason):
+        """Remove some keys, telling who needs to know about it"""
+        for key in keys:
+            # Removing the keys from the limiter first avoids evicting them
+            # again while they're removed
+            if builtins.dict.__contains__(self, key):
+                value = builtins.dict.__getitem__(self, key)
+                super(LimitedDict, self).pop(key)
+                self._changed([key])
+                self._on_evict(key, value, reason)
+
+    def _changed(self, keys):
+        """Called when some keys are changed by the memory itself"""
+        pass
+
+    def _expire(self):
+        """Remove the expired keys"""
+        if self._limiter.ttl is not None:
+            self._evict(self._limiter.expired(), "expired")
+
+    def _written(self, keys):
+        """Record some keys were written, evicting the extra ones"""
+        for key in keys:
+            self._limiter.written(key)
+        self._evict(
+            self._limiter.overflowing(builtins.dict.__len__(self)), "evicted",
+        )
+
+    def __getitem__(self, key):
+        self._expire()
+        value = super(LimitedDict, self).__getitem__(key)
+        self._limiter.read(key)
+        return value
+
+    def get(self, key, default=None):
+        self._expire()
+        if super(LimitedDict, self).__contains__(key):
+            self._limiter.read(key)
+        return super(LimitedDict, self).get(key, default)
+
+    def __contains__(self, key):
+        self._expire()
+        return super(LimitedDict, self).__contains__(key)
+
+    def __len__(self):
+        self._expire()
+        return super(LimitedDict, self).__len__()
+
+    def __iter__(self):
+        self._expire()
+        return super(LimitedDict, self).__iter__()
+
+    def keys(self):
+        self._expire()
+        return super(LimitedDict, self).keys()
+
+    def values(self):
+        self._expire()
+        return super(LimitedDict, self).values()
+
+    def items(self):
+        self._expire()
+        return super(LimitedDict, self).items()
+
+    def __setitem__(self, key, value):
+        self._expire()
+        super(LimitedDict, self).__setitem__(key, value)
+        self._written([key])
+
+    def __delitem__(self, key):
+        super(LimitedDict, self).__delitem__(key)
+        self._limiter.removed(key)
+
+    def update(self, *args, **kwargs):
+        self._expire()
+        items = builtins.dict(*args, **kwargs)
+        super(LimitedDict, self).update(items)
+        self._written(items.keys())
+
+    def setdefault(self, key, default=None):
+        with self._atomic_lock:
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+    def pop(self, key, *default):
+        self._expire()
+        result = super(LimitedDict, self).pop(key, *default)
+        self._limiter.removed(key)
+        return result
+
+    def popitem(self):
+        key, value = super(LimitedDict, self).popitem()
+        self._limiter.removed(key)
+        return key, value
+
+    def clear(self):
+        super(LimitedDict, self).clear()
+        self._limiter.cleared()
+
+
 class LocalDriver:
     """Local driver for the shared memory"""
 
@@ -34,32 +396,76 @@ class LocalDriver:
         self._memories = {}
         self._locks = {}
 
+        # Evicted keys are processed by the bot after the current update
+        self.evicted = collections.deque()
+
     def __reduce__(self):
         return rebuild_local_driver, (self.export_data(),)
 
-    def get(self, component):
+    def _create(self, memory_id, content=None):
+        """Create a new memory"""
+        if content is None:
+            content = {}
+        return dict(content)
+
+    def _create_limited(self, memory_id, content):
+        """Create a new memory which enforces some limits"""
+        return LimitedDict(content)
+
+    def get(self, component, limits=None):
         # Create the shared memory if it doesn't exist
         new = False
         if component not in self._memories:
-            self._memories[component] = dict()
+            self._memories[component] = self._create(component)
             new = True
 
-        return self._memories[component], new
+        # Memories are replaced by limited ones the first time the limits are
+        # provided
+        memory = self._memories[component]
+        if limits is not None and not isinstance(memory, LimitedDict):
+            memory = self._create_limited(component, memory)
+            memory._limit(
+                Limiter(limits["ttl"], limits["max_keys"],
+                        limits["eviction"]),
+                functools.partial(self._evicted, limits),
+            )
+            self._memories[component] = memory
 
-    def lock_acquire(self, lock_id):
+        return memory, new
+
+    def _evicted(self, limits, key, value, reason):
+        """Remember a key was evicted, if the bot needs to know about it"""
+        if limits["notify"]:
+            self.evicted.append((limits["component"], key, value, reason))
+
+    def _lock(self, lock_id):
         # Create a new lock if it doesn't exist yet
         if lock_id not in self._locks:
             self._locks[lock_id] = {"obj": threading.Lock(), "acquired": False}
+        return self._locks[lock_id]
+
+    def lock_acquire(self, lock_id):
+        lock = self._lock(lock_id)
+        lock["obj"].acquire()
+        lock["acquired"] = True
 
-        self._locks[lock_id]["obj"].acquire()
-        self._locks[lock_id]["acquired"] = True
+    async def lock_acquire_async(self, lock_id):
+        # Threading locks can't be awaited, so the lock is polled without
+        # blocking the event loop
+        lock = self._lock(lock_id)
+        while not lock["obj"].acquire(blocking=False):
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        lock["acquired"] = True
 
     def lock_release(self, lock_id):
         if lock_id not in self._locks:
             return
 
         self._locks[lock_id]["acquired"] = False
-        self._locks[lock_id].release()
+        self._locks[lock_id]["obj"].release()
+
+    async def lock_release_async(self, lock_id):
+        self.lock_release(lock_id)
 
     def lock_status(self, lock_id):
         if lock_id not in self._locks:
@@ -80,6 +486,372 @@ class LocalDriver:
         return {"storage": self._memories.copy(), "locks": locks}
 
 
+class SQLiteStore:
+    """Store the shared memories in a SQLite database"""
+
+    # The memories are kept in RAM, and only the keys changed since the last
+    # write are written to the database, in a single transaction
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL,
+                 compact_interval=COMPACT_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+
+        self._conn = None
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._next_flush = None
+        self._next_compact = None
+
+    def __reduce__(self):
+        return rebuild_store, (self.path, self.flush_interval,
+                               self.compact_interval)
+
+    def open(self):
+        """Open the database, returning the memories stored in it"""
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        # Space freed by the deleted keys can be reclaimed only if this is
+        # enabled before the table is created
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS shared ("
+                           "memory TEXT NOT NULL, "
+                           "key BLOB NOT NULL, "
+                           "value BLOB NOT NULL, "
+                           "PRIMARY KEY (memory, key))")
+        self._conn.commit()
+
+        now = time.monotonic()
+        self._next_flush = now + self.flush_interval
+        self._next_compact = now + self.compact_interval
+
+        memories = {}
+        for memory_id, key, value in self._conn.execute(
+            "SELECT memory, key, value FROM shared"
+        ):
+            memories.setdefault(memory_id, {})[pickle.loads(key)] = value
+        return memories
+
+    def changed(self, memory_id, keys):
+        """Remember some keys (or the whole memory if None) were changed"""
+        with self._lock:
+            if keys is None:
+                self._dirty[memory_id] = None
+            elif self._dirty.get(memory_id, set()) is not None:
+                self._dirty.setdefault(memory_id, set()).update(keys)
+
+    def tick(self, memories, dumps=None):
+        """Write the changes and compact the database if it's time to do so,
+        returning in how many seconds this should be called again"""
+        if self._conn is None:
+            return None
+
+        now = time.monotonic()
+        if now >= self._next_flush:
+            self.flush(memories, dumps)
+            self._next_flush = now + self.flush_interval
+        if now >= self._next_compact:
+            self.compact()
+            self._next_compact = now + self.compact_interval
+
+        return max(min(self._next_flush, self._next_compact) - now, 0)
+
+    def flush(self, memories, dumps=None):
+        """Write the keys changed since the last time to the database"""
+        with self._write_lock:
+            if self._conn is not None:
+                self._write(memories, dumps)
+
+    def _write(self, memories, dumps):
+        """Write the changed keys in a single transaction"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+
+        # Values are stored pickled, and the IPC process already has them so
+        if dumps is None:
+            dumps = _identity
+
+        with self._conn:
+            for memory_id, keys in dirty.items():
+                memory = memories.get(memory_id, {})
+
+                # Cleared memories are written again from scratch
+                if keys is None:
+                    self._conn.execute("DELETE FROM shared WHERE memory = ?",
+                                       (memory_id,))
+                    keys = list(memory.keys())
+
+                for key in keys:
+                    value = memory.get(key, _MISSING)
+                    if value is _MISSING:
+                        self._conn.execute(
+                            "DELETE FROM shared WHERE memory = ? AND key = ?",
+                            (memory_id, _dumps(key)),
+                        )
+                    else:
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO shared (memory, key, "
+                            "value) VALUES (?, ?, ?)",
+                            (memory_id, _dumps(key), dumps(value)),
+                        )
+
+    def compact(self):
+        """Shrink the database files, reclaiming the unused space"""
+        with self._write_lock:
+            if self._conn is not None:
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self._conn.execute("PRAGMA incremental_vacuum")
+
+    def close(self, memories, dumps=None):
+        """Write the last changes and close the database"""
+        with self._write_lock:
+            if self._conn is None:
+                return
+
+            self._write(memories, dumps)
+            self._conn.close()
+            self._conn = None
+
+
+class PersistentDict(dict):
+    """A shared memory which tells its store when it's changed"""
+
+    def __init__(self, memory_id, store, *args, **kwargs):
+        super(PersistentDict, self).__init__(*args, **kwargs)
+        self._memory_id = memory_id
+        self._store = store
+
+    def _changed(self, keys):
+        self._store.changed(self._memory_id, keys)
+
+    def __setitem__(self, key, value):
+        super(PersistentDict, self).__setitem__(key, value)
+        self._changed([key])
+
+    def __delitem__(self, key):
+        super(PersistentDict, self).__delitem__(key)
+        self._changed([key])
+
+    def update(self, *args, **kwargs):
+        items = builtins.dict(*args, **kwargs)
+        super(PersistentDict, self).update(items)
+        self._changed(list(items.keys()))
+
+    def setdefault(self, key, default=None):
+        with self._atomic_lock:
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+    def pop(self, key, *default):
+        result = super(PersistentDict, self).pop(key, *default)
+        self._changed([key])
+        return result
+
+    def popitem(self):
+        key, value = super(PersistentDict, self).popitem()
+        self._changed([key])
+        return key, value
+
+    def clear(self):
+        super(PersistentDict, self).clear()
+        self._changed(None)
+
+
+class PersistentLimitedDict(PersistentDict, LimitedDict):
+    """A shared memory which is both persistent and limited"""
+    pass
+
+
+class PersistentDriver(LocalDriver):
+    """Local driver storing the shared memory in a SQLite database"""
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        super(PersistentDriver, self).__init__()
+        self.path = path
+        self.flush_interval = flush_interval
+
+        # The database is opened only when the memory is used, so the runner
+        # can open it in its own process instead
+        self._store = None
+        self._stop = threading.Event()
+
+    def __reduce__(self):
+        return rebuild_persistent_driver, (self.path, self.flush_interval)
+
+    def _open(self):
+        """Load the content of the database"""
+        if self._store is not None:
+            return
+
+        self._store = SQLiteStore(self.path, self.flush_interval)
+        for memory_id, content in self._store.open().items():
+            content = {key: _loads(value) for key, value in content.items()}
+            self._memories[memory_id] = self._create(memory_id, content)
+
+        # Changes are written by a background thread, and when exiting
+        threading.Thread(target=_flush_loop, daemon=True, args=(
+            self._store, self._memories, self._stop,
+        )).start()
+        atexit.register(self.close)
+
+    def _create(self, memory_id, content=None):
+        if content is None:
+            content = {}
+        return PersistentDict(memory_id, self._store, content)
+
+    def _create_limited(self, memory_id, content):
+        return PersistentLimitedDict(memory_id, self._store, content)
+
+    def get(self, component, limits=None):
+        self._open()
+        return super(PersistentDriver, self).get(component, limits)
+
+    def import_data(self, data):
+        self._open()
+
+        # The imported memories are merged with the stored ones
+        for memory_id, content in data["storage"].items():
+            memory, __ = self.get(memory_id)
+            memory.update(content)
+
+        self._locks = {}
+        for lock_id in data["locks"]:
+            self.lock_acquire(lock_id)
+
+    def export_data(self):
+        # The content is left in the database, so the runner can load it in
+        # its own process
+        data = super(PersistentDriver, self).export_data()
+        data["storage"] = {}
+        self.close()
+
+        return data
+
+    def close(self):
+        """Write the last changes and close the database"""
+        if self._store is None:
+            return
+
+        self._stop.set()
+        self._store.close(self._memories, _dumps)
+
+        # The database is loaded again if the memory is used after this
+        self._store = None
+        self._memories = {}
+        self._stop = threading.Event()
+
+
+class Transaction:
+    """A group of changes to a shared memory, applied all at once"""
+
+    # The versions of the keys read are checked when committing, so the
+    # changes are applied only if no one else changed those keys
+
+    def __init__(self, memory):
+        self._memory = memory
+        self._versions = {}
+        self._values = {}
+        self._changed = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *__):
+        # Nothing is changed if the code inside the transaction failed
+        if exc_type is not None:
+            return
+
+        if not self.commit():
+            raise TransactionConflictError("Some keys read by the "
+                                           "transaction were changed")
+
+    def _fetch(self, keys):
+        """Fetch the keys which weren't read or written yet"""
+        missing = [key for key in keys if key not in self._values]
+        if not missing:
+            return
+
+        fetched = self._memory._transaction_read(missing)
+        for key in missing:
+            version, value = fetched.get(key, (_MISSING, _MISSING))
+            self._versions[key] = version
+            self._values[key] = value
+
+    def get_many(self, keys):
+        """Get the values of multiple keys at once, skipping the missing
+        ones"""
+        keys = list(keys)
+        self._fetch(keys)
+        return {key: self._values[key] for key in keys
+                if self._values[key] is not _MISSING}
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def __getitem__(self, key):
+        result = self.get_many([key])
+        if key not in result:
+            raise KeyError(key)
+        return result[key]
+
+    def __contains__(self, key):
+        return key in self.get_many([key])
+
+    def set_many(self, items):
+        """Set the values of multiple keys at once"""
+        for key, value in items.items():
+            self._values[key] = value
+            self._changed.add(key)
+
+    def update(self, *args, **kwargs):
+        self.set_many(builtins.dict(*args, **kwargs))
+
+    def __setitem__(self, key, value):
+        self.set_many({key: value})
+
+    def delete_many(self, keys):
+        """Delete multiple keys at once, returning how many existed"""
+        keys = list(keys)
+        self._fetch(keys)
+
+        deleted = 0
+        for key in keys:
+            if self._values[key] is not _MISSING:
+                self._values[key] = _MISSING
+                self._changed.add(key)
+                deleted += 1
+        return deleted
+
+    def __delitem__(self, key):
+        if not self.delete_many([key]):
+            raise KeyError(key)
+
+    def commit(self):
+        """Apply the changes, returning if the transaction succeeded"""
+        # There's nothing to check if nothing was changed
+        if not self._changed:
+            return True
+
+        items = {}
+        deleted = []
+        for key in self._changed:
+            if self._values[key] is _MISSING:
+                deleted.append(key)
+            else:
+                items[key] = self._values[key]
+
+        # Keys which were missing are checked too, since someone could have
+        # created them in the meantime
+        return self._memory._transaction_commit(self._versions, items,
+                                                deleted)
+
+
 class Lock:
     """Lock backed by the botogram's shared memory"""
 
@@ -93,17 +865,36 @@ class Lock:
 
     def acquire(self):
         """Acquire the lock"""
+        # Waiting for the lock would block the whole event loop, including
+        # the coroutine which has to release it
+        if _in_event_loop():
+            raise RuntimeError("Shared locks can't be acquired by blocking "
+                               "inside coroutines: use \"async with\" or "
+                               "acquire_async() instead")
         self._parent.driver.lock_acquire(self._lock_id)
 
     def release(self):
         """Release the lock"""
         self._parent.driver.lock_release(self._lock_id)
 
+    async def acquire_async(self):
+        """Acquire the lock without blocking the event loop"""
+        await self._parent.driver.lock_acquire_async(self._lock_id)
+
+    async def release_async(self):
+        """Release the lock without blocking the event loop"""
+        await self._parent.driver.lock_release_async(self._lock_id)
+
     __enter__ = acquire
 
     def __exit__(self, *__):
         self.release()
 
+    __aenter__ = acquire_async
+
+    async def __aexit__(self, *__):
+        await self.release_async()
+
 
 class SharedMemory:
     """Implementation of the shared memory for one bot"""
@@ -116,13 +907,41 @@ class SharedMemory:
 
         self._preparers = {}
 
+        # Bots and components have random IDs, so the shared memories are
+        # named after something which doesn't change after a restart
+        self._names = {}
+
+        # Limits of the memories of the components, and the components which
+        # want to know about the evicted keys
+        self._limits = {}
+        self._notified = set()
+
     def __reduce__(self):
-        return rebuild, (self.driver,)
+        return rebuild, (self.driver, self._names, self._limits,
+                         self._notified)
 
     def _key_of(self, *parts):
         """Get the key for a shared item"""
+        parts = [self._names.get(part, part) for part in parts[:2]] + \
+            list(parts[2:])
         return ":".join(parts)
 
+    def register_name(self, part_id, name):
+        """Register the stable name of a bot or a component"""
+        # Ignore the request if a name was already registered
+        if part_id in self._names:
+            return
+
+        # Components with the same name are numbered in the order they're used
+        taken = set(self._names.values())
+        unique = name
+        count = 1
+        while unique in taken:
+            count += 1
+            unique = "%s#%s" % (name, count)
+
+        self._names[part_id] = unique
+
     def register_preparers_list(self, component, inits):
         """Register a new list to pick preparers from"""
         # Ignore the request if a list was already registered
@@ -131,9 +950,31 @@ class SharedMemory:
 
         self._preparers[component] = inits
 
+    def register_limits(self, component, limits):
+        """Register the limits of the memory of a component"""
+        self._limits[component] = limits
+
+    def register_evicted_hooks(self, hooks):
+        """Register the hooks which want to know about the evicted keys"""
+        self._notified = {hook.component_id for hook in hooks}
+
+    def pop_evicted(self):
+        """Get the keys the driver evicted since the last call"""
+        evicted = getattr(self.driver, "evicted", None)
+        while evicted:
+            yield evicted.popleft()
+
     def of(self, bot, component, *other):
         """Get the shared memory of a specific component"""
-        memory, is_new = self.driver.get(self._key_of(bot, component, *other))
+        # Limits are enforced only on the standard shared memories
+        limits = None
+        if not other and self._limits.get(component) is not None:
+            limits = dict(self._limits[component], bot=bot,
+                          component=component,
+                          notify=component in self._notified)
+
+        memory, is_new = self.driver.get(self._key_of(bot, component, *other),
+                                         limits)
 
         # Treat as a standard shared memory only if no other names are provided
         if not other:
@@ -167,8 +1008,45 @@ class SharedMemory:
         return Lock(self, self._key_of(bot, component, name))
 
 
-def rebuild(driver):
-    return SharedMemory(driver)
+def transaction(memory, func=None, attempts=TRANSACTION_ATTEMPTS):
+    """Start a transaction on a memory, or run a function in one retrying it
+    if it conflicts with other changes"""
+    if func is None:
+        return Transaction(memory)
+
+    for __ in range(attempts):
+        tx = Transaction(memory)
+        result = func(tx)
+        if tx.commit():
+            return result
+
+    raise TransactionConflictError("The transaction conflicted with other "
+                                   "changes %s times" % attempts)
+
+
+for _cls in dict, LimitedDict, PersistentDict, PersistentLimitedDict:
+    utils.add_async_variants(_cls, ASYNC_METHODS)
+
+
+def _in_event_loop():
+    """Check if the current thread is running an event loop"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def rebuild(driver, names=None, limits=None, notified=None):
+    obj = SharedMemory(driver)
+    if names is not None:
+        obj._names = names
+    if limits is not None:
+        obj._limits = limits
+    if notified is not None:
+        obj._notified = notified
+
+    return obj
 
 
 def rebuild_local_driver(memories):
@@ -176,3 +1054,31 @@ def rebuild_local_driver(memories):
     obj.import_data(memories)
 
     return obj
+
+
+def rebuild_store(path, flush_interval, compact_interval):
+    return SQLiteStore(path, flush_interval, compact_interval)
+
+
+def _flush_loop(store, memories, stop):
+    """Periodically write the changes of a PersistentDriver to its database"""
+    while not stop.wait(store.tick(memories, _dumps)):
+        pass
+
+
+def rebuild_persistent_driver(path, flush_interval):
+    return PersistentDriver(path, flush_interval)
+
+
+def _identity(value):
+    return value
+
+
+def _dumps(value):
+    """Pickle a value stored in the database"""
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(value):
+    """Unpickle a value stored in the database"""
+    return pickle.loads(value)
@@ -18,30 +18,86 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import datetime
+import heapq
+import random
 import time
 
+from . import utils
+
+
+# The fields of a cron expression, with their allowed values
+CRON_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 7),
+)
+
+CRON_NAMES = {
+    "month": ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep",
+              "oct", "nov", "dec"],
+    "weekday": ["sun", "mon", "tue", "wed", "thu", "fri", "sat"],
+}
+
+CRON_ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+
+# Give up searching the next run of a cron expression after this many years
+CRON_MAX_YEARS = 5
+
+
+# What to do with the runs of a task due while too many are still running
+OVERLAP_POLICIES = ("skip", "coalesce")
+
 
 class BaseTask:
     """A basic task"""
 
-    def __init__(self, hook):
+    def __init__(self, hook, max_instances=None, overlap="skip"):
+        if overlap not in OVERLAP_POLICIES:
+            raise ValueError("Invalid overlap policy: %s" % overlap)
+        if max_instances is not None and max_instances < 1:
+            raise ValueError("A task must be allowed to run at least once")
+
         self.hook = hook
+        self.max_instances = max_instances
+        self.overlap = overlap
 
     def process(self, bot):
         """Process the task"""
-        if hasattr(self.hook, "call"):
-            return self.hook.call(bot)
+        return utils.drive(self.steps(bot))
+
+    def steps(self, bot):
+        """Process the task, yielding the coroutines it needs to wait for"""
+        if hasattr(self.hook, "steps"):
+            return (yield from self.hook.steps(bot))
         return self.hook(bot)
 
 
 class TimerTask(BaseTask):
     """Representation of a single timer"""
 
-    def __init__(self, interval, hook):
+    def __init__(self, interval, hook, jitter=0, max_instances=1,
+                 overlap="skip"):
         self.interval = interval
+        self.jitter = jitter
         self.last_run = -interval
+        self._delay = 0
 
-        super(TimerTask, self).__init__(hook)
+        super(TimerTask, self).__init__(hook, max_instances, overlap)
+
+    def next_run(self, current=None):
+        """Return when the timer should be ran next"""
+        return self.last_run + self.interval + self._delay
 
     def now(self, current=None):
         """Check if the timer should be ran now"""
@@ -49,15 +105,174 @@ class TimerTask(BaseTask):
         if current is None:
             current = time.time()
 
-        res = self.last_run + self.interval <= current
+        res = self.next_run(current) <= current
 
         # Increment the last_run if the result is True
         if res:
             self.last_run = current
+            if self.jitter:
+                self._delay = random.uniform(0, self.jitter)
+
+        return res
+
+
+class CronTask(BaseTask):
+    """A task executed when the current time matches a cron expression"""
+
+    def __init__(self, expression, hook, jitter=0, max_instances=1,
+                 overlap="skip"):
+        self.expression = expression
+        self.jitter = jitter
+        self.rule = CronRule(expression)
+
+        self._match = None
+        self._delay = 0
+
+        super(CronTask, self).__init__(hook, max_instances, overlap)
+
+    def _schedule(self, after):
+        """Schedule the next run after the provided time"""
+        self._match = self.rule.next_match(after)
+        if self.jitter:
+            self._delay = random.uniform(0, self.jitter)
+
+    def next_run(self, current=None):
+        """Return when the task should be ran next"""
+        if self._match is None:
+            if current is None:
+                current = time.time()
+            self._schedule(current)
+
+        return self._match + self._delay
+
+    def now(self, current=None):
+        """Check if the task should be ran now"""
+        # Allow to provide a dummy time
+        if current is None:
+            current = time.time()
+
+        res = self.next_run(current) <= current
+
+        # Runs missed while the bot was busy or stopped are skipped
+        if res:
+            self._schedule(max(self._match, current - self.jitter))
 
         return res
 
 
+class CronRule:
+    """A parsed cron expression"""
+
+    def __init__(self, expression):
+        self.expression = expression
+
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError("A cron expression must have %s fields: %s" % (
+                len(CRON_FIELDS), expression,
+            ))
+
+        parsed = {}
+        for value, (name, low, high) in zip(fields, CRON_FIELDS):
+            parsed[name] = _parse_cron_field(value, name, low, high)
+
+        self.minutes = parsed["minute"]
+        self.hours = parsed["hour"]
+        self.days = parsed["day"]
+        self.months = parsed["month"]
+        # Both 0 and 7 are sunday
+        self.weekdays = frozenset(day % 7 for day in parsed["weekday"])
+
+        # If both the day and the weekday are restricted, matching any of
+        # them is enough, like in cron (which considers a field starting
+        # with "*", such as "*/2", not restricted)
+        self._any_day = fields[2].startswith("*")
+        self._any_weekday = fields[4].startswith("*")
+
+        # Reject expressions which can never match, such as February 30th
+        self.next_match(time.time())
+
+    def _day_matches(self, date):
+        """Check if the rule matches the provided day"""
+        day = date.day in self.days
+        weekday = (date.weekday() + 1) % 7 in self.weekdays
+
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_match(self, after):
+        """Return the first time after the provided one matching the rule"""
+        date = datetime.datetime.fromtimestamp(after).replace(
+            second=0, microsecond=0,
+        ) + datetime.timedelta(minutes=1)
+        limit = date.year + CRON_MAX_YEARS
+
+        while date.year <= limit:
+            if date.month not in self.months:
+                if date.month == 12:
+                    date = date.replace(year=date.year + 1, month=1)
+                else:
+                    date = date.replace(month=date.month + 1)
+                date = date.replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(date):
+                date = date.replace(hour=0, minute=0)
+                date += datetime.timedelta(days=1)
+            elif date.hour not in self.hours:
+                date = date.replace(minute=0)
+                date += datetime.timedelta(hours=1)
+            elif date.minute not in self.minutes:
+                date += datetime.timedelta(minutes=1)
+            else:
+                return date.timestamp()
+
+        raise ValueError("The cron expression never matches: %s" %
+                         self.expression)
+
+
+def _parse_cron_field(value, name, low, high):
+    """Parse a single field of a cron expression"""
+    names = CRON_NAMES.get(name, [])
+
+    def convert(item):
+        item = item.lower()
+        if item in names:
+            return names.index(item) + (1 if name == "month" else 0)
+        try:
+            return int(item)
+        except ValueError:
+            raise ValueError("Invalid %s in a cron expression: %s" % (
+                name, item,
+            ))
+
+    result = set()
+    for part in value.split(","):
+        step = None
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = convert(step)
+
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (convert(item) for item in part.split("-", 1))
+        else:
+            start = convert(part)
+            # "5/15" means every 15 starting from 5
+            end = start if step is None else high
+
+        if step is None:
+            step = 1
+        if step < 1 or start < low or end > high or start > end:
+            raise ValueError("Invalid %s in a cron expression: %s" % (
+                name, value,
+            ))
+
+        result.update(range(start, end + 1, step))
+
+    return frozenset(result)
+
+
 class Scheduler:
     """Schedule all the tasks"""
 
@@ -68,6 +283,17 @@ class Scheduler:
         self.tasks = []
         self.tasks_lists.append(self.tasks)
 
+        # Tasks are kept in a heap ordered by their next run, along with the
+        # order they were added in. New tasks are added to the heap lazily,
+        # since the lists can change after they're registered
+        self._heap = []
+        self._synced = []
+        self._added = 0
+
+        # Tasks can share the same name, so they're told apart by their
+        # position, which is the same after a restart
+        self._keys = {}
+
     def add(self, task):
         """Add a task to the scheduler"""
         self.tasks.append(task)
@@ -76,15 +302,55 @@ class Scheduler:
         """Register a new list of tasks"""
         self.tasks_lists.append(tasks)
 
+    def _sync(self, current):
+        """Add to the heap the tasks added to the lists"""
+        for i, tasks in enumerate(self.tasks_lists):
+            if i == len(self._synced):
+                self._synced.append(0)
+            if self._synced[i] == len(tasks):
+                continue
+
+            for j, task in enumerate(tasks[self._synced[i]:],
+                                     self._synced[i]):
+                heapq.heappush(self._heap, (
+                    task.next_run(current), self._added, task,
+                ))
+                self._keys[id(task)] = "%s.%s" % (i, j)
+                self._added += 1
+            self._synced[i] = len(tasks)
+
+    def task_key(self, task):
+        """Return the key identifying a task returned by the scheduler"""
+        return self._keys[id(task)]
+
+    def next_run(self, current=None):
+        """Return when the next task should be scheduled"""
+        # Allow to provide a dummy time
+        if current is None:
+            current = time.time()
+
+        self._sync(current)
+        if self._heap:
+            return self._heap[0][0]
+
     def now(self, current=None):
         """Return which tasks should be scheduled now"""
         # Allow to provide a dummy time
         if current is None:
             current = time.time()
 
-        # Return all the tasks which should be executed now
-        for tasks in self.tasks_lists:
-            for task in tasks:
-                if not task.now(current):
-                    continue
-                yield task
+        self._sync(current)
+
+        popped = []
+        while self._heap and self._heap[0][0] <= current:
+            popped.append(heapq.heappop(self._heap))
+
+        # Return all the tasks which should be executed now, in the order
+        # they were added
+        result = []
+        for __, order, task in sorted(popped, key=lambda item: item[1]):
+            if task.now(current):
+                result.append(task)
+            heapq.heappush(self._heap, (task.next_run(current), order, task))
+
+        return result
@@ -38,13 +38,13 @@ class AnotherInstanceRunningError(FetchError):
 class UpdatesFetcher:
     """Logic for fetching updates"""
 
-    def __init__(self, bot):
+    def __init__(self, bot, process_backlog=False):
         self._bot = bot
         self._last_id = -1
         self._backlog_processed = False
 
         # Don't treat backlog as backlog if bot.process_backlog is True
-        if bot.process_backlog:
+        if bot.process_backlog or process_backlog:
             self._backlog_processed = True
 
     def _fetch_updates(self, timeout):
@@ -89,6 +89,25 @@ class UpdatesFetcher:
 
         return updates
 
+    def rewind(self):
+        """Fetch again all the updates which weren't confirmed yet"""
+        self._last_id = -1
+
+    def confirm(self):
+        """Tell Telegram the updates fetched so far were received"""
+        # Otherwise they would be sent again to the next instance of the bot
+        if self._last_id < 1:
+            return
+
+        try:
+            self._bot.api.call("getUpdates", {
+                "offset": self._last_id + 1,
+                "limit": 1,
+                "timeout": 0,
+            })
+        except api.APIError:
+            pass
+
     def block_until_alone(self, treshold=4, check_timeout=1, when_stop=None):
         """Returns when this one is the only instance of the bot"""
         checks_count = 0
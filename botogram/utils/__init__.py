@@ -23,4 +23,7 @@
 from .deprecations import deprecated, DeprecatedAttributes, warn
 from .strings import strip_urls, usernames_in
 from .startup import get_language, configure_logger
-from .calls import wraps, CallLazyArgument, call
+from .calls import wraps, CallLazyArgument, call, call_steps
+from .coroutines import run_coroutine, set_coroutines_loop, \
+    set_coroutines_executor, set_coroutines_timeout, add_async_variants, \
+    drive, drive_async
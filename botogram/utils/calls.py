@@ -22,6 +22,8 @@ import inspect
 
 import functools
 
+from .coroutines import drive
+
 
 def wraps(func):
     """Update a wrapper function to looks like the wrapped one"""
@@ -52,6 +54,12 @@ class CallLazyArgument:
 
 def call(func, **available):
     """Call a function with a dynamic set of arguments"""
+    return drive(call_steps(func, **available))
+
+
+def call_steps(func, **available):
+    """Call a function with a dynamic set of arguments, yielding the
+    coroutine it returns (if any) to wait for it"""
     # Get the correct function signature
     # _botogram_original_signature contains the signature used before wrapping
     # a function with @utils.wraps, so the arguments gets resolved correctly
@@ -73,4 +81,10 @@ def call(func, **available):
 
         kwargs[name] = arg
 
-    return func(**kwargs)
+    result = func(**kwargs)
+
+    # Coroutine functions are run until they complete, so hooks can use their
+    # return value as they do with normal functions
+    if inspect.iscoroutine(result):
+        result = yield result
+    return result
@@ -0,0 +1,206 @@
+# Copyright (c) 2015-2019 The Botogram Authors (see AUTHORS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import time
+
+
+# The event loop coroutines are run into, if one is running in this process
+_loop = None
+
+# The executor the *_async methods run into (None for the default one)
+_executor = None
+
+# When the coroutines run by the current thread must be cancelled, if ever
+_deadline = contextvars.ContextVar("botogram_deadline", default=None)
+
+
+def set_coroutines_loop(loop):
+    """Run all the coroutines called by botogram in the provided event loop"""
+    global _loop
+    _loop = loop
+
+
+def set_coroutines_executor(executor):
+    """Run the *_async methods in the provided executor"""
+    global _executor
+    _executor = executor
+
+
+def set_coroutines_timeout(timeout):
+    """Cancel the coroutines run by the current thread if they're still
+    running after the provided number of seconds (None to never cancel)"""
+    if timeout is not None:
+        timeout = time.monotonic() + timeout
+    _deadline.set(timeout)
+
+
+def _remaining():
+    """Get how many seconds the coroutines can still run for"""
+    deadline = _deadline.get()
+    if deadline is not None:
+        return max(deadline - time.monotonic(), 0)
+
+
+async def _in_context(context, coro):
+    """Run a coroutine with the content of the provided context"""
+    # The task has its own copy of the context, so this doesn't leak to other
+    # coroutines running in the same event loop
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+
+def run_coroutine(coro):
+    """Run a coroutine until it completes, and return its result"""
+    timeout = _remaining()
+
+    # Without a shared event loop, just create a new one for this coroutine
+    if _loop is None or not _loop.is_running():
+        if timeout is None:
+            return asyncio.run(coro)
+
+        try:
+            return asyncio.run(asyncio.wait_for(coro, timeout))
+        except asyncio.TimeoutError:
+            raise TimeoutError("The coroutine was cancelled after the "
+                               "timeout expired") from None
+
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is _loop:
+        coro.close()
+        raise RuntimeError("Can't wait for a coroutine from the event loop "
+                           "running it")
+
+    # The coroutine runs in the event loop, while the current thread waits for
+    # it to complete: this way a lot of coroutines can wait for I/O at once
+    context = contextvars.copy_context()
+    future = asyncio.run_coroutine_threadsafe(_in_context(context, coro),
+                                              _loop)
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        # The coroutine might have completed in the meantime
+        if not future.cancel() and future.done() and \
+           not future.cancelled():
+            return future.result()
+        raise TimeoutError("The coroutine was cancelled after the timeout "
+                           "expired") from None
+
+
+def drive(steps):
+    """Run the steps of a processing until it completes, waiting for the
+    coroutines it yields, and return its result"""
+    value, error = None, None
+    while True:
+        try:
+            if error is not None:
+                coro = steps.throw(error)
+            else:
+                coro = steps.send(value)
+        except StopIteration as e:
+            return e.value
+
+        value, error = None, None
+        try:
+            value = run_coroutine(coro)
+        except Exception as e:
+            error = e
+
+
+def _step(steps, value, error):
+    """Run a single step of a processing, returning if it completed and the
+    coroutine it yielded (or its result)"""
+    # StopIteration can't be raised into a future, so it's returned instead
+    try:
+        if error is not None:
+            return False, steps.throw(error)
+        return False, steps.send(value)
+    except StopIteration as e:
+        return True, e.value
+
+
+async def drive_async(steps, executor=None):
+    """Run the steps of a processing until it completes, awaiting the
+    coroutines it yields, and return its result"""
+    loop = asyncio.get_running_loop()
+
+    # The normal code runs in the executor, so it doesn't block the event loop
+    # while it's waiting for something, and it always sees the same context
+    context = contextvars.copy_context()
+    value, error = None, None
+    while True:
+        done, result = await loop.run_in_executor(
+            executor, context.run, _step, steps, value, error,
+        )
+        if done:
+            return result
+
+        value, error = None, None
+        try:
+            value = await _in_context(context, _with_timeout(
+                result, context.run(_remaining),
+            ))
+        except Exception as e:
+            error = e
+
+
+async def _with_timeout(coro, timeout):
+    """Await a coroutine, cancelling it after the timeout expires"""
+    if timeout is None:
+        return await coro
+
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError("The coroutine was cancelled after the timeout "
+                           "expired") from None
+
+
+def _async_variant(func):
+    """Create a coroutine function calling the provided one in a thread"""
+    @functools.wraps(func)
+    async def __(*args, **kwargs):
+        # The current context is copied, so the method sees the same botogram
+        # context the coroutine is running in
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(_executor,
+                                                                call)
+
+    __.__name__ = func.__name__ + "_async"
+    __.__qualname__ = func.__qualname__ + "_async"
+    return __
+
+
+def add_async_variants(cls, names=None):
+    """Add a *_async variant of the public methods of a class"""
+    if names is None:
+        names = [name for name, value in vars(cls).items()
+                 if not name.startswith("_") and callable(value)]
+
+    for name in names:
+        setattr(cls, name + "_async", _async_variant(getattr(cls, name)))
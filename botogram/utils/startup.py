@@ -20,6 +20,7 @@
 
 import os
 import sys
+import functools
 import gettext
 
 import pkg_resources
@@ -30,6 +31,8 @@ import logbook
 _logger_configured = False
 
 
+# Frozen bots are created often, so the translations are loaded only once
+@functools.lru_cache()
 def get_language(lang):
     """Get the GNUTranslations instance of a specific language"""
     path = pkg_resources.resource_filename("botogram", "i18n/%s.mo" % lang)
@@ -54,6 +54,8 @@ setuptools.setup(
         "botogram.utils",
     ],
 
+    python_requires = ">=3.7",
+
     install_requires = [
         "requests",
         "logbook",
@@ -68,6 +70,9 @@ setuptools.setup(
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
         "Topic :: Communications :: Chat",
         "Topic :: Software Development :: Libraries :: Application Frameworks",
     ],
@@ -18,6 +18,8 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import threading
+
 import pytest
 
 import botogram.api
@@ -172,3 +174,16 @@ def test_unavailable_chats_take2(api, mock_req):
         api.call("forwardMessage", {"chat_id": 123})
     assert e.value.chat_id == 123
     assert e.value.reason == "chat_moved"
+
+
+def test_sessions_per_thread(api):
+    main_session = api._session()
+    assert api._session() is main_session
+
+    # Other threads must receive their own session
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(api._session()))
+    thread.start()
+    thread.join()
+
+    assert sessions[0] is not main_session
@@ -95,3 +95,41 @@ def test_i18n_override(bot):
 
     assert bot._("Use /help to get a list of all the commands.") \
         == default_message
+
+
+def test_shared_database(bot, tmp_path):
+    path = str(tmp_path / "shared.db")
+    bot.shared_database = path
+    assert bot.shared_database == path
+
+    # Shared memories are named after the bot ID and the components
+    comp = botogram.components.Component("comp")
+    bot.use(comp)
+    shared = bot._shared_memory
+    assert shared._key_of(bot._bot_id, comp._component_id) == "123456789:comp"
+
+    shared.of(bot._bot_id, comp._component_id)["a"] = 1
+    bot.shared_database = None
+    assert bot.shared_database is None
+
+    bot.shared_database = path
+    assert shared.of(bot._bot_id, comp._component_id)["a"] == 1
+    shared.driver.close()
+
+
+def test_memory_limits(bot, sample_update):
+    bot.set_memory_limits(max_keys=1)
+    evicted = []
+
+    @bot.process_message
+    def store(shared, chat, message):
+        shared["a"] = 1
+        shared["b"] = 2
+
+    @bot.memory_evicted
+    def notify(shared, key, value, reason):
+        # The hook is called after the update is processed
+        evicted.append((key, value, reason, dict(shared)))
+
+    bot.process(sample_update)
+    assert evicted == [("a", 1, "evicted", {"b": 2})]
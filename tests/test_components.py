@@ -20,7 +20,10 @@
 
 import copy
 
+import pytest
+
 import botogram.components
+import botogram.shared
 
 
 def test_add_before_processing_hook(bot, sample_update):
@@ -386,3 +389,17 @@ def test_add_timer(bot):
     assert timer1_calls == 10  # 0, 1, 2, 3, 4, 5, 6, 7, 8, 9
     assert timer2_calls == 4   # 0, 3, 6, 9
     assert timer3_calls == 1   # 0
+
+
+def test_set_memory_limits(bot):
+    comp = botogram.Component("test")
+    with pytest.raises(ValueError):
+        comp.set_memory_limits(max_keys=0)
+    with pytest.raises(ValueError):
+        comp.set_memory_limits(ttl=10, eviction="random")
+
+    comp.set_memory_limits(ttl=10)
+    bot.use(comp)
+
+    memory = bot._shared_memory.of(bot._bot_id, comp._component_id)
+    assert isinstance(memory, botogram.shared.LimitedDict)
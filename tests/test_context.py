@@ -0,0 +1,47 @@
+# Copyright (c) 2015-2019 The Botogram Authors (see AUTHORS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+
+import botogram.context
+import botogram.utils
+
+
+def test_context_stack():
+    assert botogram.context.ctx() is None
+
+    outer = botogram.context.Context(None, None, None)
+    inner = botogram.context.Context(None, None, None)
+    with outer:
+        assert botogram.context.ctx() is outer
+        with inner:
+            assert botogram.context.ctx() is inner
+        assert botogram.context.ctx() is outer
+
+    assert botogram.context.ctx() is None
+
+
+def test_context_in_coroutines():
+    context = botogram.context.Context(None, None, None)
+
+    async def check():
+        return botogram.context.ctx()
+
+    # Coroutines started inside a context must see it
+    with context:
+        assert botogram.utils.call(check) is context
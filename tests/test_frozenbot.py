@@ -96,3 +96,12 @@ def test_pickle_frozenbot(frozenbot):
     # This will pickle and unpickle the frozen bot
     pickled = pickle.loads(pickle.dumps(frozenbot))
     assert frozenbot == pickled
+
+
+def test_schedule_outside_runner(frozenbot):
+    def reminder(bot):
+        pass
+
+    # Functions can't be scheduled without a runner to process them
+    with pytest.raises(RuntimeError):
+        frozenbot.schedule_in(10, reminder)
@@ -0,0 +1,106 @@
+# Copyright (c) 2015-2019 The Botogram Authors (see AUTHORS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+
+import time
+
+import botogram.runner.backends
+import botogram.runner.jobs
+
+
+def make_commands(path, bot):
+    backend = botogram.runner.backends.SQLiteBackend(str(path))
+    backend.open({bot._bot_id: bot})
+    return botogram.runner.jobs.JobsCommands(backend=backend)
+
+
+def test_sqlite_backend(tmp_path, bot):
+    frozenbot = bot.freeze()
+    path = tmp_path / "jobs.db"
+    commands = make_commands(path, frozenbot)
+
+    jobs = [botogram.runner.jobs.Job(frozenbot._bot_id, None, {"value": i})
+            for i in range(3)]
+    commands.bulk_put(jobs, lambda *_: None)
+    assert [job.id for job in jobs] == [1, 2, 3]
+
+    # The first job is completed, and the second one is being processed
+    commands.get((0, 0), lambda *_: None)
+    commands.get((0, 0), lambda *_: None)
+
+    # Workers aren't waiting for the queue to be drained when shutting down
+    replies = []
+    commands.shutdown(None, lambda *_: None)
+    commands.get((1, 0), lambda data: replies.append(data))
+    assert replies == ["__stop__"]
+    commands.backend.close()
+
+    # After a restart the bot ID is different
+    bot._bot_id = "new-id"
+    commands = make_commands(path, bot.freeze())
+    assert commands.resume() == 2
+
+    replies = []
+    commands.get((0, 0), lambda data: replies.append(data))
+    commands.get((0, 0), lambda data: replies.append(data))
+    assert [job.metadata["value"] for job in replies] == [1, 2]
+    assert [job.bot_id for job in replies] == ["new-id", "new-id"]
+    commands.backend.close()
+
+
+def test_sqlite_backend_delayed(tmp_path, bot):
+    frozenbot = bot.freeze()
+    path = tmp_path / "jobs.db"
+    commands = make_commands(path, frozenbot)
+
+    job = botogram.runner.jobs.Job(frozenbot._bot_id, None, {"value": 1},
+                                   run_at=time.time() + 3600)
+    commands.schedule(job, lambda *_: None)
+    commands.backend.close()
+
+    # Delayed jobs are still delayed after a restart
+    commands = make_commands(path, frozenbot)
+    assert commands.resume() == 1
+    assert len(commands.queue) == 0
+    assert commands.dispatch_delayed() > 3500
+    assert commands.dispatch_delayed(now=time.time() + 3600) is None
+    assert len(commands.queue) == 1
+
+
+def test_sqlite_backend_timers(tmp_path, bot):
+    frozenbot = bot.freeze()
+    path = tmp_path / "jobs.db"
+    commands = make_commands(path, frozenbot)
+
+    job = botogram.runner.jobs.Job(frozenbot._bot_id, None, {"value": 1},
+                                   instances_key=(frozenbot._bot_id, "1.0"),
+                                   max_instances=1)
+    commands.bulk_put([job], lambda *_: None)
+    commands.backend.close()
+
+    # The limit of the resumed timers applies to the new bot ID
+    bot._bot_id = "new-id"
+    commands = make_commands(path, bot.freeze())
+    assert commands.resume() == 1
+    assert commands.instances == {("new-id", "1.0"): 1}
+
+    replies = []
+    commands.get((0, 0), lambda data: replies.append(data))
+    assert replies[0].instances_key == ("new-id", "1.0")
+    commands.backend.close()
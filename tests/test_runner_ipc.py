@@ -0,0 +1,187 @@
+# Copyright (c) 2015-2019 The Botogram Authors (see AUTHORS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+
+import pickle
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import botogram.runner.ipc
+
+
+@pytest.fixture()
+def server(request):
+    server = botogram.runner.ipc.IPCServer(("127.0.0.1", 0), "secret")
+    server.register_command("echo", lambda data, reply: reply(data))
+
+    # Replies to this are sent only after the next "wake" command
+    waiting = []
+    server.register_command("wait", lambda data, reply: waiting.append(reply))
+
+    def wake(data, reply):
+        for waiting_reply in waiting:
+            waiting_reply(data)
+        reply(len(waiting))
+        waiting.clear()
+    server.register_command("wake", wake)
+
+    thread = threading.Thread(target=server.run)
+    thread.start()
+
+    def stop():
+        client = botogram.runner.ipc.IPCClient(server.port, "secret",
+                                               "127.0.0.1")
+        client.command("__stop__", server.stop_key)
+        client.close()
+        thread.join()
+    request.addfinalizer(stop)
+
+    return server
+
+
+def test_ipc_commands(server):
+    client = botogram.runner.ipc.IPCClient(server.port, "secret", "127.0.0.1")
+    assert client.command("echo", {"a": 1}) == {"a": 1}
+
+    with pytest.raises(botogram.runner.ipc.IPCError):
+        client.command("missing", None)
+    client.close()
+
+
+def test_ipc_authentication(server):
+    with pytest.raises(botogram.runner.ipc.IPCError):
+        botogram.runner.ipc.IPCClient(server.port, "wrong", "127.0.0.1")
+
+    # The server still works after a failed authentication
+    client = botogram.runner.ipc.IPCClient(server.port, "secret", "127.0.0.1")
+    assert client.command("echo", 1) == 1
+    client.close()
+
+
+def test_ipc_pipelining(server):
+    client = botogram.runner.ipc.IPCClient(server.port, "secret", "127.0.0.1")
+
+    # Commands waiting for a response don't block the other ones
+    first = client.send("wait", None)
+    second = client.send("wait", None)
+    assert client.command("echo", 1) == 1
+    assert not first.done() and not second.done()
+
+    assert client.command("wake", "woken") == 2
+    assert first.result() == "woken"
+    assert second.result() == "woken"
+    client.close()
+
+
+def test_ipc_threads(server):
+    client = botogram.runner.ipc.IPCClient(server.port, "secret", "127.0.0.1")
+
+    # Each thread receives the responses to its own commands
+    results = {}
+
+    def run(index):
+        results[index] = [client.command("echo", (index, i))
+                          for i in range(50)]
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for index in range(4):
+        assert results[index] == [(index, i) for i in range(50)]
+    client.close()
+
+
+def test_ipc_crash(server):
+    client = botogram.runner.ipc.IPCClient(server.port, "secret", "127.0.0.1")
+    future = client.send("wait", None)
+
+    # The commands waiting for a response fail when the connection is lost
+    client.close()
+    with pytest.raises(botogram.runner.ipc.IPCServerCrashedError):
+        future.result()
+    with pytest.raises(botogram.runner.ipc.IPCServerCrashedError):
+        client.send("echo", None)
+
+
+
+def test_ipc_reply_disconnected(server):
+    dead = botogram.runner.ipc.IPCClient(server.port, "secret", "127.0.0.1")
+    dead.send("wait", None)
+    dead.close()
+
+    # Wait for the server to notice the client disconnected
+    client = botogram.runner.ipc.IPCClient(server.port, "secret", "127.0.0.1")
+    time.sleep(0.1)
+    assert client.command("echo", 1) == 1
+
+    # Replying to the disconnected client doesn't break the other replies
+    first = client.send("wake", None)
+    second = client.send("echo", 2)
+    assert first.result() == 1
+    assert second.result() == 2
+    client.close()
+
+
+def raw_client(server):
+    """Connect to the server without the IPC client"""
+    conn = socket.create_connection(("127.0.0.1", server.port))
+    botogram.runner.ipc.write_raw_packet(conn, b"secret")
+    assert botogram.runner.ipc.read_packet(conn)["ok"]
+    return conn
+
+
+def test_ipc_slow_client(server):
+    # This client never reads the responses to its commands
+    slow = raw_client(server)
+    slow.setblocking(False)
+    try:
+        for i in range(100):
+            botogram.runner.ipc.write_packet(slow, {
+                "id": i, "command": "echo", "data": b"x" * 100000,
+            })
+    except BlockingIOError:
+        pass
+
+    # The other clients still receive their responses
+    client = botogram.runner.ipc.IPCClient(server.port, "secret", "127.0.0.1")
+    assert client.command("echo", 1) == 1
+    client.close()
+    slow.close()
+
+
+def test_ipc_partial_packets(server):
+    partial = raw_client(server)
+    packet = pickle.dumps({"id": 0, "command": "echo", "data": "partial"})
+    data = struct.pack("!I", len(packet)) + packet
+
+    # The server doesn't wait for the rest of the packet
+    partial.sendall(data[:10])
+    client = botogram.runner.ipc.IPCClient(server.port, "secret", "127.0.0.1")
+    assert client.command("echo", 1) == 1
+    client.close()
+
+    partial.sendall(data[10:])
+    assert botogram.runner.ipc.read_packet(partial)["data"] == "partial"
+    partial.close()
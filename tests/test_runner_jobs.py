@@ -0,0 +1,480 @@
+# Copyright (c) 2015-2019 The Botogram Authors (see AUTHORS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+
+import asyncio
+import pickle
+
+import pytest
+
+import botogram.runner.jobs
+import botogram.utils
+
+
+class Replies:
+    """Collect the replies sent by the IPC commands"""
+
+    def __init__(self):
+        self.replies = []
+
+    def __call__(self, data, ok=True):
+        self.replies.append(data)
+        return True
+
+    @property
+    def last(self):
+        return self.replies[-1]
+
+
+def dummy_job(value):
+    return botogram.runner.jobs.Job("bot", None, {"value": value})
+
+
+def test_job_payload(sample_update):
+    job = botogram.runner.jobs.Job("bot", len, {"update": sample_update})
+    assert job.update_id == 1
+
+    # The payload is unpickled only when it's needed
+    forwarded = pickle.loads(pickle.dumps(job))
+    assert "_metadata" not in forwarded.__dict__
+    assert forwarded.update_id == 1
+
+    # Forwarding the job again doesn't need the unpickled payload
+    received = pickle.loads(pickle.dumps(forwarded))
+    assert received.func is len
+    assert received.metadata["update"].update_id == 1
+
+
+def test_jobs_queue():
+    commands = botogram.runner.jobs.JobsCommands()
+    reply = Replies()
+
+    job1 = dummy_job(1)
+    job2 = dummy_job(2)
+    commands.bulk_put([job1, job2], reply)
+    assert reply.last is None
+
+    # Jobs are returned in the same order they were put
+    commands.get((0, 0), reply)
+    assert reply.last is job1
+    commands.get((0, 0), reply)
+    assert reply.last is job2
+
+    # With an empty queue the request waits until a job is available
+    waiting = Replies()
+    commands.get((0, 0), waiting)
+    assert waiting.replies == []
+
+    job3 = dummy_job(3)
+    commands.bulk_put([job3], reply)
+    assert waiting.replies == [job3]
+
+
+def test_jobs_status():
+    commands = botogram.runner.jobs.JobsCommands()
+    reply = Replies()
+
+    commands.get((0, 0), Replies())
+    commands.get((1, 0), Replies())
+    commands.get((1, 1), Replies())
+
+    commands.status(None, reply)
+    assert reply.last["queued"] == 0
+    assert reply.last["waiting"] == {0: 1, 1: 2}
+
+    commands.bulk_put([dummy_job(i) for i in range(5)], reply)
+    commands.status(None, reply)
+    assert reply.last["queued"] == 2
+    assert reply.last["waiting"] == {}
+
+
+def test_jobs_retire():
+    commands = botogram.runner.jobs.JobsCommands()
+    reply = Replies()
+
+    waiting0 = Replies()
+    waiting1 = Replies()
+    commands.get((0, 0), waiting0)
+    commands.get((1, 0), waiting1)
+
+    # Only the retired worker should be stopped
+    commands.retire(1, reply)
+    assert waiting0.replies == []
+    assert waiting1.replies == ["__stop__"]
+
+    commands.bulk_put([dummy_job(1)], reply)
+    commands.get((1, 0), reply)
+    assert reply.last == "__stop__"
+    assert len(waiting0.replies) == 1
+
+
+def test_jobs_shutdown():
+    commands = botogram.runner.jobs.JobsCommands()
+    reply = Replies()
+
+    waiting = Replies()
+    watching = Replies()
+    commands.get((0, 0), waiting)
+    commands.wait_shutdown(None, watching)
+    assert watching.replies == []
+
+    commands.shutdown(None, reply)
+    assert waiting.replies == ["__stop__"]
+    assert watching.replies == [None]
+
+    # No more jobs are accepted after the shutdown
+    commands.get((0, 0), reply)
+    assert reply.last == "__stop__"
+    commands.bulk_put([dummy_job(1)], reply)
+    assert reply.last == "No more jobs accepted"
+
+
+def test_jobs_worker_died():
+    commands = botogram.runner.jobs.JobsCommands(max_attempts=2)
+    reply = Replies()
+
+    job1 = dummy_job(1)
+    job2 = dummy_job(2)
+    commands.bulk_put([job1, job2], reply)
+    commands.get((0, 0), reply)
+    commands.get((1, 0), reply)
+
+    # Requesting a new job acknowledges the previous one
+    waiting = Replies()
+    commands.get((1, 0), waiting)
+    assert commands.in_flight == {(0, 0): job1}
+
+    # The job of the dead worker is sent to the waiting one
+    commands.worker_died(0, reply)
+    assert reply.last == {"requeued": 1, "dropped": 0}
+    assert waiting.replies == [job1]
+    assert job1.attempts == 1
+
+    # After crashing two workers the job is dropped
+    commands.worker_died(1, reply)
+    assert reply.last == {"requeued": 0, "dropped": 1}
+    assert commands.in_flight == {}
+    assert len(commands.queue) == 0
+
+    # Waiting requests of dead workers are forgotten
+    commands.get((2, 0), Replies())
+    assert len(commands.waiting) == 1
+    commands.worker_died(2, reply)
+    assert len(commands.waiting) == 0
+
+
+def test_jobs_timeouts():
+    commands = botogram.runner.jobs.JobsCommands(timeout=10)
+    reply = Replies()
+
+    job1 = dummy_job(1)
+    job2 = botogram.runner.jobs.Job("bot", None, {}, timeout=60)
+    job3 = botogram.runner.jobs.Job("bot", None, {}, timeout=30)
+    commands.bulk_put([job1, job2, job3], reply)
+    for slot in (0, 0), (0, 1), (1, 0):
+        commands.get(slot, reply)
+    assert job1.timeout == 10
+    assert job2.timeout == 60
+
+    kills = Replies()
+    commands.wait_kills(0, kills)
+
+    # Jobs get some time to be cancelled before their worker is killed
+    now = job1.started_at + 10
+    assert commands.check_timeouts(now) == \
+        botogram.runner.jobs.TIMEOUT_GRACE
+    assert kills.replies == []
+
+    now += botogram.runner.jobs.TIMEOUT_GRACE
+    assert commands.check_timeouts(now) == pytest.approx(20, abs=1)
+    assert kills.replies == [(1, [0])]
+    assert commands.in_flight == {(0, 1): job2, (1, 0): job3}
+    assert commands.stats.timeouts.total == 1
+
+    # Killed workers don't get new jobs
+    waiting = Replies()
+    commands.get((0, 2), waiting)
+    assert waiting.replies == ["__stop__"]
+
+    # Runners waiting after a kill get the ones they missed
+    commands.wait_kills(0, kills)
+    assert kills.last == (1, [0])
+    commands.wait_kills(1, kills)
+    assert len(kills.replies) == 2
+
+    # The other jobs of the killed worker aren't blamed for its death
+    commands.worker_died(0, reply)
+    assert reply.last == {"requeued": 1, "dropped": 0}
+    assert job2.attempts == 0
+
+    # Runners watching after the killed worker died get the current count,
+    # so they don't ask for the same kills again
+    late = Replies()
+    commands.wait_kills(0, late)
+    assert late.replies == [(1, [])]
+    commands.wait_kills(1, late)
+    assert len(late.replies) == 1
+
+    now = job3.started_at + 30 + botogram.runner.jobs.TIMEOUT_GRACE
+    commands.check_timeouts(now)
+    assert late.replies == [(1, []), (2, [1])]
+
+
+def test_jobs_priorities():
+    commands = botogram.runner.jobs.JobsCommands()
+    reply = Replies()
+
+    low = botogram.runner.jobs.Job("bot", None, {}, 30)
+    normal = botogram.runner.jobs.Job("bot", None, {}, 10)
+    high = botogram.runner.jobs.Job("bot", None, {}, 0)
+    commands.bulk_put([low, normal, high], reply)
+
+    commands.status(None, reply)
+    assert reply.last["lanes"] == {0: 1, 10: 1, 30: 1}
+
+    # Jobs with a lower priority value are processed first
+    for job in high, normal, low:
+        commands.get((0, 0), reply)
+        assert reply.last is job
+
+
+def test_jobs_starvation():
+    commands = botogram.runner.jobs.JobsCommands(starvation_timeout=10)
+    reply = Replies()
+
+    low = botogram.runner.jobs.Job("bot", None, {}, 30)
+    high = botogram.runner.jobs.Job("bot", None, {}, 0)
+    commands.bulk_put([low, high], reply)
+
+    # Jobs waiting for too long are processed before the others
+    low.queued_at -= 20
+    commands.get((0, 0), reply)
+    assert reply.last is low
+    commands.get((0, 0), reply)
+    assert reply.last is high
+
+
+def test_describe_update(frozenbot, sample_update):
+    priorities = botogram.runner.jobs.DEFAULT_PRIORITIES
+    describe = botogram.runner.jobs.describe_update
+
+    assert describe(frozenbot, sample_update, priorities) == \
+        ("message", 10, None)
+    assert describe(frozenbot, sample_update, {"message": 5}) == \
+        ("message", 5, None)
+
+
+def test_describe_update_hooks(bot, sample_update):
+    priorities = botogram.runner.jobs.DEFAULT_PRIORITIES
+    describe = botogram.runner.jobs.describe_update
+
+    @bot.command("urgent")
+    @botogram.priority(-1)
+    def urgent():
+        pass
+
+    @bot.command("normal")
+    def normal():
+        pass
+
+    @bot.command("slow")
+    @botogram.timeout(5)
+    def slow():
+        pass
+
+    frozenbot = bot.freeze()
+
+    sample_update.message.text = "/urgent now"
+    assert describe(frozenbot, sample_update, priorities) == \
+        ("urgent", -1, None)
+    sample_update.message.text = "/normal now"
+    assert describe(frozenbot, sample_update, priorities) == \
+        ("normal", 10, None)
+    sample_update.message.text = "/slow now"
+    assert describe(frozenbot, sample_update, priorities) == ("slow", 10, 5)
+
+
+def test_job_process_async(bot, sample_update):
+    processed = []
+
+    @bot.process_message
+    async def first(message):
+        await asyncio.sleep(0.01)
+        processed.append(("first", message.text))
+
+    @bot.process_message
+    def second(message):
+        processed.append(("second", message.text))
+        return True
+
+    @bot.process_message
+    def third(message):
+        processed.append(("third", message.text))
+
+    frozenbot = bot.freeze()
+    bots = {frozenbot._bot_id: frozenbot}
+    job = botogram.runner.jobs.Job(frozenbot._bot_id,
+                                   botogram.runner.jobs.process_update,
+                                   {"update": sample_update})
+
+    # The hooks run in order, and the chain stops at the one returning True
+    asyncio.run(botogram.utils.drive_async(job.steps(bots)))
+    assert processed == [("first", "test"), ("second", "test")]
+
+    # The same job can be processed without an event loop too
+    job.process(bots)
+    assert len(processed) == 4
+
+
+def test_jobs_backpressure():
+    commands = botogram.runner.jobs.JobsCommands(max_queued=2)
+    reply = Replies()
+
+    # The reply is delayed until the queue has space for more jobs
+    blocked = Replies()
+    commands.bulk_put([dummy_job(i) for i in range(3)], blocked)
+    assert blocked.replies == []
+
+    commands.status(None, reply)
+    assert reply.last["queued"] == 3
+    assert reply.last["blocked"] == 1
+
+    commands.get((0, 0), reply)
+    assert blocked.replies == []
+    commands.get((0, 0), reply)
+    assert blocked.replies == [None]
+
+    # Jobs put without waiting are always accepted immediately
+    nowait = Replies()
+    commands.bulk_put_nowait([dummy_job(i) for i in range(3)], nowait)
+    assert nowait.replies == [None]
+
+
+def test_jobs_backpressure_release():
+    commands = botogram.runner.jobs.JobsCommands(max_queued=1)
+
+    blocked = Replies()
+    commands.bulk_put([dummy_job(1)], blocked)
+    assert blocked.replies == []
+
+    # Releasing the queue unblocks everyone, for example when shutting down
+    commands.release(None, Replies())
+    assert blocked.replies == [None]
+
+    commands.bulk_put([dummy_job(2)], blocked)
+    assert blocked.replies == [None, None]
+
+
+def test_jobs_abort():
+    commands = botogram.runner.jobs.JobsCommands()
+    reply = Replies()
+
+    jobs = [dummy_job(i) for i in range(3)]
+    commands.bulk_put(jobs, reply)
+    commands.get((0, 0), reply)
+
+    # Both the queued and the interrupted jobs are returned
+    commands.abort(None, reply)
+    assert reply.last == {
+        "queued": jobs[1:],
+        "interrupted": jobs[:1],
+        "delayed": [],
+    }
+    assert len(commands.queue) == 0
+
+
+def limited_job(value, max_instances=1, overlap="skip"):
+    return botogram.runner.jobs.Job("bot", None, {"value": value},
+                                    instances_key="timer",
+                                    max_instances=max_instances,
+                                    overlap=overlap)
+
+
+def test_jobs_instances_skip():
+    commands = botogram.runner.jobs.JobsCommands()
+    reply = Replies()
+
+    # Only two instances can be queued or running at the same time
+    commands.bulk_put_nowait([limited_job(i, 2) for i in range(3)], reply)
+    assert len(commands.queue) == 2
+
+    commands.get((0, 0), reply)
+    assert reply.last.metadata["value"] == 0
+    commands.bulk_put_nowait([limited_job(3, 2)], reply)
+    assert len(commands.queue) == 1
+
+    # Completing a job allows another one to be queued
+    commands.get((0, 0), reply)
+    assert reply.last.metadata["value"] == 1
+    commands.bulk_put_nowait([limited_job(4, 2)], reply)
+    assert len(commands.queue) == 1
+
+
+def test_jobs_instances_coalesce():
+    commands = botogram.runner.jobs.JobsCommands(max_attempts=1)
+    reply = Replies()
+
+    commands.bulk_put_nowait([limited_job(0, overlap="coalesce")], reply)
+    commands.get((0, 0), reply)
+
+    # The runs due while the first one is running are coalesced into one
+    for i in range(1, 4):
+        commands.bulk_put_nowait([limited_job(i, overlap="coalesce")], reply)
+    assert len(commands.queue) == 0
+
+    commands.get((0, 0), reply)
+    assert reply.last.metadata["value"] == 3
+    assert len(commands.queue) == 0
+
+    # Dropped jobs count as completed too
+    commands.bulk_put_nowait([limited_job(4, overlap="coalesce")], reply)
+    commands.worker_died(0, reply)
+    assert reply.last == {"requeued": 0, "dropped": 1}
+    commands.get((1, 0), reply)
+    assert reply.last.metadata["value"] == 4
+
+
+def test_jobs_delayed():
+    commands = botogram.runner.jobs.JobsCommands(priorities={"timer": 5})
+    reply = Replies()
+
+    jobs = []
+    for i, run_at in enumerate((30, 10, 20)):
+        job = dummy_job(i)
+        job.priority = None
+        job.run_at = run_at
+        commands.schedule(job, reply)
+        jobs.append(job)
+
+    # Jobs are put in the queue only when they're due
+    assert commands.dispatch_delayed(now=5) == 5
+    assert len(commands.queue) == 0
+    assert commands.dispatch_delayed(now=25) == 5
+    assert len(commands.queue) == 2
+
+    commands.get((0, 0), reply)
+    assert reply.last is jobs[1]
+    assert reply.last.priority == 5
+
+    # Delayed jobs aren't dispatched while shutting down
+    commands.shutdown(None, reply)
+    assert commands.dispatch_delayed(now=35) == 0
+    commands.abort(None, reply)
+    assert reply.last["delayed"] == [jobs[0]]
+    assert commands.dispatch_delayed(now=35) is None
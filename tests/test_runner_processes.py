@@ -0,0 +1,96 @@
+# Copyright (c) 2015-2019 The Botogram Authors (see AUTHORS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+
+import multiprocessing
+import threading
+
+import pytest
+
+import botogram.runner.ipc
+import botogram.runner.jobs
+import botogram.runner.processes
+
+
+# Objects loaded by the runner before starting the workers
+loaded = {}
+
+
+def report_loaded(bot, metadata):
+    ipc = multiprocessing.current_process().ipc
+    ipc.command("report", loaded.get("bots"))
+
+
+@pytest.fixture()
+def server(request):
+    server = botogram.runner.ipc.IPCServer(("127.0.0.1", 0), "secret")
+    server.reports = []
+    server.register_command("report", lambda data, reply: (
+        server.reports.append(data), reply(None),
+    ))
+
+    # The worker gets a single job, and then it's stopped
+    jobs = [botogram.runner.jobs.Job("bot", report_loaded, {})]
+    server.register_command("jobs.get", lambda data, reply: reply(
+        jobs.pop() if jobs else "__stop__",
+    ))
+
+    thread = threading.Thread(target=server.run)
+    thread.start()
+
+    def stop():
+        client = botogram.runner.ipc.IPCClient(server.port, "secret",
+                                               "127.0.0.1")
+        client.command("__stop__", server.stop_key)
+        client.close()
+        thread.join()
+    request.addfinalizer(stop)
+
+    return server
+
+
+def run_worker(server, method):
+    """Run a worker with the provided start method until it stops"""
+    worker = botogram.runner.processes.WorkerProcess(
+        (server.port, "secret", "127.0.0.1"), 0, {"bot": None},
+    )
+    worker.use_context(multiprocessing.get_context(method))
+    worker.start()
+    worker.join(30)
+    return worker
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(),
+                    reason="the fork start method isn't available")
+def test_worker_fork_context(server, monkeypatch):
+    monkeypatch.setitem(loaded, "bots", "preloaded")
+
+    # Forked workers see the objects loaded before they were started
+    worker = run_worker(server, "fork")
+    assert worker.exitcode == 0
+    assert server.reports == ["preloaded"]
+
+
+def test_worker_spawn_context(server, monkeypatch):
+    monkeypatch.setitem(loaded, "bots", "preloaded")
+
+    # The start method of the context replaces the default one
+    worker = run_worker(server, "spawn")
+    assert worker.exitcode == 0
+    assert server.reports == [None]
@@ -0,0 +1,440 @@
+# Copyright (c) 2015-2019 The Botogram Authors (see AUTHORS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+
+import asyncio
+import multiprocessing
+import pickle
+import time
+
+import pytest
+
+import botogram
+import botogram.runner.shared
+import botogram.shared
+
+
+def _dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+class Replies:
+    """Collect the replies sent by the IPC commands"""
+
+    def __init__(self):
+        self.replies = []
+
+    def __call__(self, data, ok=True):
+        self.replies.append(data)
+        return True
+
+    @property
+    def last(self):
+        return self.replies[-1]
+
+
+class FakeResponse:
+    """A response of the FakeIPC, which might be sent later"""
+
+    def __init__(self):
+        self.callbacks = []
+        self.data = None
+        self.sent = False
+
+    def __call__(self, data, ok=True):
+        # The data is pickled when it's sent to the other process
+        self.data = pickle.loads(pickle.dumps(data))
+        self.sent = True
+        for callback in self.callbacks:
+            callback(self)
+        return True
+
+    def add_done_callback(self, func):
+        if self.sent:
+            func(self)
+        else:
+            self.callbacks.append(func)
+
+    def exception(self):
+        return None
+
+    def result(self):
+        assert self.sent
+        return self.data
+
+
+class FakeIPC:
+    """Process the IPC commands directly with the shared memory commands"""
+
+    def __init__(self):
+        self.commands = botogram.runner.shared.SharedMemoryCommands()
+        self.sent = []
+
+    def send(self, command, data):
+        self.sent.append(command)
+
+        response = FakeResponse()
+        getattr(self.commands, command.split(".", 1)[1])(data, response)
+        return response
+
+    def command(self, command, data):
+        return self.send(command, data).result()
+
+
+@pytest.fixture()
+def fake_ipc(monkeypatch):
+    ipc = FakeIPC()
+    monkeypatch.setattr(multiprocessing.current_process(), "ipc", ipc,
+                        raising=False)
+    return ipc
+
+
+def test_shared_dict(fake_ipc):
+    driver = botogram.runner.shared.MultiprocessingDriver()
+    memory, is_new = driver.get("bot:comp")
+    assert is_new
+    assert driver.get("bot:comp") == (memory, False)
+
+    memory["a"] = [1, 2]
+    assert memory["a"] == [1, 2]
+    assert memory.get("b", 3) == 3
+    assert "a" in memory and "b" not in memory
+    with pytest.raises(KeyError):
+        memory["b"]
+
+    memory.update(b=2, c=3)
+    assert len(memory) == 3
+    assert sorted(memory) == ["a", "b", "c"]
+    assert memory.copy() == {"a": [1, 2], "b": 2, "c": 3}
+
+    del memory["c"]
+    with pytest.raises(KeyError):
+        del memory["c"]
+    memory.clear()
+    assert memory.copy() == {}
+
+
+def test_shared_dict_batches(fake_ipc):
+    memory, __ = botogram.runner.shared.MultiprocessingDriver().get("bot:c")
+    fake_ipc.sent = []
+
+    # Each batch of keys needs a single request
+    memory.set_many({"a": 1, "b": 2, "c": 3})
+    assert memory.get_many(["a", "c", "d"]) == {"a": 1, "c": 3}
+    assert memory.delete_many(["b", "d"]) == 1
+    assert dict(memory.items()) == {"a": 1, "c": 3}
+    assert fake_ipc.sent == ["shared.set_many", "shared.get_many",
+                             "shared.delete_many", "shared.items"]
+
+    # The IPC process only sees the pickled values
+    stored = fake_ipc.commands._memories["bot:c"]
+    assert all(isinstance(value, bytes) for value in stored.values())
+
+
+def test_shared_changes(monkeypatch):
+    monkeypatch.setattr(botogram.runner.shared, "CHANGES_LOG_SIZE", 2)
+    commands = botogram.runner.shared.SharedMemoryCommands()
+    reply = Replies()
+
+    commands.watch(None, reply)
+    assert reply.last == 0
+
+    # Processes waiting for changes get them as soon as they happen
+    waiting = Replies()
+    commands.wait_changes(0, waiting)
+    commands.set_many(("mem", {"a": b"1"}), reply)
+    assert waiting.replies == [(1, [("mem", ["a"])])]
+
+    commands.delete_many(("mem", ["a"]), reply)
+    commands.clear("mem", reply)
+    commands.wait_changes(1, waiting)
+    assert waiting.last == (3, [("mem", ["a"]), ("mem", None)])
+
+    # Processes which missed too many changes must drop their whole cache
+    commands.wait_changes(0, waiting)
+    assert waiting.last == (3, None)
+
+
+def test_shared_dict_cache(fake_ipc):
+    memory1, __ = botogram.runner.shared.MultiprocessingDriver(True).get("m")
+    memory2, __ = botogram.runner.shared.MultiprocessingDriver(True).get("m")
+
+    memory1["a"] = 1
+    assert memory2["a"] == 1
+    assert "b" not in memory2
+
+    # Cached values (and missing keys) are read without requests
+    fake_ipc.sent = []
+    assert memory2["a"] == 1
+    assert "b" not in memory2
+    assert fake_ipc.sent == []
+
+    # Changes made by the other processes invalidate the cache
+    memory1.update(a=2, b=3)
+    assert memory2.get_many(["a", "b"]) == {"a": 2, "b": 3}
+    del memory1["b"]
+    assert memory2.get("b") is None
+
+    # Processes always read their own changes
+    memory2["a"] = [1]
+    memory2["a"].append(2)
+    assert memory2["a"] == [1]
+
+
+def test_read_cache_stale(fake_ipc):
+    cache = botogram.runner.shared.MultiprocessingDriver(True).read_cache()
+    cache.changed(5, "m", ["a"])
+
+    # Values read before the last change might be stale
+    cache.store(4, "m", ["a"], {"a": b"old"})
+    assert cache.get("m", ["a"]) == ({}, ["a"])
+    cache.store(5, "m", ["a"], {"a": b"new"})
+    assert cache.get("m", ["a"]) == ({"a": b"new"}, [])
+
+
+def test_shared_commands_store(tmp_path):
+    path = str(tmp_path / "shared.db")
+    commands = botogram.runner.shared.SharedMemoryCommands(
+        botogram.shared.SQLiteStore(path),
+    )
+    commands.open()
+    reply = Replies()
+
+    commands.set_many(("mem", {"a": b"1", "b": b"2"}), reply)
+    commands.delete_many(("mem", ["b"]), reply)
+    commands.close()
+
+    # The IPC process loads the memories after a restart
+    commands = botogram.runner.shared.SharedMemoryCommands(
+        botogram.shared.SQLiteStore(path),
+    )
+    commands.open()
+    commands.get(("mem", None), reply)
+    assert reply.last is False
+    commands.get_many(("mem", ["a", "b"]), reply)
+    assert reply.last[1] == {"a": b"1"}
+    commands.close()
+
+
+class UnpicklableError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+
+
+class BrokenValue:
+    """A value whose methods raise exceptions"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __add__(self, other):
+        raise ValueError("can't add")
+
+    def __eq__(self, other):
+        # This can't be rebuilt when unpickled, since it needs two arguments
+        raise UnpicklableError(1, "can't compare")
+
+    __hash__ = object.__hash__
+
+
+def _fail_loading():
+    raise ImportError("the class isn't available")
+
+
+class UnloadableValue:
+    """A value which can't be unpickled"""
+
+    def __reduce__(self):
+        return _fail_loading, ()
+
+
+def test_shared_dict_atomic(fake_ipc):
+    driver = botogram.runner.shared.MultiprocessingDriver()
+    memory, __ = driver.get("m")
+
+    # Each operation needs a single request
+    fake_ipc.sent = []
+    assert memory.incr("a") == 1
+    assert memory.incr("a", 5) == 6
+    assert memory.decr("a", 2) == 4
+    assert memory.cas("a", 4, 5)
+    assert not memory.cas("a", 4, 6)
+    assert memory.append("l", {"x": 1}) == 1
+    assert memory.setdefault("l") == [{"x": 1}]
+    assert memory.setdefault("d", "default") == "default"
+    assert memory.pop("d") == "default"
+    assert memory.pop("d", None) is None
+    assert fake_ipc.sent == ["shared.incr"] * 3 + ["shared.cas"] * 2 + \
+        ["shared.append"] + ["shared.setdefault"] * 2 + ["shared.pop"] * 2
+    assert memory.get_many(["a", "l", "d"]) == {"a": 5, "l": [{"x": 1}]}
+
+    # Errors are raised in the process which sent the command
+    memory["s"] = "text"
+    with pytest.raises(TypeError):
+        memory.incr("s")
+    with pytest.raises(KeyError):
+        memory.pop("missing")
+
+    # Errors raised by the values themselves don't affect the IPC process
+    memory["broken"] = BrokenValue(1)
+    with pytest.raises(ValueError):
+        memory.incr("broken")
+    with pytest.raises(RuntimeError):
+        memory.cas("broken", BrokenValue(2), 1)
+    with pytest.raises(ImportError):
+        memory.append("l", UnloadableValue())
+    memory.set_many({"a": 1})
+    assert memory.incr("a") == 2
+
+
+def test_shared_dict_atomic_cache(fake_ipc):
+    memory1, __ = botogram.runner.shared.MultiprocessingDriver(True).get("m")
+    memory2, __ = botogram.runner.shared.MultiprocessingDriver(True).get("m")
+
+    assert memory2.get("a") is None
+    memory1.incr("a")
+    assert memory2["a"] == 1
+
+
+def test_shared_dict_transaction(fake_ipc):
+    memory1, __ = botogram.runner.shared.MultiprocessingDriver(True).get("m")
+    memory2, __ = botogram.runner.shared.MultiprocessingDriver(True).get("m")
+    memory1.update({"a": 1, "b": [1]})
+
+    # The changes are applied with a single request
+    with memory1.transaction() as tx:
+        tx["a"] += 1
+        tx["b"] = tx["b"] + [2]
+        tx["c"] = "new"
+        fake_ipc.sent = []
+    assert [cmd for cmd in fake_ipc.sent if cmd != "shared.wait_changes"] \
+        == ["shared.commit"]
+    assert memory1.get_many(["a", "b", "c"]) == \
+        {"a": 2, "b": [1, 2], "c": "new"}
+    assert memory2["a"] == 2
+
+    with pytest.raises(botogram.TransactionConflictError):
+        with memory1.transaction() as tx:
+            del tx["c"]
+            tx["missing"] = tx.get("missing", 0) + 1
+            memory2["missing"] = 1
+    assert memory1.get_many(["c", "missing"]) == {"c": "new", "missing": 1}
+
+    def move(tx):
+        if "c" in tx:
+            tx["d"] = tx["c"]
+            del tx["c"]
+        if fake_ipc.sent.count("shared.commit") == 0:
+            memory2["c"] = "changed"
+
+    fake_ipc.sent = []
+    memory1.transaction(move)
+    assert fake_ipc.sent.count("shared.commit") == 2
+    assert memory1.get_many(["c", "d"]) == {"d": "changed"}
+    assert memory2.get_many(["c", "d"]) == {"d": "changed"}
+
+
+
+def test_shared_commands_locks():
+    commands = botogram.runner.shared.SharedMemoryCommands()
+    replies = Replies()
+    status = Replies()
+
+    commands.lock_acquire("lock", replies)
+    assert replies.replies == [None]
+
+    # The first waiting process disconnected, so the lock goes to the next
+    dead = []
+    commands.lock_acquire("lock", lambda data, ok=True: dead.append(data))
+    commands.lock_acquire("lock", replies)
+    commands.lock_release("lock", replies)
+    assert dead == [None]
+    assert replies.replies == [None, None, None]
+    commands.lock_status("lock", status)
+    assert status.last is True
+
+    commands.lock_release("lock", replies)
+    commands.lock_status("lock", status)
+    assert status.last is False
+
+
+def test_shared_lock_async(fake_ipc):
+    driver = botogram.runner.shared.MultiprocessingDriver()
+    shared = botogram.shared.SharedMemory(driver)
+    memory = shared.of("bot1", "comp1")
+    lock = memory.lock("lock")
+    order = []
+
+    async def holder():
+        async with lock:
+            await asyncio.sleep(0.05)
+            order.append("holder")
+
+    async def waiter():
+        await asyncio.sleep(0.01)
+        async with lock:
+            order.append("waiter")
+            await memory.set_many_async({"a": 1})
+
+    async def main():
+        await asyncio.gather(holder(), waiter())
+
+    # Waiting for the lock doesn't block the coroutine holding it
+    asyncio.run(main())
+    assert order == ["holder", "waiter"]
+    assert memory["a"] == 1
+    assert not lock.acquired
+
+    async def cancelled():
+        async with lock:
+            try:
+                await asyncio.wait_for(lock.acquire_async(), 0.01)
+            except asyncio.TimeoutError:
+                pass
+
+    # Locks granted after their coroutine was cancelled are released
+    asyncio.run(cancelled())
+    assert not lock.acquired
+
+
+def test_shared_commands_limits(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    evicted = []
+    commands = botogram.runner.shared.SharedMemoryCommands(
+        on_evict=lambda limits, *args: evicted.append(args),
+    )
+    reply = Replies()
+
+    limits = {"ttl": 10, "max_keys": 2, "eviction": "lru", "notify": True}
+    commands.get(("mem", limits), reply)
+    commands.set_many(("mem", {"a": b"1", "b": b"2"}), reply)
+    commands.get_many(("mem", ["a"]), reply)
+    commands.incr(("mem", "c", 1, 0), reply)
+    assert evicted == [("b", b"2", "evicted")]
+
+    # Expired keys are removed by a timer too
+    now[0] = 5
+    assert commands.expire() == 5
+    now[0] = 10
+    assert commands.expire() is None
+    assert evicted[1:] == [("a", b"1", "expired"), ("c", _dumps(1), "expired")]
+    commands.size("mem", reply)
+    assert reply.last == 0
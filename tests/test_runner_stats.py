@@ -0,0 +1,81 @@
+# Copyright (c) 2015-2019 The Botogram Authors (see AUTHORS)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+
+import botogram.objects
+import botogram.runner.jobs
+import botogram.runner.stats
+
+
+def test_rate():
+    rate = botogram.runner.stats.Rate(window=10)
+
+    rate.add(now=100)
+    rate.add(4, now=105)
+    assert rate.total == 5
+    assert rate.per_second(now=105) == 0.5
+
+    # Old events aren't considered anymore
+    assert rate.per_second(now=112) == 0.4
+    assert rate.export(now=200) == {"total": 5, "per_second": 0}
+
+
+def test_samples():
+    samples = botogram.runner.stats.Samples(size=100)
+    assert samples.export()["p50"] is None
+
+    for i in range(200):
+        samples.add(i)
+
+    # Only the last samples are kept
+    assert samples.export() == {
+        "samples": 100, "p50": 149, "p90": 189, "p99": 198,
+    }
+
+
+def test_jobs_stats():
+    commands = botogram.runner.jobs.JobsCommands()
+
+    jobs = []
+    for i in range(3):
+        update = botogram.objects.Update({"update_id": i})
+        jobs.append(botogram.runner.jobs.Job("bot", None, {
+            "update": update,
+        }, name="hook"))
+    commands.bulk_put(jobs, lambda *_: None)
+
+    def get_stats():
+        result = []
+        commands.get_stats(None, lambda data: result.append(data))
+        return result[0]
+
+    commands.get((0, 0), lambda *_: None)
+    commands.failed((0, 0), lambda *_: None)
+    commands.get((0, 0), lambda *_: None)
+
+    result = get_stats()
+    assert result["processed"]["total"] == 1
+    assert result["failed"]["total"] == 1
+    assert result["hooks"]["hook"]["wait"]["samples"] == 2
+    assert result["hooks"]["hook"]["run"]["samples"] == 1
+    assert result["updates"]["bot"] == {
+        "last_fetched": 2, "last_processed": 0, "pending": 2,
+    }
+    assert result["queue"]["queued"] == 1
+    assert result["workers"][0]["busy"][0]["job"] == "hook"
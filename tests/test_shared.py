@@ -18,8 +18,13 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import asyncio
 import pickle
+import time
 
+import pytest
+
+import botogram
 import botogram.shared
 import botogram.hooks
 
@@ -109,3 +114,270 @@ def test_switch_driver():
     assert shared.driver == driver
     assert shared.of("bot1", "test1")["a"] == "b"
     assert shared.of("bot1", "test2")["b"] == "c"
+
+
+def test_shared_memory_batches():
+    shared = botogram.shared.SharedMemory()
+    memory = shared.of("bot1", "comp1")
+
+    memory.set_many({"a": 1, "b": 2})
+    assert memory.get_many(["a", "c"]) == {"a": 1}
+    assert memory.delete_many(["a", "c"]) == 1
+    assert memory == {"b": 2}
+
+
+def test_shared_memory_names():
+    shared = botogram.shared.SharedMemory()
+    shared.register_name("bot-id", "123")
+    shared.register_name("comp-id1", "comp")
+    shared.register_name("comp-id2", "comp")
+
+    assert shared._key_of("bot-id", "comp-id1") == "123:comp"
+    assert shared._key_of("bot-id", "comp-id2", "sub") == "123:comp#2:sub"
+
+    # Names are kept when the memory is sent to another process
+    pickled = pickle.loads(pickle.dumps(shared))
+    assert pickled._key_of("bot-id", "comp-id2") == "123:comp#2"
+
+
+def test_persistent_driver(tmp_path):
+    path = str(tmp_path / "shared.db")
+    shared = botogram.shared.SharedMemory(
+        botogram.shared.PersistentDriver(path, flush_interval=3600),
+    )
+
+    memory = shared.of("bot1", "comp1")
+    memory.update({"a": 1, "b": [1, 2]})
+    memory["c"] = 3
+    del memory["a"]
+    shared.of("bot1", "comp2")["d"] = 4
+    shared.of("bot1", "comp2").clear()
+    shared.driver.close()
+
+    # Everything is loaded again after a restart
+    shared = botogram.shared.SharedMemory(
+        botogram.shared.PersistentDriver(path),
+    )
+    memory, is_new = shared.driver.get("bot1:comp1")
+    assert not is_new
+    assert memory == {"b": [1, 2], "c": 3}
+    assert shared.of("bot1", "comp2") == {}
+    shared.driver.close()
+
+
+def test_sqlite_store(tmp_path):
+    store = botogram.shared.SQLiteStore(str(tmp_path / "shared.db"),
+                                        flush_interval=0)
+    memories = store.open()
+    assert memories == {}
+
+    # Only the changed keys are written
+    memories["m"] = {"a": b"1", "b": b"2"}
+    store.changed("m", ["a"])
+    store.tick(memories)
+    store.compact()
+    store.close(memories)
+
+    store = pickle.loads(pickle.dumps(store))
+    assert store.open() == {"m": {"a": b"1"}}
+    store.close({})
+
+
+def test_shared_memory_atomic():
+    shared = botogram.shared.SharedMemory()
+    memory = shared.of("bot1", "comp1")
+
+    assert memory.incr("a") == 1
+    assert memory.incr("a", 5) == 6
+    assert memory.decr("a", 2) == 4
+    assert memory.decr("b", default=10) == 9
+
+    assert not memory.cas("a", 1, 2)
+    assert not memory.cas("c", None, 2)
+    assert memory.cas("a", 4, 5)
+    assert memory["a"] == 5
+
+    assert memory.append("l", 1) == 1
+    assert memory.append("l", 2) == 2
+    assert memory["l"] == [1, 2]
+
+    assert memory.setdefault("a", 1) == 5
+    assert memory.pop("a") == 5
+    assert memory.pop("a", None) is None
+
+
+
+def test_shared_memory_async():
+    shared = botogram.shared.SharedMemory()
+    memory = shared.of("bot1", "comp1")
+    lock = memory.lock("lock")
+    order = []
+
+    async def holder():
+        async with lock:
+            order.append("holder")
+            await asyncio.sleep(0.05)
+            order.append("released")
+
+    async def waiter():
+        await asyncio.sleep(0.01)
+        async with lock:
+            order.append("waiter")
+            return await memory.incr_async("a")
+
+    async def main():
+        return await asyncio.gather(holder(), waiter())
+
+    # Waiting for the lock doesn't block the coroutine holding it
+    assert asyncio.run(main()) == [None, 1]
+    assert order == ["holder", "released", "waiter"]
+    assert not lock.acquired
+
+    async def blocking():
+        with lock:
+            pass
+
+    # Locks acquired by blocking would deadlock the event loop
+    with pytest.raises(RuntimeError):
+        asyncio.run(blocking())
+
+
+def test_shared_memory_transaction():
+    shared = botogram.shared.SharedMemory()
+    memory = shared.of("bot1", "comp1")
+    memory.update({"a": 1, "b": 2})
+
+    with memory.transaction() as tx:
+        tx["a"] += 1
+        tx["c"] = tx.get("b")
+        del tx["b"]
+        assert "b" not in tx
+        # Nothing is applied before the end of the transaction
+        assert memory["a"] == 1
+    assert memory == {"a": 2, "c": 2}
+
+    # Conflicting transactions aren't applied
+    with pytest.raises(botogram.TransactionConflictError):
+        with memory.transaction() as tx:
+            tx["a"] += 1
+            memory["a"] = 10
+    assert memory["a"] == 10
+
+    with pytest.raises(botogram.TransactionConflictError):
+        with memory.transaction() as tx:
+            tx["d"] = tx.get("d", 0) + 1
+            memory["d"] = 5
+    assert memory["d"] == 5
+
+    # Appending to a list read by the transaction conflicts with it too
+    memory["l"] = [1]
+    with pytest.raises(botogram.TransactionConflictError):
+        with memory.transaction() as tx:
+            items = tx["l"]
+            memory.append("l", 2)
+            assert items == [1]
+            tx["l"] = items + [3]
+    assert memory["l"] == [1, 2]
+
+    # Changing the values read doesn't change the memory before committing
+    with memory.transaction() as tx:
+        tx["l"].append(3)
+        assert memory["l"] == [1, 2]
+        tx["l"] = tx["l"]
+    assert memory["l"] == [1, 2, 3]
+
+    # Functions are retried until they don't conflict anymore
+    calls = []
+
+    def increment(tx):
+        calls.append(tx["a"])
+        if len(calls) == 1:
+            memory["a"] = 20
+        tx["a"] += 1
+        return tx["a"]
+
+    assert memory.transaction(increment) == 21
+    assert calls == [10, 20]
+    assert memory["a"] == 21
+
+    def conflict(tx):
+        tx["a"] += 1
+        memory["a"] = len(calls)
+        calls.append(tx)
+
+    with pytest.raises(botogram.TransactionConflictError):
+        memory.transaction(conflict, attempts=3)
+
+
+def test_limiter():
+    limiter = botogram.shared.Limiter(max_keys=2)
+    for key in "abc":
+        limiter.written(key)
+    limiter.read("a")
+    assert limiter.overflowing(3) == ["b"]
+
+    limiter = botogram.shared.Limiter(max_keys=2, eviction="lfu")
+    for key in "abc":
+        limiter.written(key)
+    limiter.read("a")
+    limiter.read("c")
+    assert limiter.overflowing(3) == ["b"]
+
+    limiter = botogram.shared.Limiter(ttl=10)
+    limiter.written("a", now=0)
+    limiter.written("b", now=5)
+    limiter.written("a", now=8)
+    assert limiter.expired(now=16) == ["b"]
+    assert limiter.next_expiry() == 18
+
+
+def test_shared_memory_limits(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    shared = botogram.shared.SharedMemory()
+    shared.register_limits("comp1", {"ttl": 10, "max_keys": 2,
+                                     "eviction": "lru"})
+    comp = botogram.Component()
+    comp._component_id = "comp1"
+    shared.register_evicted_hooks([
+        botogram.hooks.MemoryEvictedHook(lambda: None, comp),
+    ])
+
+    memory = shared.of("bot1", "comp1")
+    memory["a"] = 1
+    memory["b"] = 2
+    assert memory["a"] == 1
+    memory["c"] = 3
+    assert memory == {"a": 1, "c": 3}
+
+    now[0] = 11
+    assert "a" not in memory
+    assert len(memory) == 0
+
+    # Sub-memories aren't limited
+    shared.of("bot1", "comp1", "sub").update(a=1, b=2, c=3)
+    assert len(shared.of("bot1", "comp1", "sub")) == 3
+
+    assert list(shared.pop_evicted()) == [
+        ("comp1", "b", 2, "evicted"),
+        ("comp1", "a", 1, "expired"),
+        ("comp1", "c", 3, "expired"),
+    ]
+
+
+def test_persistent_driver_limits(tmp_path):
+    path = str(tmp_path / "shared.db")
+    driver = botogram.shared.PersistentDriver(path, flush_interval=3600)
+    limits = {"ttl": None, "max_keys": 1, "eviction": "lru",
+              "notify": False, "component": "comp1"}
+    memory, __ = driver.get("mem", limits)
+    memory["a"] = 1
+    memory["b"] = 2
+    driver.close()
+
+    # Evicted keys are removed from the database too
+    driver = botogram.shared.PersistentDriver(path)
+    memory, __ = driver.get("mem")
+    assert memory == {"b": 2}
+    driver.close()
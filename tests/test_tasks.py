@@ -18,6 +18,10 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import datetime
+
+import pytest
+
 import botogram
 import botogram.tasks
 
@@ -57,3 +61,120 @@ def test_scheduler(bot):
     assert list(scheduler.now(current=7)) == [timer2]
     assert list(scheduler.now(current=8)) == []
     assert list(scheduler.now(current=10)) == [timer1, timer2]
+
+
+def test_timer_subsecond(bot):
+    timer = botogram.tasks.TimerTask(0.5, sample_timer)
+    assert timer.now(current=0) == True
+    assert timer.now(current=0.3) == False
+    assert timer.next_run() == 0.5
+    assert timer.now(current=0.5) == True
+
+
+def test_timer_jitter(bot):
+    timer = botogram.tasks.TimerTask(5, sample_timer, jitter=2)
+    assert timer.now(current=0) == True
+    assert 5 <= timer.next_run() <= 7
+    assert timer.now(current=4.9) == False
+    assert timer.now(current=7) == True
+
+
+def test_cron_rule():
+    rule = botogram.tasks.CronRule("*/15 9-17 * * mon-fri")
+
+    # Saturday 17 October 2026, at noon
+    start = datetime.datetime(2026, 10, 17, 12, 0).timestamp()
+    first = rule.next_match(start)
+    second = rule.next_match(first)
+    assert datetime.datetime.fromtimestamp(first) == \
+        datetime.datetime(2026, 10, 19, 9, 0)
+    assert datetime.datetime.fromtimestamp(second) == \
+        datetime.datetime(2026, 10, 19, 9, 15)
+
+    # Either the day or the weekday must match, if both are provided
+    rule = botogram.tasks.CronRule("0 0 13 * fri")
+    match = rule.next_match(start)
+    assert datetime.datetime.fromtimestamp(match) == \
+        datetime.datetime(2026, 10, 23, 0, 0)
+
+    # Steps of the whole range don't restrict the field, so both must match
+    rule = botogram.tasks.CronRule("0 0 */2 * sun")
+    match = rule.next_match(start)
+    assert datetime.datetime.fromtimestamp(match) == \
+        datetime.datetime(2026, 10, 25, 0, 0)
+
+    rule = botogram.tasks.CronRule("@monthly")
+    match = rule.next_match(datetime.datetime(2026, 12, 5).timestamp())
+    assert datetime.datetime.fromtimestamp(match) == \
+        datetime.datetime(2027, 1, 1, 0, 0)
+
+
+def test_cron_rule_invalid():
+    for expression in ("* * *", "61 * * * *", "*/0 * * * *", "x * * * *",
+                       "0 0 30 2 *"):
+        with pytest.raises(ValueError):
+            botogram.tasks.CronRule(expression)
+
+
+def test_cron_task(bot):
+    task = botogram.tasks.CronTask("0 * * * *", sample_timer)
+
+    start = datetime.datetime(2026, 10, 17, 12, 30).timestamp()
+    assert task.now(current=start) == False
+    assert task.next_run() == start + 1800
+    assert task.now(current=start + 1799) == False
+    assert task.now(current=start + 1800) == True
+
+    # Runs missed while the bot was stopped are skipped
+    assert task.now(current=start + 9000) == True
+    assert task.next_run() == start + 9000 + 3600
+
+
+def test_scheduler_next_run(bot):
+    timer1 = botogram.tasks.TimerTask(5, sample_timer)
+    timer2 = botogram.tasks.TimerTask(0.5, sample_timer)
+
+    scheduler = botogram.tasks.Scheduler()
+    assert scheduler.next_run(current=0) is None
+
+    scheduler.add(timer1)
+    assert list(scheduler.now(current=0)) == [timer1]
+    assert scheduler.next_run(current=0) == 5
+
+    # Tasks added later are picked up too
+    scheduler.add(timer2)
+    assert scheduler.next_run(current=0) == 0
+    assert list(scheduler.now(current=0)) == [timer2]
+    assert scheduler.next_run(current=0) == 0.5
+
+    tasks = [botogram.tasks.TimerTask(3, sample_timer)]
+    scheduler.register_tasks_list(tasks)
+    assert list(scheduler.now(current=1)) == [timer2, tasks[0]]
+
+    # Tasks of the same function are told apart by their position
+    assert [scheduler.task_key(task) for task in (timer1, timer2, tasks[0])] \
+        == ["0.0", "0.1", "1.0"]
+
+
+def test_bot_cron(bot):
+    @bot.cron("*/5 * * * *", jitter=10)
+    def task(bot):
+        pass
+
+    tasks = bot._main_component._get_chains()["tasks"][0]
+    assert isinstance(tasks[-1], botogram.tasks.CronTask)
+    assert tasks[-1].jitter == 10
+
+    with pytest.raises(ValueError):
+        bot.cron("not a cron expression")(task)
+
+
+def test_task_overlap_policy(bot):
+    timer = botogram.tasks.TimerTask(5, sample_timer)
+    assert timer.max_instances == 1
+    assert timer.overlap == "skip"
+
+    with pytest.raises(ValueError):
+        botogram.tasks.TimerTask(5, sample_timer, overlap="queue")
+    with pytest.raises(ValueError):
+        botogram.tasks.TimerTask(5, sample_timer, max_instances=0)
@@ -18,6 +18,11 @@
 #   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #   DEALINGS IN THE SOFTWARE.
 
+import asyncio
+import concurrent.futures
+import threading
+import time
+
 import pytest
 
 import botogram.utils
@@ -107,3 +112,125 @@ def test_call_lazy_arguments():
     botogram.utils.call(myfunc2, a=1, b=lazy)
     assert myfunc2_called
     assert myarg_called
+
+
+def test_call_coroutine():
+    async def myfunc(a):
+        return a * 2
+
+    assert botogram.utils.call(myfunc, a=21) == 42
+
+
+def test_call_coroutine_loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+
+    botogram.utils.set_coroutines_loop(loop)
+    try:
+        async def myfunc(a):
+            # The coroutine must be running in the shared event loop
+            assert asyncio.get_running_loop() is loop
+            return a * 2
+
+        assert botogram.utils.call(myfunc, a=21) == 42
+    finally:
+        botogram.utils.set_coroutines_loop(None)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_call_coroutine_timeout():
+    cancelled = []
+
+    async def myfunc():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+
+    try:
+        # The timeout is a deadline, so it's set again before each call
+        botogram.utils.set_coroutines_timeout(0.05)
+        with pytest.raises(TimeoutError):
+            botogram.utils.call(myfunc)
+
+        # Coroutines running in the shared event loop are cancelled too
+        botogram.utils.set_coroutines_loop(loop)
+        botogram.utils.set_coroutines_timeout(0.05)
+        with pytest.raises(TimeoutError):
+            botogram.utils.call(myfunc)
+
+        # Wait for the event loop to cancel the coroutine before stopping it
+        for __ in range(100):
+            if len(cancelled) == 2:
+                break
+            time.sleep(0.01)
+    finally:
+        botogram.utils.set_coroutines_timeout(None)
+        botogram.utils.set_coroutines_loop(None)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    assert cancelled == [True, True]
+
+
+def test_drive():
+    async def double(a):
+        return a * 2
+
+    async def fail():
+        raise ValueError("failed")
+
+    def steps():
+        result = yield double(21)
+        assert result == 42
+
+        # Errors raised by the coroutines are thrown back into the steps
+        with pytest.raises(ValueError):
+            yield fail()
+
+        return result
+
+    assert botogram.utils.drive(steps()) == 42
+    assert botogram.utils.drive(botogram.utils.call_steps(double, a=2)) == 4
+
+
+def test_drive_async():
+    def steps(a):
+        result = yield asyncio.sleep(0.1, a)
+        return result * 2
+
+    async def main(executor):
+        return await asyncio.gather(*(
+            botogram.utils.drive_async(steps(i), executor) for i in range(200)
+        ))
+
+    # The coroutines are awaited on the event loop, so they don't need a
+    # thread each to run at the same time
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+    try:
+        start = time.monotonic()
+        results = asyncio.run(main(executor))
+        assert time.monotonic() - start < 5
+    finally:
+        executor.shutdown()
+
+    assert results == [i * 2 for i in range(200)]
+
+
+def test_drive_async_timeout():
+    def steps():
+        botogram.utils.set_coroutines_timeout(0.05)
+        with pytest.raises(TimeoutError):
+            yield asyncio.sleep(10)
+        return True
+
+    assert asyncio.run(botogram.utils.drive_async(steps())) is True